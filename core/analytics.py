@@ -0,0 +1,105 @@
+from itertools import chain
+
+import numpy as np
+
+from .models import UserAnswer
+from .services import get_answer_key
+
+
+def compute_item_analysis(quiz_id):
+    """
+    Per-question item analysis over every recorded attempt of a quiz
+
+    UserAnswer rows are streamed once into an attempt x question matrix of selected option
+    indices, and all statistics are computed on that matrix with NumPy:
+    - difficulty index: share of attempts answering the question correctly
+    - discrimination index: point-biserial correlation between answering correctly and total score
+    - distractor analysis: how often each option was selected
+
+    Returns:
+        Dictionary with "total_attempts" and a "questions" list in question id order
+    """
+    answer_key = get_answer_key(quiz_id)
+    question_ids = np.array(sorted(answer_key), dtype=np.int64)
+
+    # Flatten every option into one index space; each question's correct option gets its global index
+    option_ids = []
+    correct_index = np.full(len(question_ids), -1, dtype=np.int64)
+    for column, question_id in enumerate(question_ids.tolist()):
+        entry = answer_key[question_id]
+        for option_id in entry["options"]:
+            if option_id == entry["correct_option_id"]:
+                correct_index[column] = len(option_ids)
+            option_ids.append(option_id)
+    option_ids = np.array(option_ids, dtype=np.int64)
+    option_order = np.argsort(option_ids)
+
+    rows = UserAnswer.objects.filter(attempt__quiz_id=quiz_id).values_list(
+        'attempt_id', 'question_id', 'selected_option_id'
+    ).order_by().iterator(chunk_size=5000)
+    flat = np.fromiter(chain.from_iterable(rows), dtype=np.int64)
+    answers = flat.reshape(-1, 3)
+
+    attempt_ids, attempt_rows = np.unique(answers[:, 0], return_inverse=True)
+    total_attempts = len(attempt_ids)
+
+    # Drop answers that no longer match the current key (e.g. questions or options removed by an admin)
+    question_columns = np.searchsorted(question_ids, answers[:, 1]).clip(max=max(len(question_ids) - 1, 0))
+    option_positions = np.searchsorted(option_ids, answers[:, 2], sorter=option_order)
+    option_positions = option_positions.clip(max=max(len(option_ids) - 1, 0))
+    option_indexes = option_order[option_positions] if len(option_ids) else option_positions
+    valid = np.zeros(len(answers), dtype=bool)
+    if len(question_ids) and len(option_ids):
+        valid = (question_ids[question_columns] == answers[:, 1]) & (option_ids[option_indexes] == answers[:, 2])
+
+    selected = np.full((total_attempts, len(question_ids)), -1, dtype=np.int64)
+    selected[attempt_rows[valid], question_columns[valid]] = option_indexes[valid]
+
+    correct = (selected == correct_index[np.newaxis, :]) & (selected >= 0)
+    correct = correct.astype(np.float64)
+    answered_counts = (selected >= 0).sum(axis=0)
+    totals = correct.sum(axis=1)
+
+    if total_attempts:
+        difficulty = correct.mean(axis=0)
+        item_dev = correct - difficulty
+        total_dev = totals - totals.mean()
+        denominator = np.sqrt((item_dev ** 2).sum(axis=0) * (total_dev ** 2).sum())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = (item_dev * total_dev[:, np.newaxis]).sum(axis=0)
+            discrimination = np.where(denominator > 0, covariance / denominator, np.nan)
+    else:
+        difficulty = np.full(len(question_ids), np.nan)
+        discrimination = np.full(len(question_ids), np.nan)
+
+    option_counts = np.bincount(selected[selected >= 0], minlength=len(option_ids))
+
+    questions = []
+    position = 0
+    for column, question_id in enumerate(question_ids.tolist()):
+        entry = answer_key[question_id]
+        options = []
+        for option_id, text in entry["options"].items():
+            count = int(option_counts[position])
+            options.append({
+                "option_id": option_id,
+                "text": text,
+                "is_correct": option_id == entry["correct_option_id"],
+                "count": count,
+                "frequency": round(count / total_attempts, 3) if total_attempts else 0.0
+            })
+            position += 1
+
+        questions.append({
+            "question_id": question_id,
+            "question_text": entry["text"],
+            "responses": int(answered_counts[column]),
+            "difficulty_index": None if np.isnan(difficulty[column]) else round(float(difficulty[column]), 3),
+            "discrimination_index": None if np.isnan(discrimination[column]) else round(float(discrimination[column]), 3),
+            "options": options
+        })
+
+    return {
+        "total_attempts": total_attempts,
+        "questions": questions
+    }
@@ -0,0 +1,175 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authentication import CSRFCheck
+from rest_framework.authtoken.models import Token
+
+from .models import UploadedPDF, Quiz
+from .retrieval import get_pdf_index, select_passages
+from .services import (
+    create_quiz_with_questions, get_answer_key, load_stored_explanations, store_explanations,
+    build_explanation_questions
+)
+from .utils import agenerate_mcqs_from_text, agenerate_answer_explanations, EXPLANATION_CONTEXT_CHARS
+from .views import validate_num_questions
+
+
+class AsyncAPIView(View):
+    """
+    Base for async-native JSON endpoints served under ASGI
+
+    DRF views run synchronously, so these views handle what APIView would: token or session
+    authentication, JSON request bodies and, as SessionAuthentication does, a CSRF check for
+    logged-in session users (token clients are exempt).
+    """
+    authentication_required = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # The middleware would also reject token clients; dispatch() checks session users itself
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        keyword, _, key = header.partition(' ')
+        if keyword == 'Token':
+            token = await Token.objects.select_related('user').filter(key=key.strip()).afirst()
+            if token is None or not token.user.is_active:
+                return JsonResponse({"detail": "Invalid token."}, status=401)
+            request.api_user = token.user
+        else:
+            user = await request.auser()
+            request.api_user = user if user.is_authenticated else None
+            if request.api_user is not None:
+                check = CSRFCheck(lambda request: None)
+                check.process_request(request)  # Reads the CSRF cookie process_view() compares against
+                reason = check.process_view(request, None, (), {})
+                if reason:
+                    return JsonResponse({"detail": f"CSRF Failed: {reason}"}, status=403)
+
+        if self.authentication_required and request.api_user is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+        try:
+            request.json = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({"error": "Request body must be valid JSON"}, status=400)
+        if not isinstance(request.json, dict):
+            return JsonResponse({"error": "Request body must be a JSON object"}, status=400)
+
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncGenerateQuizView(AsyncAPIView):
+    """
+    Generate quiz from PDF without holding a worker thread during the LLM calls
+    POST /api/async/generate-quiz/{pdf_id}/
+
+    Takes the same payload as GenerateQuizView, but waits for the LLM and returns
+    the created quiz id instead of a 202 with a generation job id.
+    """
+    authentication_required = True
+
+    async def post(self, request, pdf_id):
+        try:
+            pdf = await UploadedPDF.objects.aget(id=pdf_id)
+        except UploadedPDF.DoesNotExist:
+            return JsonResponse({"error": "PDF not found"}, status=404)
+
+        num_questions = request.json.get('num_questions', 5)
+        error = validate_num_questions(num_questions)
+        if error:
+            return JsonResponse({"error": error}, status=400)
+
+        pages = pdf.pages().order_by('page_number').values_list('text', flat=True)
+        text = "".join([page async for page in pages])
+
+        questions = await agenerate_mcqs_from_text(text, num_questions=num_questions)
+
+        if not questions:
+            return JsonResponse({
+                "error": "Failed to generate questions. Please try again or use a different PDF."
+            }, status=500)
+
+        # Writes stay synchronous so the quiz is persisted in one transaction
+        actual_questions_count = len(questions)
+        created = await sync_to_async(create_quiz_with_questions)(
+            pdf,
+            f"Quiz from {pdf.title} ({actual_questions_count} questions)",
+            questions
+        )
+
+        return JsonResponse({
+            "quiz_id": created["quiz"].id,
+            "message": f"Quiz with {actual_questions_count} questions generated successfully",
+            "requested_questions": num_questions,
+            "questions_generated": actual_questions_count
+        })
+
+
+class AsyncQuizExplanationView(AsyncAPIView):
+    """
+    Get AI-generated explanations for quiz questions/answers on the event loop
+    POST /api/async/quiz/{quiz_id}/explain/
+
+    Same payload and response as QuizExplanationView.
+    """
+    async def post(self, request, quiz_id):
+        try:
+            quiz = await Quiz.objects.select_related('pdf').aget(id=quiz_id)
+        except Quiz.DoesNotExist:
+            return JsonResponse({"error": "Quiz not found"}, status=404)
+
+        user = request.api_user
+        if not quiz.pdf.is_public and quiz.pdf.user_id != (user.id if user else None):
+            return JsonResponse({"error": "This quiz is private"}, status=403)
+
+        question_ids = request.json.get('question_ids', [])
+        include_context = request.json.get('include_context', True)
+
+        if not question_ids:
+            return JsonResponse({"error": "No question_ids provided"}, status=400)
+
+        if not isinstance(question_ids, list):
+            return JsonResponse({"error": "question_ids must be a list"}, status=400)
+
+        answer_key = await sync_to_async(get_answer_key)(quiz.id)
+        invalid_ids = [qid for qid in question_ids if qid not in answer_key]
+        if invalid_ids:
+            return JsonResponse({
+                "error": f"Some question IDs don't belong to this quiz: {invalid_ids}"
+            }, status=400)
+
+        questions_data = build_explanation_questions(answer_key, question_ids)
+
+        context_mode = 'pdf' if include_context else 'none'
+        stored = await sync_to_async(load_stored_explanations)([q["question_id"] for q in questions_data], context_mode)
+        missing = [q for q in questions_data if q["question_id"] not in stored]
+
+        try:
+            if missing:
+                context_builder = None
+                if include_context:
+                    # Building the passage index reads the PDF pages, so it runs off the event loop, once
+                    index = await sync_to_async(get_pdf_index)(quiz.pdf)
+                    context_builder = lambda group: select_passages(index, group, max_chars=EXPLANATION_CONTEXT_CHARS)
+
+                generated = await agenerate_answer_explanations(missing, context_builder=context_builder)
+                stored.update(await sync_to_async(store_explanations)(
+                    generated, [q["question_id"] for q in missing], context_mode
+                ))
+
+            return JsonResponse({
+                "quiz_id": quiz.id,
+                "quiz_title": quiz.title,
+                "explanations": [stored[q["question_id"]] for q in questions_data]
+            })
+
+        except Exception as e:
+            return JsonResponse({
+                "error": "Failed to generate explanations",
+                "details": str(e)
+            }, status=500)
@@ -0,0 +1,237 @@
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import GenerationJob, GenerationChunk
+from .services import create_quiz_with_questions
+from .utils import plan_generation, generate_chunks_concurrently
+
+# A running job whose worker hasn't reported progress for this long is considered abandoned and reclaimed
+GENERATION_JOB_LEASE_SECONDS = int(os.getenv("GENERATION_JOB_LEASE_SECONDS", "300"))
+# Claims allowed before a job that keeps failing or crashing its worker is given up on
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "3"))
+# How often a running job's lease is renewed while its LLM calls are in progress
+GENERATION_JOB_HEARTBEAT_SECONDS = GENERATION_JOB_LEASE_SECONDS / 5
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+
+class JobLeaseLost(Exception):
+    """
+    Raised when a worker finds that another worker has reclaimed the job it was running
+    """
+
+
+def make_worker_id(label=""):
+    return f"{socket.gethostname()}-{os.getpid()}-{label or uuid.uuid4().hex[:8]}"
+
+
+def enqueue_generation_job(pdf, user, num_questions):
+    """
+    Queue quiz generation for a PDF, reusing an identical job that is still pending or running
+    so a client retry doesn't start the work over
+
+    Returns:
+        (job, created)
+    """
+    active = GenerationJob.objects.filter(
+        pdf=pdf, user=user, num_questions=num_questions, status__in=ACTIVE_STATUSES
+    ).order_by('created_at').first()
+    if active:
+        return active, False
+    return GenerationJob.objects.create(pdf=pdf, user=user, num_questions=num_questions), True
+
+
+def claim_job(job, worker_id):
+    """
+    Take ownership of a job if it is still in the state it was read in
+
+    The update only matches while status and heartbeat are unchanged, so of several workers
+    racing for the same row exactly one wins, with or without row locks.
+    """
+    claimed = GenerationJob.objects.filter(
+        id=job.id, status=job.status, heartbeat_at=job.heartbeat_at
+    ).update(
+        status='running',
+        locked_by=worker_id,
+        heartbeat_at=timezone.now(),
+        attempts=F('attempts') + 1
+    )
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+
+def claim_next_job(worker_id):
+    """
+    Claim the oldest pending job, or a running job whose worker stopped heartbeating
+
+    Candidates are read with SELECT ... FOR UPDATE SKIP LOCKED so concurrent workers skip rows
+    another worker is claiming (databases without row locks fall back to claim_job's check).
+
+    Returns:
+        The claimed GenerationJob, or None if there is nothing to do
+    """
+    stale = timezone.now() - timedelta(seconds=GENERATION_JOB_LEASE_SECONDS)
+    claimable = Q(status='pending') | Q(status='running', heartbeat_at__lt=stale)
+
+    with transaction.atomic():
+        candidates = GenerationJob.objects.select_for_update(skip_locked=True).filter(claimable).order_by('created_at')[:10]
+        for job in candidates:
+            if claim_job(job, worker_id):
+                return job
+    return None
+
+
+def heartbeat(job, worker_id):
+    """
+    Record progress on a job, raising JobLeaseLost if the job no longer belongs to this worker
+    """
+    if not GenerationJob.objects.filter(id=job.id, status='running', locked_by=worker_id).update(heartbeat_at=timezone.now()):
+        raise JobLeaseLost(f"Job {job.id} was reclaimed from {worker_id}")
+
+
+class LeaseKeeper:
+    """
+    Heartbeats a job from a background thread, so a chunk that takes longer than the lease
+    (model fallbacks, rate-limit waits, top-ups) doesn't get the job reclaimed mid-run
+
+    Used as a context manager around the generation; `lost` is set once another worker owns the job.
+    """
+    def __init__(self, job, worker_id, interval=None):
+        self.job = job
+        self.worker_id = worker_id
+        self.interval = interval or GENERATION_JOB_HEARTBEAT_SECONDS
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    heartbeat(self.job, self.worker_id)
+                except JobLeaseLost as e:
+                    print(str(e))
+                    self.lost = True
+                    return
+                except Exception as e:
+                    # A missed beat is retried on the next tick; the lease outlasts several
+                    print(f"Heartbeat for job {self.job.id} failed: {str(e)}")
+        finally:
+            connection.close()
+
+
+def run_generation_job(job, worker_id):
+    """
+    Generate the questions for a claimed job and create its quiz
+
+    The chunk plan is stored on the first run and every chunk result is saved as soon as it
+    arrives, so a job reclaimed after a worker crash resumes after the last completed chunk.
+    """
+    if job.attempts > GENERATION_JOB_MAX_ATTEMPTS:
+        _finish(job, worker_id, status='failed', error=f"Gave up after {GENERATION_JOB_MAX_ATTEMPTS} attempts")
+        return job
+
+    try:
+        chunks = list(job.chunks.order_by('index'))
+        if not chunks:
+            plan = plan_generation(job.pdf.get_text(), job.num_questions)
+            with transaction.atomic():
+                heartbeat(job, worker_id)
+                chunks = GenerationChunk.objects.bulk_create([
+                    GenerationChunk(job=job, index=index, text=text, questions_requested=count)
+                    for index, (text, count) in enumerate(plan)
+                ])
+
+        generated = sum(len(chunk.questions) for chunk in chunks if chunk.status == 'completed')
+        remaining = [chunk for chunk in chunks if chunk.status == 'pending']
+        if generated:
+            print(f"Job {job.id}: resuming with {generated} questions from earlier chunks")
+
+        def record(position, questions):
+            chunk = remaining[position]
+            chunk.questions = questions
+            chunk.status = 'completed' if questions else 'failed'
+            # Only a worker still holding the lease may write; the heartbeat update keeps the job
+            # row locked until the chunk is saved, so a reclaim can't slip in between
+            with transaction.atomic():
+                heartbeat(job, worker_id)
+                chunk.save(update_fields=['questions', 'status'])
+
+        if generated < job.num_questions and remaining:
+            with LeaseKeeper(job, worker_id):
+                generate_chunks_concurrently(
+                    [(chunk.text, chunk.questions_requested) for chunk in remaining],
+                    job.num_questions - generated,
+                    on_result=record
+                )
+
+        questions = []
+        for chunk in job.chunks.filter(status='completed').order_by('index'):
+            questions.extend(chunk.questions)
+        questions = questions[:job.num_questions]
+
+        if not questions:
+            _finish(job, worker_id, status='failed',
+                    error="Failed to generate questions. Please try again or use a different PDF.")
+            return job
+
+        with transaction.atomic():
+            heartbeat(job, worker_id)
+            created = create_quiz_with_questions(
+                job.pdf,
+                f"Quiz from {job.pdf.title} ({len(questions)} questions)",
+                questions
+            )
+            _finish(job, worker_id, status='completed', quiz=created["quiz"])
+
+    except JobLeaseLost as e:
+        print(str(e))
+    except Exception as e:
+        print(f"Job {job.id} failed on attempt {job.attempts}: {str(e)}")
+        # Leave it for another attempt unless it has used them all
+        retry = job.attempts < GENERATION_JOB_MAX_ATTEMPTS
+        _finish(job, worker_id, status='pending' if retry else 'failed', error=str(e))
+
+    return job
+
+
+def _finish(job, worker_id, status, error="", quiz=None):
+    job.status = status
+    job.error = error
+    job.quiz = quiz
+    job.locked_by = ""
+    job.heartbeat_at = None
+    GenerationJob.objects.filter(id=job.id, locked_by=worker_id).update(
+        status=status, error=error, quiz=quiz, locked_by="", heartbeat_at=None, updated_at=timezone.now()
+    )
+    if status != 'pending':
+        job.chunks.filter(status='pending').update(status='skipped')
+
+
+def run_generation_job_now(pdf, user, num_questions):
+    """
+    Create and run a job in the calling thread, for clients that wait for the quiz in the request
+    """
+    # Created already claimed, so no background worker can pick it up before it starts here
+    worker_id = make_worker_id("inline")
+    job = GenerationJob.objects.create(
+        pdf=pdf, user=user, num_questions=num_questions,
+        status='running', locked_by=worker_id, heartbeat_at=timezone.now(), attempts=1
+    )
+    return run_generation_job(job, worker_id)
@@ -0,0 +1,430 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+from .llm_scheduler import LatencyHistogram
+from .token_budget import count_message_tokens, count_tokens
+
+GROQ_API_BASE = "https://api.groq.com/openai/v1"
+
+# Connection pool for the pooled backend: connections kept per process (per event loop for async
+# callers), seconds to establish one, seconds to wait for a response and seconds an idle one is kept
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", "20"))
+LLM_HTTP_CONNECT_TIMEOUT = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", "5"))
+LLM_HTTP_READ_TIMEOUT = float(os.getenv("LLM_HTTP_READ_TIMEOUT", "60"))
+LLM_HTTP_KEEPALIVE_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_SECONDS", "60"))
+
+MCQ_PROMPT_RE = re.compile(r"Generate exactly (\d+) multiple choice questions")
+EXPLANATION_ID_RE = re.compile(r"^Question ID (\d+):", re.MULTILINE)
+WORD_RE = re.compile(r"[A-Za-z][A-Za-z'-]{3,}")
+
+
+class LLMClient:
+    """
+    Chat completion backend used for every LLM call
+
+    chat() and achat() take the OpenAI chat completion arguments and return a response shaped
+    like the OpenAI API's ({"choices": [{"message": {"content": ...}}], "usage": {...}}).
+    Failures are raised as openai.error exceptions so the scheduler's retry and circuit breaker
+    logic works the same whichever backend is in use.
+    """
+    @property
+    def identity(self):
+        """
+        Which backend answers, so cached responses from one (e.g. the stub) are never served by another
+        """
+        return type(self).__name__
+
+    def chat(self, model, messages, temperature, max_tokens, timeout=None):
+        raise NotImplementedError
+
+    async def achat(self, model, messages, temperature, max_tokens, timeout=None):
+        # Backends without native async support run on a worker thread
+        return await asyncio.to_thread(self.chat, model, messages, temperature, max_tokens, timeout)
+
+    def stats(self):
+        return {}
+
+    async def aclose(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class OpenAIClient(LLMClient):
+    """
+    The openai library's client for any OpenAI-compatible API, with credentials passed per call
+    instead of through the module-level openai.api_key / openai.api_base
+    """
+    def __init__(self, api_key=None, api_base=GROQ_API_BASE):
+        self.api_key = api_key
+        self.api_base = api_base
+
+    @property
+    def identity(self):
+        return f"{type(self).__name__}:{self.api_base}"
+
+    def chat(self, model, messages, temperature, max_tokens, timeout=None):
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            request_timeout=timeout,
+            api_key=self.api_key,
+            api_base=self.api_base
+        )
+
+    async def achat(self, model, messages, temperature, max_tokens, timeout=None):
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            request_timeout=timeout,
+            api_key=self.api_key,
+            api_base=self.api_base
+        )
+
+
+class HTTPMetrics:
+    """
+    Per-call counters and latency percentiles for an HTTP client, safe to update from any thread
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.connections_opened = 0
+        self.status_codes = {}
+        self.errors = {}
+
+    def record(self, seconds, status=None, error=None):
+        with self._lock:
+            self.requests += 1
+            self.latency.record(seconds)
+            if status is not None:
+                self.status_codes[status] = self.status_codes.get(status, 0) + 1
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def connection_opened(self, count=1):
+        with self._lock:
+            self.connections_opened += count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "status_codes": dict(self.status_codes),
+                "errors": dict(self.errors),
+                **{f"latency_p{p}": _round(self.latency.percentile(p)) for p in (50, 95, 99)}
+            }
+
+
+def _round(seconds):
+    return None if seconds is None else round(seconds, 3)
+
+
+class PooledHTTPClient(LLMClient):
+    """
+    Talks to an OpenAI-compatible /chat/completions endpoint directly over keep-alive connection pools
+
+    Threads share one requests.Session whose pool holds up to pool_size connections (callers wait
+    for a free one rather than opening throwaway connections), and each event loop gets its own
+    aiohttp session with the same limit, since aiohttp sessions can't cross loops. Connections
+    are reused until idle for keepalive seconds, so concurrent generations don't repeat the TLS
+    handshake. Every call has a connect timeout and a read timeout (the per-call timeout when
+    given), and is recorded in metrics.
+    """
+    def __init__(self, api_key=None, api_base=GROQ_API_BASE, pool_size=LLM_HTTP_POOL_SIZE,
+                 connect_timeout=LLM_HTTP_CONNECT_TIMEOUT, read_timeout=LLM_HTTP_READ_TIMEOUT,
+                 keepalive=LLM_HTTP_KEEPALIVE_SECONDS):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self.metrics = HTTPMetrics()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._async_sessions = {}  # event loop -> aiohttp.ClientSession
+
+    @property
+    def identity(self):
+        return f"{type(self).__name__}:{self.api_base}"
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+
+    @staticmethod
+    def _payload(model, messages, temperature, max_tokens):
+        return {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+
+    def _sync_session(self):
+        with self._lock:
+            # A forked worker must not share its parent's sockets
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def chat(self, model, messages, temperature, max_tokens, timeout=None):
+        session = self._sync_session()
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                self.url, json=self._payload(model, messages, temperature, max_tokens),
+                headers=self._headers(), timeout=(self.connect_timeout, timeout or self.read_timeout)
+            )
+        except requests.Timeout as e:
+            self.metrics.record(time.perf_counter() - started, error="timeout")
+            raise openai.error.Timeout(f"Request to {model} timed out: {e}") from e
+        except requests.RequestException as e:
+            self.metrics.record(time.perf_counter() - started, error="connection")
+            raise openai.error.APIConnectionError(f"Error communicating with the LLM API: {e}") from e
+        self.metrics.record(time.perf_counter() - started, status=response.status_code)
+        return _parse_http_response(response.status_code, response.text, response.headers)
+
+    def _async_session(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                # Sessions of loops that have finished can't be closed any more; drop their sockets
+                for old_loop in [old for old in self._async_sessions if old.is_closed()]:
+                    _discard_async_session(old_loop, self._async_sessions.pop(old_loop))
+
+                trace = aiohttp.TraceConfig()
+                trace.on_connection_create_end.append(self._on_connection_created)
+                session = self._async_sessions[loop] = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive),
+                    trace_configs=[trace]
+                )
+            return session
+
+    async def _on_connection_created(self, session, context, params):
+        self.metrics.connection_opened()
+
+    async def achat(self, model, messages, temperature, max_tokens, timeout=None):
+        started = time.perf_counter()
+        try:
+            async with self._async_session().post(
+                self.url, json=self._payload(model, messages, temperature, max_tokens),
+                headers=self._headers(),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=timeout or self.read_timeout)
+            ) as response:
+                body = await response.text()
+        except asyncio.TimeoutError as e:
+            self.metrics.record(time.perf_counter() - started, error="timeout")
+            raise openai.error.Timeout(f"Request to {model} timed out") from e
+        except aiohttp.ClientError as e:
+            self.metrics.record(time.perf_counter() - started, error="connection")
+            raise openai.error.APIConnectionError(f"Error communicating with the LLM API: {e}") from e
+        self.metrics.record(time.perf_counter() - started, status=response.status)
+        return _parse_http_response(response.status, body, response.headers)
+
+    async def aclose(self):
+        """
+        Close the running event loop's session; call before the loop shuts down
+        """
+        with self._lock:
+            session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def stats(self):
+        stats = {"pool_size": self.pool_size, **self.metrics.stats()}
+        # urllib3 counts the connections its pools open; aiohttp's are counted by the trace hook
+        session = self._session
+        if session is not None:
+            stats["connections_opened"] += _open_connections(session)
+        return stats
+
+    def close(self):
+        with self._lock:
+            session, self._session = self._session, None
+            sessions, self._async_sessions = self._async_sessions, {}
+        if session is not None:
+            session.close()
+        for loop, async_session in sessions.items():
+            _discard_async_session(loop, async_session)
+
+
+def _discard_async_session(loop, session):
+    """
+    Release an aiohttp session from outside its event loop
+    """
+    if session.closed:
+        return
+    if loop.is_closed():
+        # Its sockets went with the loop; there is nothing left to close
+        session.detach()
+    else:
+        loop.call_soon_threadsafe(lambda: loop.create_task(session.close()))
+
+
+def _open_connections(session):
+    """
+    Connections the session's urllib3 pools have opened since it was created
+    """
+    total = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        total += sum(pools[key].num_connections for key in pools.keys())
+    return total
+
+
+def _parse_http_response(status, body, headers):
+    """
+    Decode a chat completion response, raising the openai.error the openai library would
+    """
+    headers = dict(headers)
+    try:
+        data = json.loads(body)
+    except json.JSONDecodeError:
+        data = None
+
+    if 200 <= status < 300 and isinstance(data, dict):
+        return data
+
+    message = body
+    if isinstance(data, dict) and isinstance(data.get("error"), dict):
+        message = data["error"].get("message", body)
+    error_class = {
+        401: openai.error.AuthenticationError,
+        403: openai.error.PermissionError,
+        429: openai.error.RateLimitError,
+        503: openai.error.ServiceUnavailableError,
+    }.get(status, openai.error.InvalidRequestError if 400 <= status < 500 else openai.error.APIError)
+    if error_class is openai.error.InvalidRequestError:
+        raise error_class(message, None, http_body=body, http_status=status, headers=headers)
+    raise error_class(message, http_body=body, http_status=status, json_body=data, headers=headers)
+
+
+class StubLLMClient(LLMClient):
+    """
+    Deterministic offline backend for benchmarks and load tests
+
+    MCQ prompts get exactly the requested number of schema-valid questions built from words in
+    the source text, explanation prompts get one explanation per question ID, and anything else
+    an empty JSON array. Responses depend only on the request, so repeated runs are comparable;
+    latency (seconds, with +/- jitter as a fraction) and failure_rate are drawn from a seeded RNG.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            delay = self.latency * (1 + self.jitter * (2 * self._random.random() - 1))
+            failed = self._random.random() < self.failure_rate
+        return max(0.0, delay), failed
+
+    def chat(self, model, messages, temperature, max_tokens, timeout=None):
+        delay, failed = self._draw()
+        time.sleep(delay if timeout is None else min(delay, timeout))
+        return self._respond(model, messages, delay, failed, timeout)
+
+    async def achat(self, model, messages, temperature, max_tokens, timeout=None):
+        delay, failed = self._draw()
+        await asyncio.sleep(delay if timeout is None else min(delay, timeout))
+        return self._respond(model, messages, delay, failed, timeout)
+
+    def _respond(self, model, messages, delay, failed, timeout):
+        if timeout is not None and delay > timeout:
+            raise openai.error.Timeout(f"Stub request to {model} timed out after {timeout}s")
+        if failed:
+            raise openai.error.ServiceUnavailableError("Stub LLM failure", http_status=503)
+
+        prompt = messages[-1]["content"]
+        content = json.dumps(stub_completion(prompt))
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(content, model)
+        return {
+            "id": "stub-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12],
+            "object": "chat.completion",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+
+def stub_completion(prompt):
+    """
+    The parsed JSON a well-behaved model would return for one of our prompts
+    """
+    match = MCQ_PROMPT_RE.search(prompt)
+    if match:
+        return _stub_mcqs(prompt, int(match.group(1)))
+
+    question_ids = EXPLANATION_ID_RE.findall(prompt)
+    return [{
+        "question_id": int(question_id),
+        "explanation": f"Stub explanation for question {question_id}.",
+        "key_concepts": ["stub concept", f"question {question_id}"]
+    } for question_id in question_ids]
+
+
+def _stub_mcqs(prompt, count):
+    source = prompt.split("Text to generate questions from:", 1)[-1]
+    words = WORD_RE.findall(source) or ["quiz", "stub", "text", "answer"]
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()[:8]
+    # Top-up prompts list the questions already generated; number new ones after them
+    start = prompt.count("\n- ") if "Do not repeat any of these existing questions" in prompt else 0
+
+    questions = []
+    for n in range(start, start + count):
+        options = {letter: words[(n * 4 + offset) % len(words)] for offset, letter in enumerate("abcd")}
+        questions.append({
+            "question": f"Which term does passage {digest} use in point {n + 1}?",
+            "options": options,
+            "answer": "abcd"[n % 4]
+        })
+    return questions
+
+
+def build_client_from_env():
+    """
+    Build the process-wide LLM client from LLM_BACKEND (pooled, openai or stub), LLM_API_BASE and
+    GROQ_API_KEY, or LLM_STUB_LATENCY, LLM_STUB_JITTER, LLM_STUB_FAILURE_RATE and LLM_STUB_SEED
+    """
+    backend_name = os.getenv("LLM_BACKEND", "pooled").lower()
+    api_key = os.getenv("GROQ_API_KEY")
+    api_base = os.getenv("LLM_API_BASE", GROQ_API_BASE)
+
+    if backend_name == "stub":
+        return StubLLMClient(
+            latency=float(os.getenv("LLM_STUB_LATENCY", "0")),
+            jitter=float(os.getenv("LLM_STUB_JITTER", "0")),
+            failure_rate=float(os.getenv("LLM_STUB_FAILURE_RATE", "0")),
+            seed=int(os.getenv("LLM_STUB_SEED", "0"))
+        )
+    if backend_name == "openai":
+        return OpenAIClient(api_key=api_key, api_base=api_base)
+    return PooledHTTPClient(api_key=api_key, api_base=api_base)
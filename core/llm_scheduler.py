@@ -0,0 +1,556 @@
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+
+import openai
+
+from .token_budget import get_model_limits
+
+# Consecutive failures (errors other than rate limiting) that open a model's circuit breaker
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+# Seconds an open circuit rejects calls before letting a single trial call through
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+# Times a rate-limited call is retried on the same model after waiting out Retry-After
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "2"))
+# Longest Retry-After worth waiting for on the same model; longer ones fail over to another model
+LLM_MAX_RETRY_WAIT = float(os.getenv("LLM_MAX_RETRY_WAIT", "20"))
+
+# Hedged requests: when a call is slower than this percentile of the model's recent latencies,
+# the same request is also sent to the next model and the first valid response wins
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+# Used until a model has LLM_HEDGE_MIN_SAMPLES latencies recorded
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "15"))
+LLM_HEDGE_MIN_SAMPLES = 20
+# Calls per model the latency histograms are computed over
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "500"))
+
+# Read timeout for each attempt of a hedged sync call. A running thread can't be interrupted, so
+# this bounds how long the losing attempt keeps a pool thread and a connection after the race
+LLM_HEDGE_ATTEMPT_TIMEOUT = float(os.getenv("LLM_HEDGE_ATTEMPT_TIMEOUT", "20"))
+
+# Maximum number of chunk requests sent to the LLM at the same time
+MAX_CONCURRENT_BATCHES = int(os.getenv("MAX_CONCURRENT_BATCHES", "4"))
+
+# Threads running hedged attempts, so the caller can wait on whichever finishes first: room for
+# every concurrent batch's attempt plus its hedge
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_WORKERS", str(2 * MAX_CONCURRENT_BATCHES))))
+# Read timeout override for the attempt running on the current pool thread
+_attempt_timeout = contextvars.ContextVar('attempt_timeout', default=None)
+
+
+def attempt_timeout(default):
+    """
+    Read timeout for an LLM request: default, shortened while running as a hedged attempt
+    """
+    override = _attempt_timeout.get()
+    return default if override is None else min(default, override)
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at `rate` units per second up to `capacity`
+
+    Reservations may take the level below zero; the caller then sleeps for the returned delay.
+    Callers therefore queue in arrival order without holding a lock while they wait.
+    """
+    def __init__(self, capacity, rate, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.level = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount):
+        self._refill()
+        # A request larger than the whole bucket waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def reserve(self, amount):
+        delay = self.delay_for(amount)
+        self.level -= min(amount, self.capacity)
+        return delay
+
+    def refund(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class LatencyHistogram:
+    """
+    Latencies of a model's most recent calls in log-spaced buckets
+
+    Buckets grow by 10% from 10ms, so a percentile is accurate to within 10%. Only the last
+    `window` calls are counted, letting thresholds follow the model as it speeds up or slows down.
+    """
+    MIN_SECONDS = 0.01
+    GROWTH = 1.1
+    BUCKETS = 120  # Up to about 15 minutes
+
+    def __init__(self, window=LLM_LATENCY_WINDOW):
+        self.window = window
+        self.counts = [0] * self.BUCKETS
+        self.recent = deque()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def record(self, seconds):
+        index = int(math.log(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS, self.GROWTH))
+        index = min(index, self.BUCKETS - 1)
+        self.counts[index] += 1
+        self.recent.append(index)
+        if len(self.recent) > self.window:
+            self.counts[self.recent.popleft()] -= 1
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile (0-100), or None without samples
+        """
+        if not self.recent:
+            return None
+        rank = max(1, math.ceil(p / 100 * len(self.recent)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.MIN_SECONDS * self.GROWTH ** (index + 1)
+
+
+class ModelState:
+    """
+    Rate budgets and circuit breaker of one model
+    """
+    def __init__(self, limits, clock):
+        self.requests = TokenBucket(limits["rpm"], limits["rpm"] / 60, clock)
+        self.tokens = TokenBucket(limits["tpm"], limits["tpm"] / 60, clock)
+        self.blocked_until = 0.0  # Set from Retry-After
+        self.rate_limit_streak = 0
+        self.failures = 0  # Consecutive failures
+        self.opened_at = None  # When the circuit opened; None while closed
+        self.trial_in_flight = False
+        self.counts = {"success": 0, "failure": 0, "rate_limited": 0, "rejected": 0}
+        self.latency = LatencyHistogram()
+
+    def circuit(self, now):
+        if self.opened_at is None:
+            return 'closed'
+        if now - self.opened_at >= LLM_BREAKER_COOLDOWN:
+            return 'half_open'
+        return 'open'
+
+
+class CircuitOpenError(openai.error.OpenAIError):
+    """
+    Raised instead of sending a call to a model whose circuit breaker is open
+    """
+
+
+def is_transient_error(error):
+    """
+    Whether an API error says the model is struggling (timeouts, dropped connections, 5xx), as
+    opposed to a request it rejected (bad request, context too long, bad credentials)
+
+    Only transient errors count towards the circuit breaker, so a few oversized requests can't
+    cut every caller off from a healthy model.
+    """
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    if type(error) is openai.error.APIError:
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def retry_after_seconds(error):
+    """
+    Seconds requested by a rate-limit error's Retry-After header, or None if it has none
+    """
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    """
+    Process-wide routing of LLM calls across models
+
+    Every call reserves one request and its tokens from the model's per-minute token buckets and
+    waits if the budget is spent. A 429 blocks the model for its Retry-After (or an exponential
+    backoff). LLM_BREAKER_THRESHOLD consecutive transient failures (timeouts, connection errors,
+    5xx) open the model's circuit breaker for LLM_BREAKER_COOLDOWN seconds, after which one trial
+    call decides whether it closes again. Rejected requests (4xx) don't count.
+    route() hands out the model that can serve a call soonest, preferring the configured order.
+    """
+    def __init__(self, limits=get_model_limits, clock=time.monotonic):
+        self.limits = limits  # model -> {"rpm": ..., "tpm": ...}
+        self.clock = clock
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, model):
+        state = self._states.get(model)
+        if state is None:
+            state = self._states[model] = ModelState(self.limits(model), self.clock)
+        return state
+
+    def _wait_estimate(self, state, now, tokens):
+        return max(state.blocked_until - now, state.requests.delay_for(1), state.tokens.delay_for(tokens))
+
+    def pick(self, models, tokens=0):
+        """
+        The model among `models` that can take a call of `tokens` soonest, or None if every circuit is open
+
+        Ties go to the earlier model in `models`, and models on a trial call after an open circuit
+        come after healthy ones.
+        """
+        with self._lock:
+            now = self.clock()
+            best = None
+            for preference, model in enumerate(models):
+                state = self._state(model)
+                circuit = state.circuit(now)
+                if circuit == 'open' or (circuit == 'half_open' and state.trial_in_flight):
+                    continue
+                key = (round(self._wait_estimate(state, now, tokens), 1), circuit != 'closed', preference)
+                if best is None or key < best[0]:
+                    best = (key, model)
+            return best[1] if best else None
+
+    def route(self, models, tokens=0):
+        """
+        Yield each of `models` at most once, healthiest first, re-evaluated after every attempt
+        """
+        remaining = list(models)
+        while remaining:
+            model = self.pick(remaining, tokens)
+            if model is None:
+                print(f"Circuit open for every remaining model: {', '.join(remaining)}")
+                return
+            remaining.remove(model)
+            yield model
+
+    def reserve(self, model, tokens):
+        """
+        Take one request and `tokens` from the model's budgets
+
+        Returns:
+            Seconds the caller must wait before sending the request
+
+        Raises:
+            CircuitOpenError: The model's circuit is open, or half-open with its trial call already running
+        """
+        with self._lock:
+            now = self.clock()
+            state = self._state(model)
+            circuit = state.circuit(now)
+            if circuit == 'open' or (circuit == 'half_open' and state.trial_in_flight):
+                raise CircuitOpenError(f"Circuit open for {model}")
+            if circuit == 'half_open':
+                state.trial_in_flight = True
+            return max(state.blocked_until - now, state.requests.reserve(1), state.tokens.reserve(tokens))
+
+    def record_success(self, model, reserved_tokens=0, used_tokens=None, latency=None):
+        with self._lock:
+            state = self._state(model)
+            state.counts["success"] += 1
+            if latency is not None:
+                state.latency.record(latency)
+            state.failures = 0
+            state.rate_limit_streak = 0
+            state.opened_at = None
+            state.trial_in_flight = False
+            if used_tokens is not None and used_tokens < reserved_tokens:
+                state.tokens.refund(reserved_tokens - used_tokens)
+
+    def record_failure(self, model):
+        with self._lock:
+            now = self.clock()
+            state = self._state(model)
+            state.counts["failure"] += 1
+            state.failures += 1
+            # A failed trial call re-opens the circuit straight away
+            if state.trial_in_flight or state.failures >= LLM_BREAKER_THRESHOLD:
+                if state.opened_at is None:
+                    print(f"Circuit opened for {model} after {state.failures} consecutive failures")
+                state.opened_at = now
+            state.trial_in_flight = False
+
+    def record_rejected(self, model):
+        # The request was refused, which says nothing about the model's health
+        with self._lock:
+            state = self._state(model)
+            state.counts["rejected"] += 1
+            state.trial_in_flight = False
+
+    def record_cancelled(self, model):
+        # An abandoned trial call mustn't keep the circuit half-open forever
+        with self._lock:
+            self._state(model).trial_in_flight = False
+
+    def record_rate_limit(self, model, retry_after=None):
+        """
+        Block the model until its Retry-After has passed
+
+        Returns:
+            Seconds the model is blocked for
+        """
+        with self._lock:
+            now = self.clock()
+            state = self._state(model)
+            state.counts["rate_limited"] += 1
+            state.rate_limit_streak += 1
+            state.trial_in_flight = False
+            if retry_after is None:
+                retry_after = min(60, 2 ** state.rate_limit_streak)
+            state.blocked_until = max(state.blocked_until, now + retry_after)
+            print(f"Rate limited on {model}; backing off for {retry_after:.1f}s")
+            return state.blocked_until - now
+
+    def call(self, model, tokens, send):
+        """
+        Run send() against model's budgets, recording the outcome and retrying rate-limited calls
+
+        Calls to a model whose circuit is open fail at once with CircuitOpenError, without sending.
+
+        Args:
+            model: Model the request is for
+            tokens: Tokens the request may use (prompt plus max_tokens)
+            send: Callable making the API request and returning the response
+        """
+        for attempt in range(LLM_RATE_LIMIT_RETRIES + 1):
+            delay = self.reserve(model, tokens)
+            if delay:
+                time.sleep(delay)
+            started = self.clock()
+            try:
+                response = send()
+            except openai.error.RateLimitError as e:
+                blocked = self.record_rate_limit(model, retry_after_seconds(e))
+                if attempt == LLM_RATE_LIMIT_RETRIES or blocked > LLM_MAX_RETRY_WAIT:
+                    raise
+                continue
+            except openai.error.OpenAIError as e:
+                if is_transient_error(e):
+                    self.record_failure(model)
+                else:
+                    self.record_rejected(model)
+                raise
+            self.record_success(model, tokens, _used_tokens(response), latency=self.clock() - started)
+            return response
+
+    async def acall(self, model, tokens, send):
+        """
+        Async version of call; send() returns an awaitable
+        """
+        for attempt in range(LLM_RATE_LIMIT_RETRIES + 1):
+            delay = self.reserve(model, tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            started = self.clock()
+            try:
+                response = await send()
+            except asyncio.CancelledError:
+                self.record_cancelled(model)
+                raise
+            except openai.error.RateLimitError as e:
+                blocked = self.record_rate_limit(model, retry_after_seconds(e))
+                if attempt == LLM_RATE_LIMIT_RETRIES or blocked > LLM_MAX_RETRY_WAIT:
+                    raise
+                continue
+            except openai.error.OpenAIError as e:
+                if is_transient_error(e):
+                    self.record_failure(model)
+                else:
+                    self.record_rejected(model)
+                raise
+            self.record_success(model, tokens, _used_tokens(response), latency=self.clock() - started)
+            return response
+
+    def hedge_delay(self, model):
+        """
+        Seconds to wait on a call to model before hedging it with the next model
+        """
+        with self._lock:
+            latency = self._state(model).latency
+            if len(latency) < LLM_HEDGE_MIN_SAMPLES:
+                return LLM_HEDGE_DEFAULT_DELAY
+            return max(LLM_HEDGE_MIN_DELAY, latency.percentile(LLM_HEDGE_PERCENTILE))
+
+    def first_success(self, models, attempt, tokens=0, hedge=False, on_error=None):
+        """
+        Run attempt(model) on the healthiest model, falling back to the next one when it fails
+
+        With hedge=True a call that has been running for hedge_delay() is raced against the same
+        request on the next model; the first attempt to return wins. The delay is counted from
+        when the attempt gets a pool thread, not from when it was queued, so a busy pool doesn't
+        set off hedges. A running thread can't be interrupted, so losers are abandoned; attempts
+        run with a read timeout of at most LLM_HEDGE_ATTEMPT_TIMEOUT to bound what they hold on to.
+
+        Returns:
+            (model, result) of the first successful attempt, or (None, None) if every model failed
+        """
+        routed = self.route(models, tokens)
+        if not hedge:
+            for model in routed:
+                try:
+                    return model, attempt(model)
+                except Exception as e:
+                    if on_error:
+                        on_error(model, e)
+            return None, None
+
+        pending = {}  # future -> model
+
+        def submit(model):
+            started = Future()  # Resolves to the monotonic time the attempt began running
+
+            def run():
+                started.set_result(time.monotonic())
+                _attempt_timeout.set(LLM_HEDGE_ATTEMPT_TIMEOUT)
+                try:
+                    return attempt(model)
+                finally:
+                    _attempt_timeout.set(None)
+
+            pending[_hedge_executor.submit(run)] = model
+            return model, started
+
+        latest = None  # (model, started) of the newest attempt
+        for model in routed:
+            latest = submit(model)
+            break
+
+        while pending:
+            last_model, started = latest
+            if not started.done():
+                # Still waiting for a pool thread: the hedge timer hasn't started
+                done, _ = wait(list(pending) + [started], return_when=FIRST_COMPLETED)
+                done.discard(started)
+            else:
+                running_for = time.monotonic() - started.result()
+                timeout = max(0.0, self.hedge_delay(last_model) - running_for)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    model = next(routed, None)
+                    if model is None:
+                        # Nothing left to hedge with: just wait for what is running
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    else:
+                        print(f"Hedging: {last_model} is slow, also trying {model}")
+                        latest = submit(model)
+                        continue
+
+            for future in done:
+                model = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if on_error:
+                        on_error(model, e)
+                    continue
+                for other in pending:
+                    other.cancel()
+                return model, result
+
+            # Every finished attempt failed; move on to the next model straight away
+            if done and not pending:
+                model = next(routed, None)
+                if model is not None:
+                    latest = submit(model)
+        return None, None
+
+    async def afirst_success(self, models, attempt, tokens=0, hedge=False, on_error=None):
+        """
+        Async version of first_success; attempt(model) returns an awaitable and losing attempts are cancelled
+        """
+        routed = self.route(models, tokens)
+        if not hedge:
+            for model in routed:
+                try:
+                    return model, await attempt(model)
+                except Exception as e:
+                    if on_error:
+                        on_error(model, e)
+            return None, None
+
+        pending = {}  # task -> model
+        last_model = None
+        try:
+            for model in routed:
+                pending[asyncio.ensure_future(attempt(model))] = last_model = model
+                break
+
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay(last_model), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    model = next(routed, None)
+                    if model is None:
+                        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        print(f"Hedging: {last_model} is slow, also trying {model}")
+                        pending[asyncio.ensure_future(attempt(model))] = last_model = model
+                        continue
+
+                for task in done:
+                    model = pending.pop(task)
+                    try:
+                        return model, task.result()
+                    except Exception as e:
+                        if on_error:
+                            on_error(model, e)
+
+                if not pending:
+                    model = next(routed, None)
+                    if model is not None:
+                        pending[asyncio.ensure_future(attempt(model))] = last_model = model
+            return None, None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            now = self.clock()
+            return {
+                model: {
+                    "circuit": state.circuit(now),
+                    "blocked_for": round(max(0.0, state.blocked_until - now), 1),
+                    "consecutive_failures": state.failures,
+                    **state.counts,
+                    "latency_samples": len(state.latency),
+                    "latency_p50": state.latency.percentile(50),
+                    "latency_p95": state.latency.percentile(95),
+                    "latency_p99": state.latency.percentile(99)
+                }
+                for model, state in self._states.items()
+            }
+
+
+def _used_tokens(response):
+    try:
+        return response['usage']['total_tokens']
+    except (KeyError, TypeError):
+        return None
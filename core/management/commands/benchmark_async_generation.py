@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+
+from core import utils
+from core.llm_client import OpenAIClient, PooledHTTPClient, StubLLMClient
+from core.llm_scheduler import LLMScheduler
+from core.models import UploadedPDF
+
+
+def _stub_handler(latency):
+    """
+    OpenAI-compatible /chat/completions handler answering like StubLLMClient after a fixed delay
+    """
+    stub = StubLLMClient()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps connections open, so keep-alive clients can reuse them
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(latency)
+            payload = json.dumps(stub.chat(body["model"], body["messages"], body.get("temperature"), body.get("max_tokens"))).encode()
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    """
+    Compare request throughput of the sync (WSGI-style) and async (ASGI) quiz generation endpoints
+    python manage.py benchmark_async_generation [--requests 40] [--workers 8] [--latency 0.5] [--backend stub]
+
+    Runs in-process against a throwaway test database, so no API key is needed. --backend stub answers
+    from StubLLMClient directly; openai and pooled send real HTTP requests to a local stub server.
+    """
+    help = "Benchmark sync thread-pool vs async event-loop serving of LLM-bound quiz generation"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=40, help="Concurrent generation requests per mode")
+        parser.add_argument('--workers', type=int, default=8, help="Worker threads for the sync run (WSGI workers)")
+        parser.add_argument('--latency', type=float, default=0.5, help="Seconds the stub LLM takes per completion")
+        parser.add_argument('--questions', type=int, default=5, help="Questions requested per quiz")
+        parser.add_argument('--backend', choices=['stub', 'openai', 'pooled'], default='stub', help="LLM client to benchmark through")
+
+    def handle(self, *args, **options):
+        server = None
+        if options['backend'] == 'stub':
+            client = StubLLMClient(latency=options['latency'])
+        else:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), _stub_handler(options['latency']))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            client_class = OpenAIClient if options['backend'] == 'openai' else PooledHTTPClient
+            client = client_class(api_key="benchmark", api_base=f"http://127.0.0.1:{server.server_port}")
+
+        saved = (utils.llm_client, utils.llm_cache.backend, utils.llm_scheduler)
+        utils.llm_client = client
+        # Every request must reach the stub, otherwise the second mode is served from cache
+        utils.llm_cache.backend = None
+        # The stub has no rate limits, so the scheduler's per-model budgets shouldn't throttle the run
+        utils.llm_scheduler = LLMScheduler(limits=lambda model: {"rpm": 10 ** 6, "tpm": 10 ** 9})
+
+        # A file-backed test database lets concurrent requests wait on SQLite's write lock instead of failing
+        db_dir = tempfile.mkdtemp()
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(db_dir, 'benchmark.sqlite3')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self._run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            os.rmdir(db_dir)
+            utils.llm_client, utils.llm_cache.backend, utils.llm_scheduler = saved
+            client.close()
+            if server:
+                server.shutdown()
+                server.server_close()
+
+    def _run(self, options):
+        user = User.objects.create_user(username='benchmark', password='benchmark')
+        token = Token.objects.create(user=user)
+        pdf = UploadedPDF.objects.create(
+            user=user, title="Benchmark", pdf_file="pdfs/benchmark.pdf", is_public=True
+        )
+        pdf.set_pages(["Benchmark source text for quiz generation. " * 20])
+
+        headers = {'Authorization': f"Token {token.key}"}
+        body = {'num_questions': options['questions']}
+        # The sync endpoint queues by default; wait=true keeps generation inside the request for comparison
+        sync_body = dict(body, wait=True)
+        n = options['requests']
+
+        def sync_request(_):
+            response = Client().post(f'/api/generate-quiz/{pdf.id}/', sync_body, content_type='application/json', headers=headers)
+            return response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            sync_codes = list(executor.map(sync_request, range(n)))
+        sync_elapsed = time.perf_counter() - start
+
+        async def async_run():
+            client = AsyncClient()
+            responses = await asyncio.gather(*[
+                client.post(f'/api/async/generate-quiz/{pdf.id}/', body, content_type='application/json', headers=headers)
+                for _ in range(n)
+            ])
+            await utils.llm_client.aclose()
+            return [response.status_code for response in responses]
+
+        start = time.perf_counter()
+        async_codes = asyncio.run(async_run())
+        async_elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"{'mode':<28} {'requests':>9} {'ok':>5} {'seconds':>9} {'req/s':>8}")
+        for label, codes, elapsed in [
+            (f"sync ({options['workers']} threads)", sync_codes, sync_elapsed),
+            ("async (event loop)", async_codes, async_elapsed),
+        ]:
+            ok = sum(1 for code in codes if code == 200)
+            self.stdout.write(f"{label:<28} {n:>9} {ok:>5} {elapsed:>9.2f} {n / elapsed:>8.1f}")
+        self.stdout.write(f"Async speedup: {sync_elapsed / async_elapsed:.2f}x")
+
+        client_stats = utils.llm_client.stats()
+        if client_stats:
+            self.stdout.write(f"{options['backend']} client: " + ", ".join(f"{key}={value}" for key, value in client_stats.items()))
@@ -0,0 +1,66 @@
+import time
+from pathlib import Path
+
+import fitz  # PyMuPDF
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.utils import extract_text_from_pdf
+
+
+class Command(BaseCommand):
+    """
+    Compare serial and process-pool PDF text extraction
+    python manage.py benchmark_pdf_extraction [--workers 4] [--repeat 3] [paths ...]
+    """
+    help = "Benchmark serial vs parallel PDF text extraction on the PDFs in media/pdfs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="PDF files to benchmark (default: every PDF in MEDIA_ROOT/pdfs)")
+        parser.add_argument('--workers', type=int, default=4, help="Process pool size for the parallel run")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per mode; the best time is reported")
+
+    def handle(self, *args, **options):
+        paths = [Path(p) for p in options['paths']] or sorted((Path(settings.MEDIA_ROOT) / 'pdfs').glob('*.pdf'))
+        if not paths:
+            self.stdout.write("No PDFs found")
+            return
+
+        self.stdout.write(f"{'file':<45} {'pages':>6} {'serial ms':>10} {'parallel ms':>12} {'pages/s':>9} {'speedup':>8}")
+        total_pages = total_serial = total_parallel = 0
+
+        for path in paths:
+            with fitz.open(path) as doc:
+                pages = doc.page_count
+
+            # min_parallel_pages=1 forces the pool so both modes are measured on every file
+            serial_text, serial = self._best_time(lambda: extract_text_from_pdf(str(path), max_workers=1), options['repeat'])
+            parallel_text, parallel = self._best_time(
+                lambda: extract_text_from_pdf(str(path), max_workers=options['workers'], min_parallel_pages=1),
+                options['repeat']
+            )
+            if serial_text != parallel_text:
+                self.stderr.write(f"Text mismatch for {path.name}")
+
+            total_pages += pages
+            total_serial += serial
+            total_parallel += parallel
+            self.stdout.write(
+                f"{path.name[:45]:<45} {pages:>6} {serial * 1000:>10.1f} {parallel * 1000:>12.1f} "
+                f"{pages / parallel:>9.0f} {serial / parallel:>7.2f}x"
+            )
+
+        self.stdout.write(
+            f"{'TOTAL':<45} {total_pages:>6} {total_serial * 1000:>10.1f} {total_parallel * 1000:>12.1f} "
+            f"{total_pages / total_parallel:>9.0f} {total_serial / total_parallel:>7.2f}x"
+        )
+
+    def _best_time(self, func, repeat):
+        best = None
+        result = None
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
@@ -0,0 +1,61 @@
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from core.jobs import claim_next_job, run_generation_job, make_worker_id
+
+
+class Command(BaseCommand):
+    """
+    Process queued quiz generation jobs
+    python manage.py run_generation_worker [--workers 2] [--poll-interval 2] [--once]
+
+    Each worker thread claims one job at a time; a job's chunks are still generated concurrently
+    (MAX_CONCURRENT_BATCHES). Jobs left running by a crashed worker are picked up again once their
+    lease (GENERATION_JOB_LEASE_SECONDS) expires and resume after the last completed chunk.
+    """
+    help = "Run quiz generation workers that process queued GenerationJobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help="Jobs processed in parallel")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty instead of polling")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._work, args=(make_worker_id(str(n)), stop, options), daemon=True)
+            for n in range(max(1, options['workers']))
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Started {len(threads)} generation workers")
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            # Jobs in progress keep their lease and are resumed by the next worker after it expires
+            self.stdout.write("Stopping workers after their current job")
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _work(self, worker_id, stop, options):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim_next_job(worker_id)
+                if job is None:
+                    if options['once']:
+                        break
+                    stop.wait(options['poll_interval'])
+                    continue
+
+                self.stdout.write(f"[{worker_id}] Running job {job.id} (attempt {job.attempts})")
+                run_generation_job(job, worker_id)
+                self.stdout.write(f"[{worker_id}] Job {job.id} {job.status}")
+        finally:
+            connection.close()
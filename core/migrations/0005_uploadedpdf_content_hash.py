@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:20
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_content_hash(apps, schema_editor):
+    UploadedPDF = apps.get_model("core", "UploadedPDF")
+    for pdf in UploadedPDF.objects.filter(content_hash__isnull=True).iterator():
+        if not pdf.pdf_file:
+            continue
+        digest = hashlib.sha256()
+        try:
+            with pdf.pdf_file.open("rb") as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+        except (FileNotFoundError, OSError):
+            continue
+        pdf.content_hash = digest.hexdigest()
+        pdf.save(update_fields=["content_hash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_uploadedpdf_is_public"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadedpdf",
+            name="content_hash",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_content_hash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Legacy rows have no page boundaries, so their text is split into fixed-size sections
+LEGACY_SECTION_CHARS = 4000
+
+
+def move_extracted_text_to_pages(apps, schema_editor):
+    UploadedPDF = apps.get_model("core", "UploadedPDF")
+    PDFPage = apps.get_model("core", "PDFPage")
+    for pdf in UploadedPDF.objects.filter(extracted_text__isnull=False).iterator():
+        text = pdf.extracted_text
+        pages = []
+        for page_number, start in enumerate(range(0, len(text), LEGACY_SECTION_CHARS), start=1):
+            section = text[start:start + LEGACY_SECTION_CHARS]
+            pages.append(PDFPage(
+                pdf=pdf,
+                page_number=page_number,
+                start_offset=start,
+                end_offset=start + len(section),
+                text=section,
+            ))
+        PDFPage.objects.bulk_create(pages)
+        pdf.page_count = len(pages)
+        pdf.save(update_fields=["page_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_uploadedpdf_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadedpdf",
+            name="page_count",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="PDFPage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("page_number", models.IntegerField()),
+                ("start_offset", models.IntegerField()),
+                ("end_offset", models.IntegerField()),
+                ("text", models.TextField(blank=True)),
+                ("pdf", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="core.uploadedpdf")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["pdf", "start_offset"], name="core_pdfpag_pdf_id_4b12fc_idx")],
+                "unique_together": {("pdf", "page_number")},
+            },
+        ),
+        migrations.RunPython(move_extracted_text_to_pages, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="uploadedpdf",
+            name="extracted_text",
+        ),
+    ]
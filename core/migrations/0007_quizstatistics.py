@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_statistics(apps, schema_editor):
+    QuizAttempt = apps.get_model("core", "QuizAttempt")
+    QuizStatistics = apps.get_model("core", "QuizStatistics")
+
+    stats = {}
+    rows = QuizAttempt.objects.values("quiz_id", "score").annotate(n=Count("id")).order_by()
+    for row in rows:
+        quiz_id, score, n = row["quiz_id"], row["score"], row["n"]
+        entry = stats.setdefault(quiz_id, QuizStatistics(quiz_id=quiz_id, histogram={}))
+        entry.attempt_count += n
+        entry.score_sum += score * n
+        entry.score_sq_sum += score * score * n
+        entry.min_score = score if entry.min_score is None else min(entry.min_score, score)
+        entry.max_score = score if entry.max_score is None else max(entry.max_score, score)
+        entry.histogram[str(score)] = n
+
+    QuizStatistics.objects.bulk_create(stats.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0006_pdfpage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuizStatistics",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("attempt_count", models.IntegerField(default=0)),
+                ("score_sum", models.BigIntegerField(default=0)),
+                ("score_sq_sum", models.BigIntegerField(default=0)),
+                ("min_score", models.IntegerField(blank=True, null=True)),
+                ("max_score", models.IntegerField(blank=True, null=True)),
+                ("histogram", models.JSONField(default=dict)),
+                ("quiz", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name="statistics", to="core.quiz")),
+            ],
+        ),
+        migrations.RunPython(backfill_statistics, migrations.RunPython.noop),
+    ]
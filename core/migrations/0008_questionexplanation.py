@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_quizstatistics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuestionExplanation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("context_mode", models.CharField(choices=[("pdf", "With PDF context"), ("none", "Without context")], max_length=10)),
+                ("explanation", models.TextField()),
+                ("key_concepts", models.JSONField(default=list)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("question", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="core.question")),
+            ],
+            options={
+                "unique_together": {("question", "context_mode")},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_generationjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadedpdf",
+            name="text_source",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="text_copies",
+                to="core.uploadedpdf",
+            ),
+        ),
+    ]
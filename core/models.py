@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
 class UploadedPDF(models.Model):
@@ -6,11 +6,83 @@ class UploadedPDF(models.Model):
     title = models.CharField(max_length=200)
     pdf_file = models.FileField(upload_to='pdfs/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    extracted_text = models.TextField(blank=True, null=True)
     is_public = models.BooleanField(default=True)  # Public by default
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)  # SHA-256 of file bytes
+    page_count = models.IntegerField(null=True, blank=True)  # Set once the text has been extracted
+    # A duplicate upload reads the pages of the first copy instead of storing the text again
+    text_source = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='text_copies'
+    )
 
     def __str__(self):
         return f"{self.title} ({'Public' if self.is_public else 'Private'})"
+
+    def pages(self):
+        """
+        PDFPage rows holding this document's text, which a duplicate upload shares with its original
+        """
+        return PDFPage.objects.filter(pdf_id=self.text_source_id or self.id)
+
+    def share_pages(self, source):
+        """
+        Use source's stored pages as this document's text instead of copying them
+        """
+        self.text_source_id = source.text_source_id or source.id
+        self.page_count = source.page_count
+        self.save(update_fields=['text_source', 'page_count'])
+
+    def set_pages(self, page_texts):
+        """
+        Replace the stored text with the given per-page strings, recording character offsets
+        """
+        pages = []
+        offset = 0
+        for page_number, text in enumerate(page_texts, start=1):
+            pages.append(PDFPage(
+                pdf=self,
+                page_number=page_number,
+                start_offset=offset,
+                end_offset=offset + len(text),
+                text=text
+            ))
+            offset += len(text)
+
+        with transaction.atomic():
+            self.pdfpage_set.all().delete()
+            PDFPage.objects.bulk_create(pages)
+            self.page_count = len(pages)
+            self.text_source = None
+            self.save(update_fields=['page_count', 'text_source'])
+
+    def get_text(self, start=0, end=None):
+        """
+        Return the document text between character offsets [start, end), loading only the pages that overlap it
+        """
+        pages = self.pages().filter(end_offset__gt=start)
+        if end is not None:
+            pages = pages.filter(start_offset__lt=end)
+
+        parts = []
+        for page_start, text in pages.order_by('page_number').values_list('start_offset', 'text').iterator():
+            lo = max(start - page_start, 0)
+            hi = len(text) if end is None else min(end - page_start, len(text))
+            parts.append(text[lo:hi])
+        return "".join(parts)
+
+
+class PDFPage(models.Model):
+    pdf = models.ForeignKey(UploadedPDF, on_delete=models.CASCADE)
+    page_number = models.IntegerField()  # 1-based
+    start_offset = models.IntegerField()  # Character offset of this page in the full document text
+    end_offset = models.IntegerField()
+    text = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('pdf', 'page_number')
+        indexes = [models.Index(fields=['pdf', 'start_offset'])]
+
+    def __str__(self):
+        return f"{self.pdf.title} - page {self.page_number}"
     
 class Quiz(models.Model):
     pdf = models.ForeignKey(UploadedPDF, on_delete=models.CASCADE)
@@ -35,6 +107,71 @@ class Option(models.Model):
     def __str__(self):
         return f"{self.text} ({'✓' if self.is_correct else '✗'})"
 
+class GenerationJob(models.Model):
+    """
+    Queued quiz generation request, worked through chunk by chunk by the generation worker
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    pdf = models.ForeignKey(UploadedPDF, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    num_questions = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    quiz = models.ForeignKey(Quiz, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)  # Times a worker has claimed the job
+    locked_by = models.CharField(max_length=100, blank=True)  # Worker currently holding the job
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last progress from that worker
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Job {self.id}: {self.num_questions} questions from {self.pdf.title} ({self.status})"
+
+class GenerationChunk(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+        ('skipped', 'Skipped'),  # Not needed once the requested number of questions was reached
+    ]
+
+    job = models.ForeignKey(GenerationJob, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField()  # Position in the chunk plan, in document order
+    text = models.TextField()
+    questions_requested = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    questions = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = ('job', 'index')
+
+    def __str__(self):
+        return f"Job {self.job_id} chunk {self.index} ({self.status})"
+
+class QuestionExplanation(models.Model):
+    CONTEXT_MODES = [
+        ('pdf', 'With PDF context'),
+        ('none', 'Without context'),
+    ]
+
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    context_mode = models.CharField(max_length=10, choices=CONTEXT_MODES)
+    explanation = models.TextField()
+    key_concepts = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('question', 'context_mode')
+
+    def __str__(self):
+        return f"Explanation for Q{self.question_id} ({self.context_mode})"
+
 class QuizAttempt(models.Model):
     quiz = models.ForeignKey(Quiz, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -54,3 +191,55 @@ class UserAnswer(models.Model):
     def __str__(self):
         return f"Q{self.question.id}: {self.selected_option.text} ({'✓' if self.is_correct else '✗'})"
 
+
+
+class QuizStatistics(models.Model):
+    """
+    Running score statistics for a quiz, updated as each attempt is recorded
+    """
+    quiz = models.OneToOneField(Quiz, on_delete=models.CASCADE, related_name='statistics')
+    attempt_count = models.IntegerField(default=0)
+    score_sum = models.BigIntegerField(default=0)
+    score_sq_sum = models.BigIntegerField(default=0)
+    min_score = models.IntegerField(null=True, blank=True)
+    max_score = models.IntegerField(null=True, blank=True)
+    histogram = models.JSONField(default=dict)  # {"<score>": number of attempts with that score}
+
+    def __str__(self):
+        return f"{self.quiz.title} - {self.attempt_count} attempts"
+
+    def record(self, score):
+        self.attempt_count += 1
+        self.score_sum += score
+        self.score_sq_sum += score * score
+        self.min_score = score if self.min_score is None else min(self.min_score, score)
+        self.max_score = score if self.max_score is None else max(self.max_score, score)
+        self.histogram[str(score)] = self.histogram.get(str(score), 0) + 1
+
+    @property
+    def mean(self):
+        return self.score_sum / self.attempt_count if self.attempt_count else 0
+
+    @property
+    def std_dev(self):
+        if not self.attempt_count:
+            return 0
+        variance = self.score_sq_sum / self.attempt_count - self.mean ** 2
+        return max(variance, 0) ** 0.5
+
+    def count_at_least(self, threshold):
+        return sum(count for score, count in self.histogram.items() if int(score) >= threshold)
+
+    def percentile(self, p):
+        """
+        Nearest-rank percentile (0-100) of the recorded scores
+        """
+        if not self.attempt_count:
+            return 0
+        rank = max(1, -(-p * self.attempt_count // 100))
+        seen = 0
+        for score in sorted(self.histogram, key=int):
+            seen += self.histogram[score]
+            if seen >= rank:
+                return int(score)
+        return self.max_score
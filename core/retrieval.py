@@ -0,0 +1,153 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from .llm_cache import MemoryLRUBackend
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how if in into is it its of on or
+that the their then there these this those to was were what when where which while who why will
+with not no yes all any each other which than such only also may more most some so very
+""".split())
+
+# Passages are smaller than generation chunks so each question pulls in only the text it needs
+PASSAGE_CHARS = 800
+PASSAGE_OVERLAP = 100
+
+# Built indexes, keyed by document content so duplicate uploads share one
+_index_cache = MemoryLRUBackend(max_entries=50)
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def split_into_passages(text, size=PASSAGE_CHARS, overlap=PASSAGE_OVERLAP):
+    """
+    Split text into overlapping passages, preferring to break at whitespace
+    """
+    passages = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + size // 2, end)
+            if space != -1:
+                end = space
+        passage = text[start:end].strip()
+        if len(passage) > 50:
+            passages.append(passage)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return passages
+
+
+class BM25Index:
+    """
+    Okapi BM25 index over a list of passages
+    """
+    def __init__(self, passages, k1=1.5, b=0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)  # term -> [(passage index, term frequency)]
+        self.lengths = []
+
+        for index, passage in enumerate(passages):
+            counts = Counter(tokenize(passage))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings[term].append((index, tf))
+
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        n = len(passages)
+        self.idf = {
+            term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, query, k=3):
+        """
+        Return up to k (passage index, score) pairs for the query, best first
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, tf in self.postings[term]:
+                norm = 1 - self.b + self.b * self.lengths[index] / self.avg_length
+                scores[index] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def get_pdf_index(pdf):
+    """
+    Return the BM25 index for an UploadedPDF, building it from the stored pages on first use
+    """
+    key = pdf.content_hash or f"pdf-{pdf.id}"
+    index = _index_cache.get(key)
+    if index is None:
+        index = BM25Index(split_into_passages(pdf.get_text()))
+        _index_cache.set(key, index)
+    return index
+
+
+def _numbered_length(passage_chars, count):
+    """
+    Length of count numbered passages totalling passage_chars once joined into a context
+    """
+    prefixes = sum(len(f"[Passage {number}] ") for number in range(1, count + 1))
+    return passage_chars + prefixes + 2 * max(0, count - 1)
+
+
+def build_explanation_context(pdf, questions_data, k=3, max_chars=3000):
+    """
+    Select the passages of an UploadedPDF most relevant to each question (see select_passages)
+    """
+    return select_passages(get_pdf_index(pdf), questions_data, k, max_chars)
+
+
+def select_passages(index, questions_data, k=3, max_chars=3000):
+    """
+    Select the passages most relevant to each question for an explanation prompt
+
+    Each question is matched on its text plus its options. The union of the selected passages is
+    returned in document order and numbered; each question dictionary gets a "passage_refs" list
+    naming the passages retrieved for it. Passages are added best-first while the whole context,
+    numbering and separators included, stays within max_chars.
+
+    Only reads the in-memory index, so it is safe to call from worker threads.
+
+    Returns:
+        Context text with numbered passages ("" if nothing relevant was found)
+    """
+    hits = []
+    for q in questions_data:
+        query = " ".join([q["question_text"]] + [opt["text"] for opt in q["options"]])
+        hits.append(index.search(query, k))
+
+    # Spend the character budget on the best-ranked passages first, round-robin across questions
+    selected = set()
+    used = 0
+    for rank in range(k):
+        for question_hits in hits:
+            if rank >= len(question_hits):
+                continue
+            passage_index = question_hits[rank][0]
+            if passage_index in selected:
+                continue
+            length = len(index.passages[passage_index])
+            if _numbered_length(used + length, len(selected) + 1) > max_chars:
+                continue
+            selected.add(passage_index)
+            used += length
+
+    numbers = {passage_index: number for number, passage_index in enumerate(sorted(selected), start=1)}
+    for q, question_hits in zip(questions_data, hits):
+        q["passage_refs"] = [numbers[i] for i, _ in question_hits if i in numbers]
+
+    return "\n\n".join(f"[Passage {numbers[i]}] {index.passages[i]}" for i in sorted(selected))
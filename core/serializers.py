@@ -4,8 +4,8 @@ from .models import UploadedPDF,Quiz, Question, Option
 class UploadedPDFSerializer(serializers.ModelSerializer):
     class Meta:
         model = UploadedPDF
-        fields = '__all__'
-        read_only_fields = ['user', 'uploaded_at', 'extracted_text']
+        exclude = ['text_source']  # May point at another user's private upload
+        read_only_fields = ['user', 'uploaded_at', 'content_hash', 'page_count']
 
 class OptionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -24,4 +24,17 @@ class QuizDetailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Quiz
-        fields = ['id', 'title', 'created_at', 'questions']
\ No newline at end of file
+        fields = ['id', 'title', 'created_at', 'questions']
+
+class QuizSummarySerializer(serializers.ModelSerializer):
+    question_count = serializers.IntegerField(read_only=True)
+    is_public = serializers.BooleanField(read_only=True)
+    is_owner = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Quiz
+        fields = ['id', 'title', 'created_at', 'question_count', 'is_public', 'is_owner']
+
+    def get_is_owner(self, obj):
+        request = self.context.get('request')
+        return bool(request and request.user.is_authenticated and obj.owner_id == request.user.id)
@@ -0,0 +1,492 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from .llm_cache import MemoryLRUBackend
+from .models import Quiz, Question, Option, QuizAttempt, UserAnswer, QuizStatistics, QuestionExplanation
+from .serializers import QuizDetailSerializer
+from .utils import plan_generation, iter_chunks_concurrently
+
+
+class _TieredCache:
+    """
+    Process-local LRU in front of an optional shared Django cache (named by the alias_setting setting)
+
+    Local entries expire after local_ttl seconds, which bounds how stale another worker's copy
+    can get when there is no shared cache. With a shared cache, every key also has a version
+    there that delete() replaces, and a local entry is only used while its version is current,
+    so an invalidation in one process is seen by all of them on their next read.
+    """
+    def __init__(self, alias_setting, max_entries, local_ttl):
+        self.alias_setting = alias_setting
+        self.local = MemoryLRUBackend(max_entries=max_entries)
+        self.local_ttl = local_ttl
+
+    def _shared(self):
+        alias = getattr(settings, self.alias_setting, None)
+        return caches[alias] if alias else None
+
+    def version(self, key):
+        """
+        Current version of key; read it before loading a value so set() can't store data
+        that was invalidated while it loaded
+        """
+        shared = self._shared()
+        if shared is None:
+            return None
+        version_key = f"{key}:version"
+        version = shared.get(version_key)
+        if version is None:
+            shared.add(version_key, uuid.uuid4().hex, timeout=None)
+            version = shared.get(version_key)
+        return version
+
+    def get(self, key):
+        shared = self._shared()
+        entry = self.local.get(key)
+        if shared is None:
+            return entry[1] if entry is not None else None
+
+        version = shared.get(f"{key}:version")
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        entry = shared.get(key)
+        if entry is not None and entry[0] == version:
+            self.local.set(key, entry, self.local_ttl)
+            return entry[1]
+        return None
+
+    def set(self, key, value, version=None):
+        shared = self._shared()
+        if shared is not None and version is None:
+            version = self.version(key)
+        entry = (version, value)
+        self.local.set(key, entry, self.local_ttl)
+        if shared is not None:
+            shared.set(key, entry, timeout=None)
+
+    def delete(self, key):
+        self.local.delete(key)
+        shared = self._shared()
+        if shared is not None:
+            shared.set(f"{key}:version", uuid.uuid4().hex, timeout=None)
+            shared.delete(key)
+
+
+# Answer keys are cached per process; ANSWER_KEY_CACHE_ALIAS optionally names a shared Django cache behind it
+_answer_key_cache = _TieredCache(
+    'ANSWER_KEY_CACHE_ALIAS',
+    max_entries=getattr(settings, 'ANSWER_KEY_CACHE_SIZE', 500),
+    local_ttl=getattr(settings, 'ANSWER_KEY_LOCAL_TTL', 30)
+)
+
+# Rendered quiz detail JSON (bytes, etag), shared the same way through QUIZ_PAYLOAD_CACHE_ALIAS
+_quiz_payload_cache = _TieredCache(
+    'QUIZ_PAYLOAD_CACHE_ALIAS',
+    max_entries=getattr(settings, 'QUIZ_PAYLOAD_CACHE_SIZE', 200),
+    local_ttl=getattr(settings, 'QUIZ_PAYLOAD_LOCAL_TTL', 30)
+)
+
+
+class GradingError(Exception):
+    """
+    Raised when a submission references questions or options that don't belong to the quiz
+    """
+
+
+def create_quiz_with_questions(pdf, title, questions):
+    """
+    Persist a quiz with its questions and options in a single transaction using bulk inserts
+
+    Args:
+        pdf: UploadedPDF the quiz was generated from
+        title: Quiz title
+        questions: List of generated question dictionaries:
+            {"question": "...", "options": {"a": "...", ...}, "answer": "a"}
+
+    Returns:
+        Dictionary with the created "quiz" plus "question_ids" and "option_ids"
+        (one list of option IDs per question), in the order of `questions`
+    """
+    with transaction.atomic():
+        quiz = Quiz.objects.create(pdf=pdf, title=title)
+        added = add_questions_to_quiz(quiz, questions)
+
+    # The answer key is already known here, so grading never has to read it back
+    cache_answer_key(quiz.id, added["answer_key"])
+
+    return {
+        "quiz": quiz,
+        "question_ids": added["question_ids"],
+        "option_ids": added["option_ids"]
+    }
+
+
+def add_questions_to_quiz(quiz, questions):
+    """
+    Bulk insert generated questions and their options into an existing quiz
+
+    Returns:
+        Dictionary with "question_ids", "option_ids" (one list per question) and the
+        "answer_key" entries for the new questions, in the order of `questions`
+    """
+    # No savepoint when nested: a failure here rolls back the caller's transaction anyway
+    with transaction.atomic(savepoint=False):
+        question_objs = Question.objects.bulk_create([
+            Question(quiz=quiz, text=q["question"]) for q in questions
+        ])
+
+        option_objs = []
+        options_per_question = []
+        for ques, q in zip(question_objs, questions):
+            options_per_question.append(len(q["options"]))
+            for key, value in q["options"].items():
+                option_objs.append(Option(
+                    question=ques,
+                    text=value,
+                    is_correct=(key == q["answer"])
+                ))
+        option_objs = Option.objects.bulk_create(option_objs)
+
+    option_ids = []
+    answer_key = {}
+    position = 0
+    for ques, count in zip(question_objs, options_per_question):
+        options = option_objs[position:position + count]
+        option_ids.append([opt.id for opt in options])
+        correct = [opt.id for opt in options if opt.is_correct]
+        answer_key[ques.id] = {
+            "text": ques.text,
+            "options": {opt.id: opt.text for opt in options},
+            "correct_option_id": correct[0] if correct else None
+        }
+        position += count
+
+    return {
+        "question_ids": [ques.id for ques in question_objs],
+        "option_ids": option_ids,
+        "answer_key": answer_key
+    }
+
+
+def stream_quiz_generation(pdf, num_questions):
+    """
+    Generate a quiz chunk by chunk, persisting each chunk's questions as soon as they are parsed
+
+    Yields (event, data) pairs:
+        "start": the number of chunks planned
+        "questions": one per chunk that produced questions, in completion order, shaped like
+            the quiz detail payload ({"id", "text", "options": [{"id", "text", "is_correct"}]})
+        "chunk_failed": a chunk that every model failed on
+        "complete": final summary with the quiz ID and counts
+        "error": no questions could be generated at all
+    """
+    plan = plan_generation(pdf.get_text(), num_questions)
+    yield "start", {"requested_questions": num_questions, "chunks_planned": len(plan)}
+
+    quiz = None
+    answer_key = {}
+    try:
+        for index, chunk_questions in iter_chunks_concurrently(plan, num_questions):
+            if not chunk_questions:
+                yield "chunk_failed", {"chunk": index}
+                continue
+
+            chunk_questions = chunk_questions[:num_questions - len(answer_key)]
+            if not chunk_questions:
+                continue
+
+            # The quiz is only created once there is something to put in it
+            if quiz is None:
+                quiz = Quiz.objects.create(pdf=pdf, title=f"Quiz from {pdf.title} (generating)")
+            added = add_questions_to_quiz(quiz, chunk_questions)
+            answer_key.update(added["answer_key"])
+
+            yield "questions", {
+                "quiz_id": quiz.id,
+                "chunk": index,
+                "questions": [{
+                    "id": question_id,
+                    "text": added["answer_key"][question_id]["text"],
+                    "options": [{
+                        "id": option_id,
+                        "text": text,
+                        "is_correct": option_id == added["answer_key"][question_id]["correct_option_id"]
+                    } for option_id, text in added["answer_key"][question_id]["options"].items()]
+                } for question_id in added["question_ids"]],
+                "questions_generated": len(answer_key)
+            }
+    finally:
+        # Runs even if the client disconnects mid-stream, so the quiz keeps what was generated so far
+        if quiz is not None:
+            quiz.title = f"Quiz from {pdf.title} ({len(answer_key)} questions)"
+            quiz.save(update_fields=['title'])
+            cache_answer_key(quiz.id, answer_key)
+
+    if quiz is None:
+        yield "error", {"error": "Failed to generate questions. Please try again or use a different PDF."}
+        return
+
+    yield "complete", {
+        "quiz_id": quiz.id,
+        "message": f"Quiz with {len(answer_key)} questions generated successfully",
+        "requested_questions": num_questions,
+        "questions_generated": len(answer_key)
+    }
+
+
+def load_answer_key(quiz_id):
+    """
+    Load a quiz's answer key from the database in two queries
+
+    Returns:
+        Dictionary of question_id -> {"text", "options": {option_id: text}, "correct_option_id"}
+    """
+    answer_key = {
+        question_id: {"text": text, "options": {}, "correct_option_id": None}
+        for question_id, text in Question.objects.filter(quiz_id=quiz_id).values_list('id', 'text')
+    }
+    options = Option.objects.filter(question__quiz_id=quiz_id).order_by('id').values_list(
+        'id', 'question_id', 'text', 'is_correct'
+    )
+    for option_id, question_id, text, is_correct in options:
+        entry = answer_key[question_id]
+        entry["options"][option_id] = text
+        if is_correct and entry["correct_option_id"] is None:
+            entry["correct_option_id"] = option_id
+    return answer_key
+
+
+def _answer_key_cache_key(quiz_id):
+    return f"answer-key:{quiz_id}"
+
+
+def cache_answer_key(quiz_id, answer_key):
+    """
+    Store an answer key in the process-local cache and, if configured, the shared cache
+    """
+    _answer_key_cache.set(_answer_key_cache_key(quiz_id), answer_key)
+
+
+def get_answer_key(quiz_id):
+    """
+    Return a quiz's answer key (see load_answer_key), loading it from the database only on a cache miss
+
+    The returned dictionary is shared between requests and must not be modified.
+    """
+    key = _answer_key_cache_key(quiz_id)
+    answer_key = _answer_key_cache.get(key)
+    if answer_key is not None:
+        return answer_key
+
+    version = _answer_key_cache.version(key)
+    answer_key = load_answer_key(quiz_id)
+    _answer_key_cache.set(key, answer_key, version)
+    return answer_key
+
+
+def invalidate_answer_key(quiz_id):
+    """
+    Drop a quiz's cached answer key after its questions or options change, in every process
+    """
+    _answer_key_cache.delete(_answer_key_cache_key(quiz_id))
+
+
+def get_quiz_payload(quiz_id):
+    """
+    Return the rendered quiz detail JSON and its strong ETag, serializing the quiz only on a cache miss
+
+    Returns:
+        (payload_bytes, etag) tuple, or None if the quiz doesn't exist
+    """
+    key = f"quiz-payload:{quiz_id}"
+    cached = _quiz_payload_cache.get(key)
+    if cached is not None:
+        return cached
+
+    version = _quiz_payload_cache.version(key)
+    try:
+        quiz = Quiz.objects.prefetch_related('question_set__option_set').get(id=quiz_id)
+    except Quiz.DoesNotExist:
+        return None
+
+    payload = JSONRenderer().render(QuizDetailSerializer(quiz).data)
+    cached = (payload, f'"{hashlib.sha256(payload).hexdigest()}"')
+    _quiz_payload_cache.set(key, cached, version)
+    return cached
+
+
+def invalidate_quiz_payload(quiz_id):
+    """
+    Drop a quiz's rendered detail payload after the quiz, its questions or options change, in every process
+    """
+    _quiz_payload_cache.delete(f"quiz-payload:{quiz_id}")
+
+
+def record_attempt_statistics(quiz_id, score):
+    """
+    Fold one attempt's score into the quiz's running statistics (call inside the attempt's transaction)
+    """
+    QuizStatistics.objects.get_or_create(quiz_id=quiz_id)
+    stats = QuizStatistics.objects.select_for_update().get(quiz_id=quiz_id)
+    stats.record(score)
+    stats.save()
+
+
+def grade_submission(quiz, user, answers):
+    """
+    Grade a quiz submission against its answer key and record the attempt
+
+    All answers are validated and scored in memory before anything is written, then the
+    attempt and its UserAnswer rows are inserted in one transaction, so the number of
+    queries does not depend on the number of answers.
+
+    Args:
+        quiz: Quiz being submitted
+        user: Submitting user, or None for anonymous attempts
+        answers: List of {"question_id": ..., "option_id": ...} dictionaries
+
+    Returns:
+        Dictionary with the created "attempt", "score", "total_questions" and per-answer "results"
+
+    Raises:
+        GradingError: If an answer references a question or option outside this quiz
+    """
+    answer_key = get_answer_key(quiz.id)
+
+    graded = []
+    for answer_data in answers:
+        if not isinstance(answer_data, dict):
+            raise GradingError("Each answer must be an object with question_id and option_id")
+
+        question_id = answer_data.get('question_id')
+        option_id = answer_data.get('option_id')
+
+        try:
+            entry = answer_key[int(question_id)]
+        except (KeyError, TypeError, ValueError):
+            raise GradingError(f"Question with id {question_id} not found in this quiz")
+
+        try:
+            option_id = int(option_id)
+            selected_text = entry["options"][option_id]
+        except (KeyError, TypeError, ValueError):
+            raise GradingError(f"Option with id {option_id} not found for question {question_id}")
+
+        graded.append((int(question_id), option_id, selected_text, option_id == entry["correct_option_id"]))
+
+    score = sum(1 for *_, is_correct in graded if is_correct)
+    total_questions = len(answer_key)
+
+    with transaction.atomic():
+        attempt = QuizAttempt.objects.create(
+            quiz=quiz,
+            user=user,
+            score=score,
+            total_questions=total_questions
+        )
+        record_attempt_statistics(quiz.id, score)
+        UserAnswer.objects.bulk_create([
+            UserAnswer(
+                attempt=attempt,
+                question_id=question_id,
+                selected_option_id=option_id,
+                is_correct=is_correct
+            )
+            for question_id, option_id, _, is_correct in graded
+        ])
+
+    results = []
+    for question_id, option_id, selected_text, is_correct in graded:
+        entry = answer_key[question_id]
+        results.append({
+            "question_id": question_id,
+            "question_text": entry["text"],
+            "selected_option": selected_text,
+            "correct_option": entry["options"].get(entry["correct_option_id"]),
+            "is_correct": is_correct
+        })
+
+    return {
+        "attempt": attempt,
+        "score": score,
+        "total_questions": total_questions,
+        "results": results
+    }
+
+
+def build_explanation_questions(answer_key, question_ids):
+    """
+    Build the question dictionaries generate_answer_explanations expects, once per distinct ID
+    """
+    questions_data = []
+    for question_id in dict.fromkeys(question_ids):
+        entry = answer_key[question_id]
+        correct_option_id = entry["correct_option_id"]
+
+        questions_data.append({
+            "question_id": question_id,
+            "question_text": entry["text"],
+            "options": [
+                {"text": text, "is_correct": option_id == correct_option_id}
+                for option_id, text in entry["options"].items()
+            ],
+            "correct_answer": entry["options"].get(correct_option_id, "N/A")
+        })
+    return questions_data
+
+
+def load_stored_explanations(question_ids, context_mode):
+    """
+    Return stored explanations for the given questions as question_id -> explanation dictionary
+    """
+    rows = QuestionExplanation.objects.filter(question_id__in=question_ids, context_mode=context_mode)
+    return {
+        row.question_id: {
+            "question_id": row.question_id,
+            "explanation": row.explanation,
+            "key_concepts": row.key_concepts
+        }
+        for row in rows
+    }
+
+
+def store_explanations(explanations, question_ids, context_mode):
+    """
+    Persist freshly generated explanations for the requested questions
+
+    Canned fallbacks (marked "fallback") and entries for questions that weren't requested are
+    returned but not stored, so the next request tries the AI again for those questions.
+
+    Returns:
+        Dictionary of question_id -> explanation dictionary for every requested question that was explained
+    """
+    requested = set(question_ids)
+    results = {}
+    rows = []
+    for exp in explanations:
+        fallback = exp.pop("fallback", False)
+        try:
+            question_id = int(exp.get("question_id"))
+        except (TypeError, ValueError):
+            continue
+        if question_id not in requested or question_id in results:
+            continue
+
+        exp["question_id"] = question_id
+        results[question_id] = exp
+        if not fallback:
+            rows.append(QuestionExplanation(
+                question_id=question_id,
+                context_mode=context_mode,
+                explanation=exp.get("explanation", ""),
+                key_concepts=exp.get("key_concepts", [])
+            ))
+
+    # A concurrent request may have stored the same question first; keep whichever landed
+    QuestionExplanation.objects.bulk_create(rows, ignore_conflicts=True)
+    return results
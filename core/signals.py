@@ -0,0 +1,46 @@
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from .models import UploadedPDF, PDFPage, Quiz, Question, Option, QuestionExplanation
+from .services import invalidate_answer_key, invalidate_quiz_payload
+
+
+def invalidate_quiz_caches(quiz_id):
+    invalidate_answer_key(quiz_id)
+    invalidate_quiz_payload(quiz_id)
+
+
+@receiver([post_save, post_delete], sender=Quiz)
+def invalidate_quiz(sender, instance, **kwargs):
+    invalidate_quiz_caches(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_question(sender, instance, **kwargs):
+    invalidate_quiz_caches(instance.quiz_id)
+
+
+@receiver(post_save, sender=Question)
+@receiver([post_save, post_delete], sender=Option)
+def discard_stale_explanations(sender, instance, **kwargs):
+    question_id = instance.id if sender is Question else instance.question_id
+    QuestionExplanation.objects.filter(question_id=question_id).delete()
+
+
+@receiver([post_save, post_delete], sender=Option)
+def invalidate_option(sender, instance, **kwargs):
+    # The question may already be gone when options are deleted by cascade
+    quiz_id = Question.objects.filter(id=instance.question_id).values_list('quiz_id', flat=True).first()
+    if quiz_id is not None:
+        invalidate_quiz_caches(quiz_id)
+
+
+@receiver(pre_delete, sender=UploadedPDF)
+def hand_over_shared_pages(sender, instance, **kwargs):
+    # Duplicate uploads read this document's pages; the oldest of them takes the pages over
+    heir = instance.text_copies.order_by('uploaded_at', 'id').first()
+    if heir is None:
+        return
+    PDFPage.objects.filter(pdf=instance).update(pdf=heir)
+    instance.text_copies.exclude(id=heir.id).update(text_source=heir)
+    UploadedPDF.objects.filter(id=heir.id).update(text_source=None)
@@ -1,3 +1,1531 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import fitz
+import openai
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from . import retrieval, services, utils
+from .llm_cache import LLMResponseCache, MemoryLRUBackend, SQLiteBackend, build_cache_from_env
+from .jobs import (
+    enqueue_generation_job, claim_next_job, run_generation_job, run_generation_job_now, JobLeaseLost, LeaseKeeper
+)
+from .llm_client import PooledHTTPClient, StubLLMClient, _parse_http_response
+from .llm_scheduler import (
+    LLMScheduler, LatencyHistogram, CircuitOpenError, attempt_timeout, LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN,
+    LLM_HEDGE_ATTEMPT_TIMEOUT, LLM_HEDGE_DEFAULT_DELAY
+)
+from .models import (
+    UploadedPDF, PDFPage, Quiz, Question, Option, QuizAttempt, UserAnswer, QuestionExplanation, GenerationJob, GenerationChunk
+)
+from .services import create_quiz_with_questions, grade_submission, get_answer_key, GradingError
+from .token_budget import (
+    count_tokens, max_questions_per_request, mcq_output_tokens, MCQ_CHUNK_MAX_TOKENS, MCQ_MIN_QUESTIONS_PER_CHUNK
+)
+from .utils import (
+    salvage_questions, generate_single_batch_mcqs, agenerate_mcqs_from_text, plan_chunks, plan_generation, build_mcq_request,
+    build_explanation_request, is_valid_question, allocate_questions, plan_explanation_groups,
+    generate_answer_explanations, parse_explanation_response, EXPLANATION_MAX_TOKENS, EXPLANATION_GROUP_TOKENS,
+    EXPLANATION_TOKENS_PER_QUESTION
+)
+
+
+def make_questions(count):
+    return [{
+        "question": f"Question {i}?",
+        "options": {"a": f"A{i}", "b": f"B{i}", "c": f"C{i}", "d": f"D{i}"},
+        "answer": "b"
+    } for i in range(count)]
+
+
+class CreateQuizWithQuestionsTests(TestCase):
+    def setUp(self):
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+
+    def test_persists_quiz_questions_and_options(self):
+        created = create_quiz_with_questions(self.pdf, "Quiz", make_questions(3))
+
+        quiz = created["quiz"]
+        self.assertEqual(Quiz.objects.get(id=quiz.id).title, "Quiz")
+        self.assertEqual(len(created["question_ids"]), 3)
+        self.assertEqual(
+            list(Question.objects.filter(quiz=quiz).order_by('id').values_list('id', flat=True)),
+            created["question_ids"]
+        )
+        for question_id, option_ids in zip(created["question_ids"], created["option_ids"]):
+            options = Option.objects.filter(question_id=question_id).order_by('id')
+            self.assertEqual(list(options.values_list('id', flat=True)), option_ids)
+            self.assertEqual([opt.text[0] for opt in options if opt.is_correct], ["B"])
+
+    def test_query_count_is_independent_of_question_count(self):
+        with CaptureQueriesContext(connection) as small:
+            create_quiz_with_questions(self.pdf, "Small", make_questions(2))
+        with CaptureQueriesContext(connection) as large:
+            create_quiz_with_questions(self.pdf, "Large", make_questions(50))
+
+        self.assertEqual(len(small), len(large))
+        self.assertLessEqual(len(large), 6)
+
+
+class GradeSubmissionTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.small = create_quiz_with_questions(pdf, "Small", make_questions(2))
+        self.large = create_quiz_with_questions(pdf, "Large", make_questions(40))
+
+    def answers_for(self, created, correct_every=2):
+        # Option index 1 ("b") is correct; answer "a" for every other question
+        return [{
+            "question_id": question_id,
+            "option_id": option_ids[1] if i % correct_every == 0 else option_ids[0]
+        } for i, (question_id, option_ids) in enumerate(zip(created["question_ids"], created["option_ids"]))]
+
+    def test_scores_and_records_answers(self):
+        graded = grade_submission(self.large["quiz"], None, self.answers_for(self.large))
+
+        self.assertEqual(graded["score"], 20)
+        self.assertEqual(graded["total_questions"], 40)
+        self.assertEqual(graded["attempt"].score, 20)
+        self.assertEqual(UserAnswer.objects.filter(attempt=graded["attempt"]).count(), 40)
+        self.assertEqual(UserAnswer.objects.filter(attempt=graded["attempt"], is_correct=True).count(), 20)
+        self.assertEqual(graded["results"][1]["selected_option"], "A1")
+        self.assertEqual(graded["results"][1]["correct_option"], "B1")
+
+    def test_rejects_option_from_another_question_without_writing(self):
+        answers = self.answers_for(self.small)
+        answers[0]["option_id"] = self.small["option_ids"][1][0]
+
+        with self.assertRaises(GradingError):
+            grade_submission(self.small["quiz"], None, answers)
+        self.assertFalse(QuizAttempt.objects.exists())
+
+    def test_updates_quiz_statistics(self):
+        grade_submission(self.large["quiz"], None, self.answers_for(self.large))
+        grade_submission(self.large["quiz"], None, self.answers_for(self.large, correct_every=1))
+
+        response = self.client.get(f"/api/quiz/{self.large['quiz'].id}/analytics/")
+        data = response.json()
+        self.assertEqual(data["total_attempts"], 2)
+        self.assertEqual(data["average_score"], 30.0)
+        self.assertEqual(data["std_dev"], 10.0)
+        self.assertEqual((data["lowest_score"], data["highest_score"]), (20, 40))
+        self.assertEqual(data["pass_rate"], 50.0)
+        self.assertEqual(data["score_distribution"], {"20": 1, "40": 1})
+
+    def test_query_count_is_independent_of_answer_count(self):
+        with CaptureQueriesContext(connection) as small:
+            grade_submission(self.small["quiz"], None, self.answers_for(self.small))
+        with CaptureQueriesContext(connection) as large:
+            grade_submission(self.large["quiz"], None, self.answers_for(self.large))
+
+        self.assertEqual(len(small), len(large))
+
+
+class QuizItemAnalysisTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(3))
+        self.url = f"/api/quiz/{self.created['quiz'].id}/item-analysis/"
+
+    def submit(self, *choices):
+        # One option index per question ("b", index 1, is correct); None leaves the question unanswered
+        grade_submission(self.created["quiz"], None, [
+            {"question_id": question_id, "option_id": option_ids[choice]}
+            for question_id, option_ids, choice in zip(self.created["question_ids"], self.created["option_ids"], choices)
+            if choice is not None
+        ])
+
+    def analysis(self):
+        return self.client.get(self.url).json()
+
+    def test_difficulty_discrimination_and_distractors(self):
+        self.submit(1, 0, 0)
+        self.submit(1, 1, 0)
+        self.submit(1, 1, 1)
+
+        data = self.analysis()
+        first, second, third = data["questions"]
+        self.assertEqual(data["total_attempts"], 3)
+        self.assertEqual(first["difficulty_index"], 1.0)
+        self.assertIsNone(first["discrimination_index"])  # Every attempt got it right
+        self.assertAlmostEqual(second["difficulty_index"], 0.667)
+        self.assertAlmostEqual(second["discrimination_index"], 0.866)
+        self.assertAlmostEqual(third["difficulty_index"], 0.333)
+        self.assertEqual([opt["count"] for opt in second["options"]], [1, 2, 0, 0])
+        self.assertEqual([opt["frequency"] for opt in second["options"]], [0.333, 0.667, 0.0, 0.0])
+
+    def test_zero_variance_items_have_no_discrimination(self):
+        # Every attempt has the same total score, so no item can discriminate
+        self.submit(1, 0, 0)
+        self.submit(0, 1, 0)
+        self.submit(0, 0, 1)
+
+        for question in self.analysis()["questions"]:
+            self.assertAlmostEqual(question["difficulty_index"], 0.333)
+            self.assertIsNone(question["discrimination_index"])
+
+    def test_single_attempt(self):
+        self.submit(1, 2, 1)
+
+        data = self.analysis()
+        self.assertEqual(data["total_attempts"], 1)
+        self.assertEqual([q["difficulty_index"] for q in data["questions"]], [1.0, 0.0, 1.0])
+        self.assertTrue(all(q["discrimination_index"] is None for q in data["questions"]))
+        self.assertEqual([opt["frequency"] for opt in data["questions"][1]["options"]], [0.0, 0.0, 1.0, 0.0])
+
+    def test_unanswered_questions_count_as_wrong_but_not_as_responses(self):
+        self.submit(1, 1, None)
+        self.submit(1, None, None)
+
+        second, third = self.analysis()["questions"][1:]
+        self.assertEqual((second["responses"], second["difficulty_index"]), (1, 0.5))
+        self.assertEqual(sum(opt["count"] for opt in second["options"]), 1)
+        self.assertEqual((third["responses"], third["difficulty_index"]), (0, 0.0))
+        self.assertEqual(sum(opt["count"] for opt in third["options"]), 0)
+
+    def test_quiz_without_attempts(self):
+        data = self.analysis()
+        self.assertEqual(data["total_attempts"], 0)
+        for question in data["questions"]:
+            self.assertIsNone(question["difficulty_index"])
+            self.assertIsNone(question["discrimination_index"])
+            self.assertEqual(question["responses"], 0)
+
+
+class PDFUploadDedupTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_patcher = override_settings(MEDIA_ROOT=media.name)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.user = User.objects.create_user(username="uploader", password="pass")
+        self.client.force_login(self.user)
+
+    def upload(self, title, is_public="true"):
+        pdf_file = SimpleUploadedFile("notes.pdf", b"%PDF-1.4 same bytes", content_type="application/pdf")
+        return self.client.post("/api/upload-pdf/", {"pdf_file": pdf_file, "title": title, "is_public": is_public})
+
+    def test_identical_upload_shares_extracted_pages(self):
+        pages = ["Page one text.", "Page two text."]
+        with mock.patch('core.views.extract_pages_from_pdf', return_value=pages) as extract:
+            first = self.upload("First")
+            second = self.upload("Second")
+            third = self.upload("Third")
+
+        extract.assert_called_once()
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json()["duplicate_of"], first.json()["id"])
+        self.assertNotIn("text_source", second.json())
+
+        original = UploadedPDF.objects.get(id=first.json()["id"])
+        copy = UploadedPDF.objects.get(id=second.json()["id"])
+        self.assertEqual(copy.pdf_file.name, original.pdf_file.name)
+        self.assertEqual(copy.page_count, 2)
+        self.assertEqual(copy.get_text(), original.get_text())
+        # The text is stored once, however many copies are uploaded
+        self.assertEqual(PDFPage.objects.count(), 2)
+
+        # Deleting the original hands its pages to the oldest copy
+        original.delete()
+        copy.refresh_from_db()
+        self.assertIsNone(copy.text_source_id)
+        self.assertEqual(copy.get_text(), "Page one text.Page two text.")
+        self.assertEqual(UploadedPDF.objects.get(id=third.json()["id"]).get_text(), "Page one text.Page two text.")
+        self.assertEqual(PDFPage.objects.count(), 2)
+
+    def test_duplicate_of_only_names_visible_uploads(self):
+        other = User.objects.create_user(username="other", password="pass")
+        with mock.patch('core.views.extract_pages_from_pdf', return_value=["Secret notes."]):
+            private = self.upload("Mine", is_public="false")
+            self.client.force_login(other)
+            response = self.upload("Theirs")
+
+        self.assertNotIn("duplicate_of", response.json())
+        theirs = UploadedPDF.objects.get(id=response.json()["id"])
+        self.assertEqual(theirs.text_source_id, private.json()["id"])
+        self.assertEqual(theirs.get_text(), "Secret notes.")
+
+
+class PDFExtractionTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "pages.pdf")
+        with fitz.open() as doc:
+            for i in range(5):
+                doc.new_page().insert_text((72, 72), f"Text of page {i + 1}")
+            doc.save(self.path)
+
+    def test_pool_and_serial_extraction_agree(self):
+        serial = utils.extract_pages_from_pdf(self.path, max_workers=1)
+        pooled = utils.extract_pages_from_pdf(self.path, max_workers=2, min_parallel_pages=1)
+
+        self.assertEqual([page.strip() for page in serial], [f"Text of page {i}" for i in range(1, 6)])
+        self.assertEqual(pooled, serial)
+
+    def test_serial_by_default(self):
+        with mock.patch('core.utils.ProcessPoolExecutor') as pool:
+            pages = utils.extract_pages_from_pdf(self.path, max_workers=4)
+        pool.assert_not_called()
+        self.assertEqual(len(pages), 5)
+
+
+class PDFPageTextTests(TestCase):
+    def setUp(self):
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.pdf.set_pages(["aaaa", "bbbb", "cccc"])
+
+    def test_slices_span_page_boundaries(self):
+        self.assertEqual(self.pdf.get_text(), "aaaabbbbcccc")
+        self.assertEqual(self.pdf.get_text(2, 6), "aabb")
+        self.assertEqual(self.pdf.get_text(4, 8), "bbbb")
+        self.assertEqual(self.pdf.get_text(3, 9), "abbbbc")
+        self.assertEqual(self.pdf.get_text(10), "cc")
+        self.assertEqual(self.pdf.get_text(12), "")
+
+    def test_only_overlapping_pages_are_loaded(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.pdf.get_text(5, 7)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"start_offset" < 7', queries[0]["sql"])
+        self.assertIn('"end_offset" > 5', queries[0]["sql"])
+
+    def test_set_pages_replaces_previous_text(self):
+        self.pdf.set_pages(["new"])
+        self.assertEqual((self.pdf.get_text(), self.pdf.page_count), ("new", 1))
+
+
+class PDFPageMigrationTests(TransactionTestCase):
+    before = [("core", "0005_uploadedpdf_content_hash")]
+    after = [("core", "0006_pdfpage")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.before)
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_extracted_text_moves_into_fixed_size_sections(self):
+        old_apps = self.executor.loader.project_state(self.before).apps
+        LegacyPDF = old_apps.get_model("core", "UploadedPDF")
+        text = "".join(str(i % 10) for i in range(9000))
+        legacy = LegacyPDF.objects.create(title="Old", pdf_file="pdfs/old.pdf", extracted_text=text)
+        empty = LegacyPDF.objects.create(title="Unparsed", pdf_file="pdfs/unparsed.pdf", extracted_text=None)
+
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.after)
+        new_apps = self.executor.loader.project_state(self.after).apps
+        PDFPage = new_apps.get_model("core", "PDFPage")
+        migrated = new_apps.get_model("core", "UploadedPDF").objects.get(id=legacy.id)
+
+        pages = list(PDFPage.objects.filter(pdf_id=legacy.id).order_by("page_number"))
+        self.assertEqual(migrated.page_count, 3)
+        self.assertEqual([(p.start_offset, p.end_offset) for p in pages], [(0, 4000), (4000, 8000), (8000, 9000)])
+        self.assertEqual("".join(p.text for p in pages), text)
+        self.assertFalse(PDFPage.objects.filter(pdf_id=empty.id).exists())
+
+
+class QuizListTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pass")
+        public_pdf = UploadedPDF.objects.create(title="Public", pdf_file="pdfs/public.pdf", is_public=True)
+        private_pdf = UploadedPDF.objects.create(
+            title="Private", pdf_file="pdfs/private.pdf", is_public=False, user=self.owner
+        )
+        self.quiz_ids = []
+        for i in range(5):
+            pdf = private_pdf if i == 4 else public_pdf
+            quiz = create_quiz_with_questions(pdf, f"Quiz {i}", make_questions(i + 1))["quiz"]
+            Quiz.objects.filter(id=quiz.id).update(created_at=timezone.now() - timedelta(days=10 - i))
+            self.quiz_ids.append(quiz.id)
+
+    def test_pages_follow_newest_first_with_a_next_cursor(self):
+        first = self.client.get("/api/quizzes/", {"page_size": 2}).json()
+        self.assertEqual([q["id"] for q in first["results"]], [self.quiz_ids[3], self.quiz_ids[2]])
+        self.assertIn("cursor=", first["next"])
+        self.assertNotIn("count", first)
+
+        second = self.client.get(first["next"]).json()
+        self.assertEqual([q["id"] for q in second["results"]], [self.quiz_ids[1], self.quiz_ids[0]])
+        self.assertIsNone(second["next"])
+
+    def test_summaries_are_flat(self):
+        self.client.force_login(self.owner)
+        results = self.client.get("/api/quizzes/").json()["results"]
+
+        self.assertEqual(results[0], {
+            "id": self.quiz_ids[4], "title": "Quiz 4", "created_at": results[0]["created_at"],
+            "question_count": 5, "is_public": False, "is_owner": True
+        })
+        self.assertEqual([q["question_count"] for q in results[1:]], [4, 3, 2, 1])
+        self.assertFalse(any(q["is_owner"] for q in results[1:]))
+
+    def test_list_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/quizzes/")
+        self.assertEqual(len(response.json()["results"]), 4)
+
+
+class AnswerKeyCacheTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(3))
+        self.quiz_id = self.created["quiz"].id
+
+    def test_key_is_served_from_cache_after_generation(self):
+        with self.assertNumQueries(0):
+            answer_key = get_answer_key(self.quiz_id)
+        first_question = self.created["question_ids"][0]
+        self.assertEqual(answer_key[first_question]["correct_option_id"], self.created["option_ids"][0][1])
+
+    def test_admin_edit_invalidates_key(self):
+        first_options = self.created["option_ids"][0]
+        Option.objects.filter(id=first_options[1]).update(is_correct=False)
+        option = Option.objects.get(id=first_options[2])
+        option.is_correct = True
+        option.save()
+
+        answer_key = get_answer_key(self.quiz_id)
+        self.assertEqual(answer_key[self.created["question_ids"][0]]["correct_option_id"], first_options[2])
+
+
+SHARED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+}
+
+
+@override_settings(CACHES=SHARED_CACHES, ANSWER_KEY_CACHE_ALIAS='shared')
+class SharedAnswerKeyCacheTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(3))
+        self.quiz_id = self.created["quiz"].id
+
+    def test_edit_in_one_worker_invalidates_the_others(self):
+        # Another worker process, with its own local tier, has the key cached
+        other_worker = MemoryLRUBackend()
+        with mock.patch.object(services._answer_key_cache, 'local', other_worker):
+            get_answer_key(self.quiz_id)
+
+        first_options = self.created["option_ids"][0]
+        Option.objects.filter(id=first_options[1]).update(is_correct=False)
+        option = Option.objects.get(id=first_options[2])
+        option.is_correct = True
+        option.save()
+
+        with mock.patch.object(services._answer_key_cache, 'local', other_worker):
+            answer_key = get_answer_key(self.quiz_id)
+        self.assertEqual(answer_key[self.created["question_ids"][0]]["correct_option_id"], first_options[2])
+
+    def test_local_entries_expire_without_a_shared_cache(self):
+        with self.settings(ANSWER_KEY_CACHE_ALIAS=None):
+            get_answer_key(self.quiz_id)
+            Option.objects.filter(id=self.created["option_ids"][0][0]).update(text="Edited elsewhere")
+            later = time.time() + services._answer_key_cache.local_ttl + 1
+            with mock.patch('core.llm_cache.time.time', return_value=later):
+                answer_key = get_answer_key(self.quiz_id)
+        self.assertEqual(answer_key[self.created["question_ids"][0]]["options"][self.created["option_ids"][0][0]], "Edited elsewhere")
+
+
+class QuizDetailPayloadTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(2))
+        self.url = f"/api/quizzes/{self.created['quiz'].id}/"
+
+    def test_etag_revalidation_returns_304(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["questions"]), 2)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_option_edit_changes_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        option = Option.objects.get(id=self.created["option_ids"][0][0])
+        option.text = "Edited"
+        option.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["questions"][0]["options"][0]["text"], "Edited")
+
+
+@override_settings(CACHES=SHARED_CACHES, QUIZ_PAYLOAD_CACHE_ALIAS='shared')
+class SharedQuizPayloadCacheTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(2))
+        self.url = f"/api/quizzes/{self.created['quiz'].id}/"
+
+    def test_edit_in_one_worker_changes_etag_in_the_others(self):
+        other_worker = MemoryLRUBackend()
+        with mock.patch.object(services._quiz_payload_cache, 'local', other_worker):
+            etag = self.client.get(self.url)["ETag"]
+
+        option = Option.objects.get(id=self.created["option_ids"][0][0])
+        option.text = "Edited"
+        option.save()
+
+        with mock.patch.object(services._quiz_payload_cache, 'local', other_worker):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["questions"][0]["options"][0]["text"], "Edited")
+
+    def test_zero_padded_id_is_invalidated_with_the_quiz(self):
+        quiz_id = self.created["quiz"].id
+        etag = self.client.get(f"/api/quizzes/0{quiz_id}/")["ETag"]
+
+        option = Option.objects.get(id=self.created["option_ids"][0][0])
+        option.text = "Edited"
+        option.save()
+
+        response = self.client.get(f"/api/quizzes/0{quiz_id}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["questions"][0]["options"][0]["text"], "Edited")
+        self.assertEqual(self.client.get("/api/quizzes/abc/").status_code, 404)
+
+    def test_workers_share_the_rendered_payload(self):
+        etag = self.client.get(self.url)["ETag"]
+        with mock.patch.object(services._quiz_payload_cache, 'local', MemoryLRUBackend()):
+            with self.assertNumQueries(0):
+                cached = services.get_quiz_payload(self.created['quiz'].id)
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached[1], etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class QuizExplanationStoreTests(TestCase):
+    def setUp(self):
+        pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.created = create_quiz_with_questions(pdf, "Quiz", make_questions(3))
+        self.url = f"/api/quiz/{self.created['quiz'].id}/explain/"
+
+    def fake_explanations(self, questions_data, pdf_context="", context_builder=None):
+        return [{
+            "question_id": q["question_id"],
+            "explanation": f"Because {q['correct_answer']}",
+            "key_concepts": ["concept"]
+        } for q in questions_data]
+
+    def test_only_unexplained_questions_reach_the_llm(self):
+        first, second, third = self.created["question_ids"]
+        with mock.patch('core.views.generate_answer_explanations', side_effect=self.fake_explanations) as generate:
+            self.client.post(self.url, {"question_ids": [first, second]}, content_type='application/json')
+            response = self.client.post(
+                self.url, {"question_ids": [third, first], "include_context": True}, content_type='application/json'
+            )
+
+        self.assertEqual(generate.call_count, 2)
+        self.assertEqual([q["question_id"] for q in generate.call_args[0][0]], [third])
+        explanations = response.json()["explanations"]
+        self.assertEqual([exp["question_id"] for exp in explanations], [third, first])
+        self.assertEqual(explanations[1]["explanation"], "Because B0")
+
+        with mock.patch('core.views.generate_answer_explanations') as generate:
+            self.client.post(self.url, {"question_ids": [first, second, third]}, content_type='application/json')
+        generate.assert_not_called()
+
+    def test_pdf_index_is_loaded_once_outside_the_worker_threads(self):
+        retrieval._index_cache.clear()
+        pdf = self.created["quiz"].pdf
+        pdf.set_pages([" ".join(f"Sentence {i} about option B{i % 20}." for i in range(400))])
+        created = create_quiz_with_questions(pdf, "Long quiz", make_questions(20))  # Several groups
+        question_ids = created["question_ids"]
+        callers = []
+        get_text = UploadedPDF.get_text
+
+        def record_thread(pdf, *args):
+            callers.append(threading.current_thread())
+            return get_text(pdf, *args)
+
+        with mock.patch.object(UploadedPDF, 'get_text', autospec=True, side_effect=record_thread), \
+                mock.patch('core.utils.generate_explanation_batch', side_effect=lambda group, context: [
+                    {"question_id": q["question_id"], "explanation": context[:20], "key_concepts": []} for q in group
+                ]) as batch:
+            response = self.client.post(
+                f"/api/quiz/{created['quiz'].id}/explain/", {"question_ids": question_ids, "include_context": True},
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(batch.call_count, 1)
+        self.assertEqual(callers, [threading.main_thread()])
+        self.assertTrue(all(exp["explanation"].startswith("[Passage 1]") for exp in response.json()["explanations"]))
+
+    def test_fallback_explanations_are_not_stored(self):
+        first = self.created["question_ids"][0]
+        fallback = [{"question_id": first, "explanation": "Review", "key_concepts": [], "fallback": True}]
+        with mock.patch('core.views.generate_answer_explanations', return_value=fallback):
+            response = self.client.post(self.url, {"question_ids": [first]}, content_type='application/json')
+
+        self.assertNotIn("fallback", response.json()["explanations"][0])
+        self.assertFalse(QuestionExplanation.objects.exists())
+
+
+def make_question_data(count):
+    return [{
+        "question_id": i + 1,
+        "question_text": f"Question {i} about a fairly specific part of the chapter?",
+        "options": [{"text": f"Option {letter}{i}", "is_correct": letter == "b"} for letter in "abcd"],
+        "correct_answer": f"Option b{i}"
+    } for i in range(count)]
+
+
+class ExplanationGroupTests(TestCase):
+    def fake_completion(self, model, messages, temperature, max_tokens, parse=None):
+        self.requests.append((messages[-1]["content"], max_tokens))
+        ids = [int(n) for n in re.findall(r"^Question ID (\d+):", messages[-1]["content"], re.MULTILINE)]
+        # Answer out of order, as models sometimes do
+        return parse(json.dumps([{"question_id": i, "explanation": f"Because {i}"} for i in reversed(ids)]))
+
+    def setUp(self):
+        self.requests = []
+        patcher = mock.patch('core.utils.cached_chat_completion', side_effect=self.fake_completion)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_groups_keep_order_and_fit_the_group_budget(self):
+        questions = make_question_data(20)
+        groups = plan_explanation_groups(questions)
+
+        self.assertGreater(len(groups), 1)
+        self.assertEqual([q for group in groups for q in group], questions)
+        for group in groups:
+            self.assertLessEqual(EXPLANATION_TOKENS_PER_QUESTION * len(group), EXPLANATION_GROUP_TOKENS)
+
+    def test_every_request_gets_the_full_output_budget(self):
+        generate_answer_explanations(make_question_data(1))
+        generate_answer_explanations(make_question_data(20))
+        self.assertTrue(all(max_tokens == EXPLANATION_MAX_TOKENS for _, max_tokens in self.requests))
+
+    def test_merged_results_follow_question_order(self):
+        questions = make_question_data(20)
+        explanations = generate_answer_explanations(questions, max_workers=4)
+
+        self.assertEqual([exp["question_id"] for exp in explanations], list(range(1, 21)))
+        self.assertTrue(all("fallback" not in exp for exp in explanations))
+
+    def test_context_builder_gets_each_group(self):
+        questions = make_question_data(20)
+        builder = mock.Mock(side_effect=lambda group: f"Context for {group[0]['question_id']}-{group[-1]['question_id']}")
+        generate_answer_explanations(questions, pdf_context="unused", context_builder=builder)
+
+        groups = plan_explanation_groups(questions)
+        self.assertEqual(sorted(call.args[0][0]["question_id"] for call in builder.call_args_list), [g[0]["question_id"] for g in groups])
+        for prompt, _ in self.requests:
+            self.assertIn("Context for", prompt)
+            self.assertNotIn("unused", prompt)
+
+    def test_truncated_response_keeps_completed_explanations(self):
+        content = json.dumps([{"question_id": i, "explanation": f"Because {i}"} for i in (1, 2, 3)])
+        truncated = content[:content.rindex('"explanation"')]
+
+        self.assertEqual([exp["question_id"] for exp in parse_explanation_response(truncated)], [1, 2])
+
+
+class RetrievalTests(TestCase):
+    TOPICS = ["photosynthesis chlorophyll sunlight", "volcano magma eruption", "treaty parliament election"]
+
+    def setUp(self):
+        retrieval._index_cache.clear()
+        # Each topic gets several passages' worth of text, in document order
+        self.pages = [" ".join(f"Paragraph {n} about {topic}." for n in range(60)) for topic in self.TOPICS]
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf", content_hash="abc")
+        self.pdf.set_pages(self.pages)
+
+    def question(self, text):
+        return {"question_text": text, "options": [{"text": "first"}, {"text": "second"}]}
+
+    def test_best_matching_passage_ranks_first(self):
+        index = retrieval.BM25Index(["cats purr and sleep all day long", "magma rises before a volcano erupts",
+                                     "a volcano is a mountain"])
+        self.assertEqual([i for i, _ in index.search("volcano magma")], [1, 2])
+        self.assertEqual(index.search("unrelated words"), [])
+
+    def test_context_holds_passages_about_the_question(self):
+        questions = [self.question("What happens to magma during an eruption?")]
+        context = retrieval.build_explanation_context(self.pdf, questions)
+
+        self.assertIn("volcano", context)
+        self.assertNotIn("photosynthesis", context)
+        self.assertEqual(questions[0]["passage_refs"][0], 1)
+        self.assertTrue(context.startswith("[Passage 1] "))
+
+    def test_index_is_built_once_per_content_hash(self):
+        retrieval.get_pdf_index(self.pdf)
+        duplicate = UploadedPDF.objects.create(title="Copy", pdf_file="pdfs/copy.pdf", content_hash="abc")
+        with self.assertNumQueries(0):
+            self.assertIs(retrieval.get_pdf_index(duplicate), retrieval.get_pdf_index(self.pdf))
+
+        other = UploadedPDF.objects.create(title="Other", pdf_file="pdfs/other.pdf", content_hash="def")
+        other.set_pages(["Something else entirely. " * 10])
+        self.assertIsNot(retrieval.get_pdf_index(other), retrieval.get_pdf_index(self.pdf))
+
+    def test_context_fits_budget_with_numbering_and_separators(self):
+        questions = [self.question(topic) for topic in self.TOPICS]
+        index = retrieval.get_pdf_index(self.pdf)
+        # Room for each question's best passage itself, but not for their labels and separators too
+        best = [index.search(q["question_text"] + " first second", 1)[0][0] for q in questions]
+        budget = sum(len(index.passages[i]) for i in best)
+
+        context = retrieval.build_explanation_context(self.pdf, questions, k=1, max_chars=budget)
+
+        self.assertLessEqual(len(context), budget)
+        self.assertEqual(len(re.findall(r"\[Passage \d+\] ", context)), 2)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="async", password="pass")
+        self.token = Token.objects.create(user=self.user)
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.pdf.set_pages(["Some source text. " * 10])
+
+    async def test_generate_quiz_requires_valid_token(self):
+        url = f"/api/async/generate-quiz/{self.pdf.id}/"
+        response = await self.async_client.post(url, {"num_questions": 2}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        response = await self.async_client.post(
+            url, {"num_questions": 2}, content_type='application/json', headers={"Authorization": "Token bogus"}
+        )
+        self.assertEqual(response.status_code, 401)
+
+    async def test_session_users_need_a_csrf_token(self):
+        client = AsyncClient(enforce_csrf_checks=True)
+        await client.aforce_login(self.user)
+        url = f"/api/async/generate-quiz/{self.pdf.id}/"
+
+        with mock.patch('core.async_views.agenerate_mcqs_from_text', return_value=make_questions(2)) as generate:
+            response = await client.post(url, '{"num_questions": 2}', content_type='text/plain')
+            self.assertEqual(response.status_code, 403)
+            generate.assert_not_called()
+
+            client.cookies["csrftoken"] = "a" * 32
+            response = await client.post(
+                url, {"num_questions": 2}, content_type='application/json', headers={"X-CSRFToken": "a" * 32}
+            )
+            self.assertEqual(response.status_code, 200)
+
+            # Token clients don't send cookies, so they aren't subject to CSRF
+            response = await client.post(
+                url, {"num_questions": 2}, content_type='application/json',
+                headers={"Authorization": f"Token {self.token.key}"}
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_body_must_be_a_json_object(self):
+        headers = {"Authorization": f"Token {self.token.key}"}
+        for body in ["[]", '"text"', "5", "not json"]:
+            response = await self.async_client.post(
+                f"/api/async/generate-quiz/{self.pdf.id}/", body, content_type='application/json', headers=headers
+            )
+            self.assertEqual(response.status_code, 400, body)
+
+    async def test_generate_quiz_persists_questions(self):
+        with mock.patch('core.async_views.agenerate_mcqs_from_text', return_value=make_questions(2)) as generate:
+            response = await self.async_client.post(
+                f"/api/async/generate-quiz/{self.pdf.id}/", {"num_questions": 2},
+                content_type='application/json', headers={"Authorization": f"Token {self.token.key}"}
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(generate.call_args[0][0], "Some source text. " * 10)
+        self.assertEqual(response.json()["questions_generated"], 2)
+        self.assertEqual(await Question.objects.filter(quiz_id=response.json()["quiz_id"]).acount(), 2)
+
+    async def test_explanations_are_served_from_the_store(self):
+        created = await sync_to_async(create_quiz_with_questions)(self.pdf, "Quiz", make_questions(2))
+        first = created["question_ids"][0]
+        generated = [{"question_id": first, "explanation": "Because B0", "key_concepts": []}]
+        url = f"/api/async/quiz/{created['quiz'].id}/explain/"
+
+        with mock.patch('core.async_views.agenerate_answer_explanations', return_value=generated):
+            await self.async_client.post(url, {"question_ids": [first], "include_context": False}, content_type='application/json')
+        with mock.patch('core.async_views.agenerate_answer_explanations') as generate:
+            response = await self.async_client.post(
+                url, {"question_ids": [first], "include_context": False}, content_type='application/json'
+            )
+
+        generate.assert_not_called()
+        self.assertEqual(response.json()["explanations"][0]["explanation"], "Because B0")
+
+
+class GenerationJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="jobs", password="pass")
+        self.client.force_login(self.user)
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.pdf.set_pages(["Chapter text with enough words to count as content. " * 200])
+        # Ten questions per request, so a dozen questions take two chunks
+        patcher = mock.patch('core.utils.max_questions_per_request', return_value=10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_batch(self, text, num_questions):
+        return make_questions(num_questions)
+
+    def test_generate_endpoint_queues_and_reuses_active_job(self):
+        url = f"/api/generate-quiz/{self.pdf.id}/"
+        first = self.client.post(url, {"num_questions": 12}, content_type='application/json')
+        retry = self.client.post(url, {"num_questions": 12}, content_type='application/json')
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(retry.json()["job_id"], first.json()["job_id"])
+        self.assertEqual(GenerationJob.objects.count(), 1)
+
+    def test_worker_completes_job_and_reports_chunks(self):
+        job, _ = enqueue_generation_job(self.pdf, self.user, 12)
+        claimed = claim_next_job("worker-1")
+        self.assertEqual(claimed.id, job.id)
+        self.assertIsNone(claim_next_job("worker-2"))
+
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.fake_batch):
+            run_generation_job(claimed, "worker-1")
+
+        response = self.client.get(f"/api/generation-jobs/{job.id}/").json()
+        self.assertEqual(response["status"], "completed")
+        self.assertEqual(response["questions_generated"], 12)
+        self.assertEqual(Question.objects.filter(quiz_id=response["quiz_id"]).count(), 12)
+        self.assertEqual(response["chunks"][0]["status"], "completed")
+        self.assertEqual(response["chunks_done"], response["chunks_total"])
+
+    def test_abandoned_job_resumes_after_last_completed_chunk(self):
+        job, _ = enqueue_generation_job(self.pdf, self.user, 12)
+        claim_next_job("crashed-worker")
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.fake_batch):
+            # The plan and the first chunk are saved, then the worker dies
+            with mock.patch('core.jobs.heartbeat', side_effect=[None, None, SystemExit]):
+                with self.assertRaises(SystemExit):
+                    run_generation_job(job, "crashed-worker")
+
+        self.assertEqual(GenerationChunk.objects.filter(job=job, status='completed').count(), 1)
+        self.assertIsNone(claim_next_job("worker-2"))  # Lease still held
+
+        GenerationJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timezone.timedelta(hours=1))
+        resumed = claim_next_job("worker-2")
+        self.assertEqual(resumed.attempts, 2)
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.fake_batch) as generate:
+            run_generation_job(resumed, "worker-2")
+
+        # The dozen questions are split evenly over the two halves of the document
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(generate.call_args[0][1], 6)
+        resumed.refresh_from_db()
+        self.assertEqual(resumed.status, "completed")
+        self.assertEqual(resumed.quiz.question_set.count(), 12)
+
+
+    def test_reclaimed_job_gets_no_chunk_writes_from_the_old_worker(self):
+        job, _ = enqueue_generation_job(self.pdf, self.user, 12)
+        claim_next_job("worker-1")
+        GenerationChunk.objects.bulk_create([
+            GenerationChunk(job=job, index=i, text="Chapter text. " * 50, questions_requested=6) for i in range(2)
+        ])
+        # worker-2 takes over while worker-1 is still generating
+        GenerationJob.objects.filter(id=job.id).update(locked_by="worker-2")
+
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.fake_batch):
+            run_generation_job(job, "worker-1")
+
+        self.assertFalse(GenerationChunk.objects.filter(job=job).exclude(status='pending').exists())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ("running", "worker-2"))
+
+    def test_lease_is_renewed_while_chunks_are_running(self):
+        job, _ = enqueue_generation_job(self.pdf, self.user, 12)
+        with mock.patch('core.jobs.heartbeat') as beat:
+            with LeaseKeeper(job, "worker-1", interval=0.01):
+                time.sleep(0.1)
+        self.assertGreater(beat.call_count, 2)
+
+        with mock.patch('core.jobs.heartbeat', side_effect=JobLeaseLost("reclaimed")) as beat:
+            with LeaseKeeper(job, "worker-1", interval=0.01) as keeper:
+                time.sleep(0.1)
+        self.assertTrue(keeper.lost)
+        self.assertEqual(beat.call_count, 1)
+
+    def test_inline_job_is_never_offered_to_workers(self):
+        def run_after_worker_poll(job, worker_id):
+            # A worker polling between the job's creation and its run must not get it
+            self.assertIsNone(claim_next_job("background-worker"))
+            return run_generation_job(job, worker_id)
+
+        with mock.patch('core.jobs.run_generation_job', side_effect=run_after_worker_poll), \
+                mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.fake_batch):
+            job = run_generation_job_now(self.pdf, self.user, 12)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("completed", 1))
+        self.assertEqual(job.quiz.question_set.count(), 12)
+
+
+class QuizGenerationStreamTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="stream", password="pass")
+        self.client.force_login(self.user)
+        self.pdf = UploadedPDF.objects.create(title="Doc", pdf_file="pdfs/doc.pdf")
+        self.pdf.set_pages(["Chapter text with enough words to count as content. " * 200])
+        # Ten questions per request, so a dozen questions take two chunks
+        patcher = mock.patch('core.utils.max_questions_per_request', return_value=10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_events(self, response, on_event=None):
+        events = []
+        for block in response.streaming_content:
+            event, data = block.decode().strip().split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+            if on_event:
+                on_event(*events[-1])
+        return events
+
+    def test_each_chunk_is_saved_before_it_is_sent(self):
+        def check_saved(event, data):
+            if event == "questions":
+                saved = Question.objects.filter(quiz_id=data["quiz_id"]).count()
+                self.assertEqual(saved, data["questions_generated"])
+
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=lambda text, n: make_questions(n)):
+            response = self.client.post(
+                f"/api/generate-quiz/{self.pdf.id}/stream/", {"num_questions": 12}, content_type='application/json'
+            )
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            events = self.read_events(response, check_saved)
+
+        names = [event for event, _ in events]
+        self.assertEqual(names, ["start", "questions", "questions", "complete"])
+        summary = events[-1][1]
+        self.assertEqual(summary["questions_generated"], 12)
+
+        quiz = Quiz.objects.get(id=summary["quiz_id"])
+        self.assertEqual(quiz.title, "Quiz from Doc (12 questions)")
+        streamed_ids = [q["id"] for _, data in events[1:3] for q in data["questions"]]
+        self.assertEqual(sorted(streamed_ids), list(quiz.question_set.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(len(get_answer_key(quiz.id)), 12)
+
+    def test_error_event_when_nothing_is_generated(self):
+        with mock.patch('core.utils.generate_single_batch_mcqs', return_value=[]):
+            response = self.client.post(
+                f"/api/generate-quiz/{self.pdf.id}/stream/", {"num_questions": 3}, content_type='application/json'
+            )
+            events = self.read_events(response)
+
+        self.assertEqual(events[-1][0], "error")
+        self.assertFalse(Quiz.objects.exists())
+
+
+class SalvageQuestionsTests(TestCase):
+    def test_keeps_complete_questions_from_truncated_response(self):
+        content = json.dumps(make_questions(3), indent=2)
+        truncated = "Here you go:\n```json\n" + content[:content.rindex('"answer"')]
+
+        questions = salvage_questions(truncated)
+
+        self.assertEqual([q["question"] for q in questions], ["Question 0?", "Question 1?"])
+
+    def test_skips_invalid_items_and_unwraps_objects(self):
+        bad = {"question": "No answer?", "options": {"a": "x", "b": "y"}, "answer": "e"}
+        content = json.dumps({"questions": [bad] + make_questions(2)})
+
+        self.assertEqual([q["question"] for q in salvage_questions(content)], ["Question 0?", "Question 1?"])
+
+    def test_tops_up_only_the_shortfall(self):
+        requests = []
+
+        def fake_completion(model, messages, temperature, max_tokens, parse=None):
+            requests.append(messages[-1]["content"])
+            if len(requests) == 1:
+                content = json.dumps(make_questions(10))
+                return parse(content[:content.rindex('{"question": "Question 7?"')])
+            # One repeat of an existing question, which is dropped
+            return parse(json.dumps(make_questions(10)[6:9]))
+
+        with mock.patch('core.utils.cached_chat_completion', side_effect=fake_completion):
+            questions = generate_single_batch_mcqs("text", 10)
+
+        self.assertEqual(len(requests), 2)
+        self.assertTrue(requests[1].startswith("Generate exactly 3 multiple choice questions"))
+        self.assertIn("- Question 6?", requests[1])
+        self.assertEqual([q["question"] for q in questions], [f"Question {i}?" for i in range(9)])
+
+    def test_skips_top_up_without_room_for_a_question(self):
+        content = json.dumps(make_questions(10))
+        truncated = content[:content.rindex('{"question": "Question 7?"')]
+        # Room for the first request, but the top-up's longer prompt leaves none
+        budgets = iter([mcq_output_tokens(10), 0])
+
+        with mock.patch('core.utils.mcq_max_tokens', side_effect=lambda *args: next(budgets)), \
+                mock.patch('core.utils.cached_chat_completion',
+                           side_effect=lambda parse=None, **kwargs: parse(truncated)) as completion:
+            questions = generate_single_batch_mcqs("text", 10)
+
+        self.assertEqual(completion.call_count, 1)
+        self.assertEqual(len(questions), 7)
+
+
+class ChunkDispatchTests(TestCase):
+    def chunk_questions(self, chunk, count):
+        return [dict(q, question=f"{chunk} {q['question']}") for q in make_questions(count)]
+
+    def test_results_come_back_in_chunk_order(self):
+        second_done = threading.Event()
+        finished = []
+
+        def fake_batch(chunk, count):
+            # The first chunk only finishes after the second one has been collected
+            if chunk == "c0":
+                second_done.wait(5)
+            return self.chunk_questions(chunk, count)
+
+        def on_result(index, _):
+            finished.append(index)
+            if index == 1:
+                second_done.set()
+
+        plan = [("c0", 2), ("c1", 2), ("c2", 2)]
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=fake_batch):
+            questions = utils.generate_chunks_concurrently(plan, 6, max_workers=3, on_result=on_result)
+
+        self.assertLess(finished.index(1), finished.index(0))
+        self.assertEqual([q["question"].split()[0] for q in questions], ["c0", "c0", "c1", "c1", "c2", "c2"])
+
+    def test_dispatch_stops_once_the_count_is_covered(self):
+        plan = [(f"c{i}", 2) for i in range(5)]
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=self.chunk_questions) as batch:
+            questions = utils.generate_chunks_concurrently(plan, 4, max_workers=1)
+
+        self.assertEqual([call.args for call in batch.call_args_list], [("c0", 2), ("c1", 2)])
+        self.assertEqual(len(questions), 4)
+
+    def test_failed_chunk_is_replaced_by_the_next(self):
+        def fake_batch(chunk, count):
+            if chunk == "c0":
+                raise RuntimeError("model down")
+            return self.chunk_questions(chunk, count)
+
+        plan = [(f"c{i}", 2) for i in range(5)]
+        with mock.patch('core.utils.generate_single_batch_mcqs', side_effect=fake_batch) as batch:
+            questions = utils.generate_chunks_concurrently(plan, 4, max_workers=1)
+
+        self.assertEqual([call.args[0] for call in batch.call_args_list], ["c0", "c1", "c2"])
+        self.assertEqual([q["question"].split()[0] for q in questions], ["c1", "c1", "c2", "c2"])
+
+    def test_async_dispatch_keeps_order_and_stops_early(self):
+        async def fake_batch(chunk, count):
+            # Later chunks finish first
+            await asyncio.sleep(0.01 * (3 - int(chunk[1:])))
+            return self.chunk_questions(chunk, count)
+
+        plan = [(f"c{i}", 2) for i in range(5)]
+        with mock.patch('core.utils.agenerate_single_batch_mcqs', side_effect=fake_batch) as batch:
+            questions = asyncio.run(utils.agenerate_chunks_concurrently(plan, 6, max_workers=3))
+
+        self.assertEqual(batch.call_count, 3)
+        self.assertEqual([q["question"].split()[0] for q in questions], ["c0", "c0", "c1", "c1", "c2", "c2"])
+
+
+    def test_cancelling_async_generation_cancels_chunk_requests(self):
+        finished = []
+
+        async def fake_batch(chunk, count):
+            await asyncio.sleep(1)
+            finished.append(chunk)
+            return self.chunk_questions(chunk, count)
+
+        async def cancel_early():
+            generation = asyncio.ensure_future(utils.agenerate_chunks_concurrently([(f"c{i}", 2) for i in range(3)], 6))
+            await asyncio.sleep(0.05)
+            generation.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await generation
+            await asyncio.sleep(1.1)
+
+        with mock.patch('core.utils.agenerate_single_batch_mcqs', side_effect=fake_batch) as batch:
+            asyncio.run(cancel_early())
+
+        self.assertEqual(batch.call_count, 3)
+        self.assertEqual(finished, [])
+
+
+class TokenBudgetTests(TestCase):
+    def setUp(self):
+        self.text = " ".join(f"Sentence {i} explains another concept in the chapter." for i in range(3000))
+
+    def test_chunks_fit_the_token_budget_and_need_few_requests(self):
+        plan = plan_chunks(self.text, 200, model="llama-3.1-8b-instant")
+
+        questions_per_request = max_questions_per_request("llama-3.1-8b-instant")
+        self.assertEqual(sum(count for _, count in plan), 200)
+        self.assertLessEqual(-(-200 // questions_per_request), len(plan))
+        for chunk, count in plan:
+            self.assertLessEqual(count, questions_per_request)
+            self.assertLessEqual(count_tokens(chunk, "llama-3.1-8b-instant"), MCQ_CHUNK_MAX_TOKENS)
+        # Consecutive chunks overlap and together cover the whole text
+        self.assertTrue(self.text.startswith(plan[0][0]))
+        self.assertTrue(self.text.endswith(plan[-1][0]))
+
+    def test_few_questions_are_drawn_from_the_whole_document(self):
+        text = " ".join(f"Sentence {i} explains another concept in the chapter." for i in range(30000))
+        plan = plan_chunks(text, 10, model="llama-3.1-8b-instant")
+
+        self.assertEqual(sum(count for _, count in plan), 10)
+        self.assertLessEqual(len(plan), 10 // MCQ_MIN_QUESTIONS_PER_CHUNK)
+        for chunk, _ in plan:
+            self.assertLessEqual(count_tokens(chunk, "llama-3.1-8b-instant"), MCQ_CHUNK_MAX_TOKENS)
+        # Excerpts span the document, not just its first pages
+        sentences = [int(n) for chunk, _ in plan for n in re.findall(r"Sentence (\d+)", chunk)]
+        self.assertLess(min(sentences), 3000)
+        self.assertGreater(max(sentences), 27000)
+
+    def test_call_count_is_exact(self):
+        # A quarter of the text (about 6800 tokens) fits in two requests; there is no small tail section
+        short = self.text[:len(self.text) // 4]
+        self.assertEqual([count for _, count in plan_chunks(short, 10, model="llama-3.1-8b-instant")], [5, 5])
+        # 200 questions need nine full responses, and the text doesn't force more calls
+        plan = plan_chunks(short, 200, model="llama-3.1-8b-instant")
+        self.assertEqual(len(plan), -(-200 // max_questions_per_request("llama-3.1-8b-instant")))
+        self.assertEqual(sum(count for _, count in plan), 200)
+
+    def test_short_text_fallback_respects_response_size(self):
+        self.assertEqual(plan_generation("Too short to split.", 200), [
+            ("Too short to split.", max_questions_per_request("llama-3.1-8b-instant"))
+        ])
+
+    def test_questions_are_allocated_in_proportion_to_length(self):
+        self.assertEqual(allocate_questions(12, [100, 100, 200], cap=10), [3, 3, 6])
+        # Fewer questions than sections: spread out rather than taken from the start
+        self.assertEqual(allocate_questions(2, [1] * 10, cap=10), [0, 0, 1, 0, 0, 0, 0, 1, 0, 0])
+        # Questions over the cap move to the other sections
+        self.assertEqual(allocate_questions(12, [1000, 10, 10], cap=6), [6, 3, 3])
+
+    def test_max_tokens_respects_model_context(self):
+        small = build_mcq_request(self.text[:2000], 10, "gemma2-9b-it")
+        self.assertEqual(small["max_tokens"], mcq_output_tokens(10))
+
+        too_large = build_mcq_request(self.text, 10, "gemma2-9b-it")
+        self.assertEqual(too_large["max_tokens"], 0)
+
+
+class LLMCacheTests(TestCase):
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = MemoryLRUBackend(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")  # "b" is now the least recently used
+        backend.set("c", 3)
+
+        self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), (1, None, 3))
+        self.assertEqual(len(backend), 2)
+
+    def test_entries_expire_after_ttl(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for backend in (MemoryLRUBackend(), SQLiteBackend(os.path.join(tmp, "cache.sqlite3"))):
+                with mock.patch('core.llm_cache.time.time', return_value=1000.0):
+                    backend.set("key", "value", ttl=60)
+                    backend.set("forever", "value")
+                with mock.patch('core.llm_cache.time.time', return_value=1059.0):
+                    self.assertEqual(backend.get("key"), "value")
+                with mock.patch('core.llm_cache.time.time', return_value=1061.0):
+                    self.assertIsNone(backend.get("key"))
+                    self.assertEqual(backend.get("forever"), "value")
+
+    def test_sqlite_backend_persists_across_connections(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.sqlite3")
+            SQLiteBackend(path).set("key", "value")
+
+            other_process = SQLiteBackend(path, max_entries=2)
+            self.assertEqual(other_process.get("key"), "value")
+            # Past max_entries the least recently read rows go first
+            with mock.patch('core.llm_cache.time.time', side_effect=[1.0, 2.0, 3.0]):
+                other_process.set("b", "2")
+                other_process.get("key")
+                other_process.set("c", "3")
+            self.assertEqual(len(other_process), 2)
+            self.assertIsNone(other_process.get("b"))
+
+    def test_hits_and_misses_are_counted(self):
+        cache = LLMResponseCache(MemoryLRUBackend())
+        key = LLMResponseCache.make_key("model", [{"role": "user", "content": "hi"}], 0.7, 100)
+        self.assertNotEqual(key, LLMResponseCache.make_key("model", [{"role": "user", "content": "hi"}], 0.7, 200))
+        self.assertNotEqual(key, LLMResponseCache.make_key("model", [{"role": "user", "content": "hi"}], 0.7, 100, "other"))
+
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "response")
+        self.assertEqual(cache.get(key), "response")
+        self.assertEqual(cache.stats(), {
+            "backend": "MemoryLRUBackend", "entries": 1, "hits": 1, "misses": 1, "hit_rate": 0.5
+        })
+
+        cache.clear()
+        self.assertEqual((cache.stats()["hits"], cache.stats()["entries"]), (0, 0))
+
+    def test_backend_is_chosen_from_environment(self):
+        with mock.patch.dict(os.environ, {"LLM_CACHE_BACKEND": "memory", "LLM_CACHE_TTL": "0",
+                                          "LLM_CACHE_MAX_ENTRIES": "5"}):
+            cache = build_cache_from_env()
+        self.assertIsInstance(cache.backend, MemoryLRUBackend)
+        self.assertEqual((cache.backend.max_entries, cache.ttl), (5, None))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.sqlite3")
+            with mock.patch.dict(os.environ, {"LLM_CACHE_BACKEND": "sqlite", "LLM_CACHE_PATH": path}):
+                cache = build_cache_from_env()
+            self.assertIsInstance(cache.backend, SQLiteBackend)
+            self.assertEqual(cache.backend.path, path)
+
+        with mock.patch.dict(os.environ, {"LLM_CACHE_BACKEND": "none"}):
+            cache = build_cache_from_env()
+        self.assertFalse(cache.enabled)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+
+
+    def test_responses_are_not_shared_across_backends(self):
+        cache = LLMResponseCache(MemoryLRUBackend())
+        stub = StubLLMClient()
+        groq = PooledHTTPClient(api_key="key", api_base="https://api.groq.com/openai/v1")
+        other_host = PooledHTTPClient(api_key="key", api_base="http://localhost:8000/v1")
+        self.assertEqual(len({stub.identity, groq.identity, other_host.identity}), 3)
+
+        with mock.patch.object(utils, 'llm_cache', cache), mock.patch.object(utils, 'llm_client', stub):
+            stub_answer = utils.cached_chat_completion("llama-3.1-8b-instant", [{"role": "user", "content": "hi"}], 0.7, 50)
+        with mock.patch.object(utils, 'llm_cache', cache), mock.patch.object(utils, 'llm_client', groq), \
+                mock.patch.object(groq, 'chat', return_value={"choices": [{"message": {"content": "real"}}]}) as chat:
+            answer = utils.cached_chat_completion("llama-3.1-8b-instant", [{"role": "user", "content": "hi"}], 0.7, 50)
+
+        chat.assert_called_once()
+        self.assertEqual(answer, "real")
+        self.assertNotEqual(stub_answer, "real")
+        self.assertEqual(len(cache.backend), 2)
+
+
+class LLMSchedulerTests(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.scheduler = LLMScheduler(limits=lambda model: {"rpm": 2, "tpm": 1000}, clock=lambda: self.now)
+
+    def rate_limit_error(self, retry_after):
+        return openai.error.RateLimitError("Too many requests", headers={"retry-after": str(retry_after)})
+
+    def test_requests_wait_for_budget(self):
+        self.assertEqual(self.scheduler.reserve("a", 100), 0)
+        self.assertEqual(self.scheduler.reserve("a", 100), 0)
+        self.assertAlmostEqual(self.scheduler.reserve("a", 100), 30)
+        # Another model has its own budget, so it is picked while "a" is exhausted
+        self.assertEqual(self.scheduler.pick(["a", "b"], 100), "b")
+
+    def test_retry_after_routes_to_next_model_until_it_passes(self):
+        send = mock.Mock(side_effect=[self.rate_limit_error(60), {"usage": {"total_tokens": 10}}])
+        with self.assertRaises(openai.error.RateLimitError):
+            self.scheduler.call("a", 100, send)
+
+        self.assertEqual(list(self.scheduler.route(["a", "b"], 100))[0], "b")
+        self.now = 61
+        self.assertEqual(list(self.scheduler.route(["a", "b"], 100))[0], "a")
+
+    def test_short_retry_after_is_waited_out_on_same_model(self):
+        send = mock.Mock(side_effect=[self.rate_limit_error(2), {"usage": {"total_tokens": 10}}])
+        with mock.patch('core.llm_scheduler.time.sleep') as sleep:
+            self.scheduler.call("a", 100, send)
+
+        self.assertEqual(send.call_count, 2)
+        sleep.assert_called_once_with(2)
+
+    def test_circuit_opens_after_repeated_failures_and_closes_after_trial(self):
+        send = mock.Mock(side_effect=openai.error.APIError("Server error"))
+        for _ in range(LLM_BREAKER_THRESHOLD):
+            self.now += 60  # Keep the rate budget out of the way
+            with self.assertRaises(openai.error.APIError):
+                self.scheduler.call("a", 10, send)
+
+        self.assertEqual(self.scheduler.stats()["a"]["circuit"], "open")
+        self.assertEqual(list(self.scheduler.route(["a", "b"])), ["b"])
+
+        self.now += LLM_BREAKER_COOLDOWN
+        self.assertEqual(self.scheduler.pick(["a"]), "a")
+        self.scheduler.call("a", 10, lambda: {})
+        self.assertEqual(self.scheduler.stats()["a"]["circuit"], "closed")
+
+    def test_rejected_requests_do_not_open_the_circuit(self):
+        rejections = [
+            openai.error.InvalidRequestError("Context length exceeded", None, http_status=400),
+            openai.error.AuthenticationError("Invalid API key", http_status=401),
+            openai.error.APIError("Unprocessable", http_status=422),
+        ]
+        for error in rejections * LLM_BREAKER_THRESHOLD:
+            self.now += 60
+            with self.assertRaises(type(error)):
+                self.scheduler.call("a", 10, mock.Mock(side_effect=error))
+
+        stats = self.scheduler.stats()["a"]
+        self.assertEqual((stats["circuit"], stats["failure"], stats["rejected"]), ("closed", 0, 3 * LLM_BREAKER_THRESHOLD))
+
+        transient = [
+            openai.error.Timeout("Timed out"), openai.error.APIConnectionError("Connection reset"),
+            openai.error.ServiceUnavailableError("Overloaded", http_status=503),
+            openai.error.APIError("Bad gateway", http_status=502), openai.error.APIError("Server error"),
+        ]
+        for error in transient:
+            self.now += 60
+            with self.assertRaises(type(error)):
+                self.scheduler.call("a", 10, mock.Mock(side_effect=error))
+        self.assertEqual(self.scheduler.stats()["a"]["circuit"], "open")
+
+    def test_calls_to_an_open_circuit_fail_without_sending(self):
+        for _ in range(LLM_BREAKER_THRESHOLD):
+            self.scheduler.record_failure("a")
+        send = mock.Mock(return_value={})
+
+        with self.assertRaises(CircuitOpenError):
+            self.scheduler.call("a", 10, send)
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(self.scheduler.acall("a", 10, mock.AsyncMock(return_value={})))
+        send.assert_not_called()
+
+        # After the cooldown one trial call goes through; others wait for its outcome
+        self.now += LLM_BREAKER_COOLDOWN
+        self.scheduler.reserve("a", 10)
+        with self.assertRaises(CircuitOpenError):
+            self.scheduler.call("a", 10, send)
+        send.assert_not_called()
+
+    def test_explanations_fall_back_while_their_model_is_open(self):
+        for _ in range(LLM_BREAKER_THRESHOLD):
+            self.scheduler.record_failure(utils.EXPLANATION_MODEL)
+        questions = make_question_data(1)
+
+        with mock.patch.object(utils, 'llm_scheduler', self.scheduler), \
+                mock.patch.object(utils.llm_cache, 'get', return_value=None), \
+                mock.patch.object(utils.llm_client, 'chat') as chat:
+            explanations = utils.generate_explanation_batch(questions)
+
+        chat.assert_not_called()
+        self.assertTrue(explanations[0]["fallback"])
+
+    def test_latency_percentiles_follow_recent_calls(self):
+        histogram = LatencyHistogram(window=100)
+        for seconds in [1.0] * 95 + [10.0] * 5:
+            histogram.record(seconds)
+        self.assertAlmostEqual(histogram.percentile(50), 1.0, delta=0.1)
+        self.assertAlmostEqual(histogram.percentile(99), 10.0, delta=1.0)
+
+        # Older calls fall out of the window
+        for _ in range(100):
+            histogram.record(2.0)
+        self.assertAlmostEqual(histogram.percentile(99), 2.0, delta=0.2)
+
+    def test_hedge_delay_waits_for_enough_samples(self):
+        self.assertEqual(self.scheduler.hedge_delay("a"), LLM_HEDGE_DEFAULT_DELAY)
+        for _ in range(50):
+            self.scheduler.record_success("a", latency=3.0)
+        self.assertAlmostEqual(self.scheduler.hedge_delay("a"), 3.0, delta=0.3)
+
+    def test_slow_request_is_hedged_on_next_model(self):
+        release = threading.Event()
+
+        def attempt(model):
+            if model == "a":
+                release.wait(5)
+                return "slow"
+            return "fast"
+
+        with mock.patch.object(self.scheduler, 'hedge_delay', return_value=0.05):
+            result = self.scheduler.first_success(["a", "b"], attempt, hedge=True)
+        release.set()
+        self.assertEqual(result, ("b", "fast"))
+
+    def test_hedge_timer_starts_when_the_attempt_runs(self):
+        pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        pool.submit(time.sleep, 0.3)  # Another request holds the only pool thread
+        attempted = []
+
+        def attempt(model):
+            attempted.append(model)
+            time.sleep(0.02)
+            return model
+
+        with mock.patch('core.llm_scheduler._hedge_executor', pool), \
+                mock.patch.object(pool, 'submit', wraps=pool.submit) as submit, \
+                mock.patch.object(self.scheduler, 'hedge_delay', return_value=0.1):
+            result = self.scheduler.first_success(["a", "b"], attempt, hedge=True)
+
+        # Queueing behind the other request didn't count towards the hedge delay
+        self.assertEqual(result, ("a", "a"))
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(attempted, ["a"])
+
+    def test_hedged_attempts_get_a_short_read_timeout(self):
+        timeouts = []
+
+        def attempt(model):
+            timeouts.append(attempt_timeout(60))
+            return "ok"
+
+        self.scheduler.first_success(["a"], attempt, hedge=True)
+        self.scheduler.first_success(["a"], attempt)
+        self.assertEqual(timeouts, [min(60, LLM_HEDGE_ATTEMPT_TIMEOUT), 60])
+        self.assertEqual(attempt_timeout(60), 60)
+
+    def test_failed_attempt_falls_back_without_hedging(self):
+        def attempt(model):
+            if model == "a":
+                raise ValueError("No valid questions")
+            return "ok"
+
+        errors = []
+        result = self.scheduler.first_success(["a", "b"], attempt, on_error=lambda model, e: errors.append(model))
+        self.assertEqual(result, ("b", "ok"))
+        self.assertEqual(errors, ["a"])
+
+    async def test_async_hedge_cancels_the_slower_request(self):
+        cancelled = []
+
+        async def attempt(model):
+            if model == "a":
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(model)
+                    raise
+            return model
+
+        with mock.patch.object(self.scheduler, 'hedge_delay', return_value=0.05):
+            result = await self.scheduler.afirst_success(["a", "b"], attempt, hedge=True)
+        await asyncio.sleep(0)
+        self.assertEqual(result, ("b", "b"))
+        self.assertEqual(cancelled, ["a"])
+
+
+class LLMClientTests(TestCase):
+    def setUp(self):
+        # Every call should reach the client rather than the shared response cache
+        patcher = mock.patch.object(utils.llm_cache, 'backend', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stub_generates_requested_questions_deterministically(self):
+        request = build_mcq_request("Photosynthesis converts light energy into chemical energy. " * 5, 4, "llama-3.1-8b-instant")
+        first = StubLLMClient().chat(**request)
+        second = StubLLMClient().chat(**request)
+
+        questions = json.loads(first["choices"][0]["message"]["content"])
+        self.assertEqual(len(questions), 4)
+        self.assertTrue(all(is_valid_question(q) for q in questions))
+        self.assertEqual(first, second)
+        self.assertGreater(first["usage"]["total_tokens"], 0)
+
+    def test_stub_answers_explanation_prompts_by_question_id(self):
+        request = build_explanation_request([
+            {"question_id": 7, "question_text": "Q?", "options": [{"text": "A", "is_correct": True}, {"text": "B", "is_correct": False}]}
+        ])
+        response = StubLLMClient().chat("llama-3.1-8b-instant", request["messages"], 0.3, request["max_tokens"])
+        self.assertEqual(json.loads(response["choices"][0]["message"]["content"])[0]["question_id"], 7)
+
+    def test_stub_failures_surface_as_api_errors(self):
+        client = StubLLMClient(failure_rate=1.0)
+        with self.assertRaises(openai.error.ServiceUnavailableError):
+            client.chat("llama-3.1-8b-instant", [{"role": "user", "content": "hi"}], 0.7, 10)
+
+    def test_generation_runs_end_to_end_on_stub(self):
+        with mock.patch.object(utils, 'llm_client', StubLLMClient()):
+            questions = generate_single_batch_mcqs("Mitochondria produce most of the cell's energy. " * 10, 3)
+        self.assertEqual(len(questions), 3)
+
+    async def test_async_generation_runs_end_to_end_on_stub(self):
+        with mock.patch.object(utils, 'llm_client', StubLLMClient(latency=0.01)):
+            questions = await agenerate_mcqs_from_text("Mitochondria produce most of the cell's energy. " * 10, 3)
+        self.assertEqual(len(questions), 3)
+
+    def test_http_errors_map_to_openai_errors(self):
+        with self.assertRaises(openai.error.RateLimitError) as raised:
+            _parse_http_response(429, '{"error": {"message": "Slow down"}}', {"retry-after": "3"})
+        self.assertEqual(str(raised.exception), "Slow down")
+        self.assertEqual(raised.exception.headers["retry-after"], "3")
+        self.assertEqual(_parse_http_response(200, '{"choices": []}', {}), {"choices": []})
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay)
+        payload = json.dumps(StubLLMClient().chat(body["model"], body["messages"], 0.7, 100)).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except BrokenPipeError:
+            pass  # The client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+class PooledHTTPClientTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), CompletionHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = PooledHTTPClient(api_key="test", api_base=f"http://127.0.0.1:{self.server.server_port}", read_timeout=5)
+        self.messages = build_mcq_request("Enzymes speed up chemical reactions. " * 5, 2, "llama-3.1-8b-instant")["messages"]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sequential_calls_reuse_one_connection(self):
+        for _ in range(3):
+            response = self.client.chat("llama-3.1-8b-instant", self.messages, 0.7, 300)
+            self.assertEqual(len(json.loads(response["choices"][0]["message"]["content"])), 2)
+
+        stats = self.client.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["status_codes"], {200: 3})
+
+    def test_slow_response_hits_read_timeout(self):
+        with mock.patch.object(CompletionHandler, 'delay', 0.5):
+            with self.assertRaises(openai.error.Timeout):
+                self.client.chat("llama-3.1-8b-instant", self.messages, 0.7, 300, timeout=0.1)
+        self.assertEqual(self.client.stats()["errors"], {"timeout": 1})
+
+    async def test_async_calls_share_the_loop_session(self):
+        for _ in range(3):
+            await self.client.achat("llama-3.1-8b-instant", self.messages, 0.7, 300)
+        await self.client.aclose()
+
+        stats = self.client.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections_opened"], 1)
@@ -0,0 +1,134 @@
+import json
+import os
+import re
+
+# Context window, output limit and rate limits (requests and tokens per minute) per model.
+# The prompt, the source text and the response must all fit in the context window, and a single
+# request can't use more tokens than the per-minute allowance. The rate limits are the Groq free
+# tier; LLM_RATE_LIMITS='{"model": {"rpm": ..., "tpm": ...}}' overrides them for other plans.
+MODEL_LIMITS = {
+    "llama-3.1-8b-instant": {"context": 131072, "max_output": 8192, "rpm": 30, "tpm": 6000},
+    "gemma2-9b-it": {"context": 8192, "max_output": 8192, "rpm": 30, "tpm": 15000},
+    "llama-3.1-70b-versatile": {"context": 131072, "max_output": 8192, "rpm": 30, "tpm": 6000},
+    "llama3-8b-8192": {"context": 8192, "max_output": 8192, "rpm": 30, "tpm": 6000},
+}
+DEFAULT_LIMITS = {"context": 8192, "max_output": 2048, "rpm": 30, "tpm": 6000}
+
+for _model, _overrides in json.loads(os.getenv("LLM_RATE_LIMITS", "{}")).items():
+    MODEL_LIMITS[_model] = {**MODEL_LIMITS.get(_model, DEFAULT_LIMITS), **_overrides}
+
+# How each model family's tokenizer differs: digits per token (Llama 3 groups up to three,
+# Gemma splits every digit) and a scale factor for its smaller vocabulary
+TOKENIZER_PROFILES = {
+    "llama": {"digits_per_token": 3, "scale": 1.0},
+    "gemma": {"digits_per_token": 1, "scale": 1.08},
+}
+
+# Headroom kept free in every request for estimation error
+TOKEN_SAFETY_MARGIN = 0.1
+
+# Output budget for MCQ responses: the JSON array wrapper plus one object per question
+MCQ_OUTPUT_BASE_TOKENS = 50
+MCQ_TOKENS_PER_QUESTION = 110
+
+# Optional caps on top of the model limits (0 = use the model limit)
+MCQ_MAX_OUTPUT_TOKENS = int(os.getenv("MCQ_MAX_OUTPUT_TOKENS", "0"))
+# Source text per chunk; smaller chunks spread questions over more of the document
+MCQ_CHUNK_MAX_TOKENS = int(os.getenv("MCQ_CHUNK_MAX_TOKENS", "4000"))
+MCQ_CHUNK_MIN_TOKENS = 500
+MCQ_CHUNK_OVERLAP_TOKENS = 50
+# Long documents are spread over more requests so questions come from all of it, down to this
+# many questions per request; a section too long for one request is sent as evenly spaced
+# excerpts of at least MCQ_EXCERPT_MIN_TOKENS each
+MCQ_MIN_QUESTIONS_PER_CHUNK = int(os.getenv("MCQ_MIN_QUESTIONS_PER_CHUNK", "5"))
+MCQ_EXCERPT_MIN_TOKENS = 200
+
+PIECE_RE = re.compile(r"[A-Za-z]+|\d+|\n+|[^\sA-Za-z\d]")
+
+
+def get_model_limits(model):
+    return MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+
+
+def _tokenizer_profile(model):
+    return TOKENIZER_PROFILES["gemma" if model and model.startswith("gemma") else "llama"]
+
+
+def count_tokens(text, model=None):
+    """
+    Estimate how many tokens a model's tokenizer produces for text
+
+    No tokenizer files are needed: common words are a single token and longer words take one
+    more token per four letters, digits are grouped the way the model's tokenizer does, and each
+    punctuation mark and each run of newlines is one token. TOKEN_SAFETY_MARGIN absorbs the
+    estimation error.
+    """
+    profile = _tokenizer_profile(model)
+    tokens = 0
+    for piece in PIECE_RE.findall(text):
+        if piece[0].isalpha():
+            tokens += 1 + max(0, len(piece) - 6) // 4
+        elif piece[0].isdigit():
+            tokens += -(-len(piece) // profile["digits_per_token"])
+        else:
+            tokens += 1
+    return int(tokens * profile["scale"])
+
+
+def count_message_tokens(messages, model=None):
+    # About four tokens of chat template per message
+    return sum(count_tokens(message["content"], model) + 4 for message in messages)
+
+
+def usable_tokens(limit):
+    return int(limit * (1 - TOKEN_SAFETY_MARGIN))
+
+
+def request_token_limit(model):
+    """
+    Most tokens (prompt plus response) a single request to model may use
+    """
+    limits = get_model_limits(model)
+    return min(limits["context"], limits["tpm"])
+
+
+def max_output_tokens(model):
+    limit = get_model_limits(model)["max_output"]
+    if MCQ_MAX_OUTPUT_TOKENS:
+        limit = min(limit, MCQ_MAX_OUTPUT_TOKENS)
+    return limit
+
+
+def mcq_output_tokens(num_questions):
+    """
+    Output tokens needed for a response with num_questions MCQs
+    """
+    return MCQ_OUTPUT_BASE_TOKENS + num_questions * MCQ_TOKENS_PER_QUESTION
+
+
+def max_questions_per_request(model):
+    """
+    Most MCQs a single response from model can hold without being truncated
+    """
+    # At most half of a request goes to the response, leaving the rest for the source text
+    output = min(usable_tokens(max_output_tokens(model)), usable_tokens(request_token_limit(model)) // 2)
+    return max(1, (output - MCQ_OUTPUT_BASE_TOKENS) // MCQ_TOKENS_PER_QUESTION)
+
+
+def mcq_max_tokens(num_questions, model, prompt_tokens):
+    """
+    max_tokens for an MCQ request: what num_questions need, within the model's output limit
+    and whatever room the prompt leaves in a request
+    """
+    available = usable_tokens(request_token_limit(model)) - prompt_tokens
+    return max(0, min(mcq_output_tokens(num_questions), max_output_tokens(model), available))
+
+
+def chunk_input_budget(model, questions_per_chunk, prompt_overhead):
+    """
+    Source-text tokens a chunk may hold so that prompt, text and response fit in one request
+    """
+    budget = usable_tokens(request_token_limit(model)) - prompt_overhead - mcq_output_tokens(questions_per_chunk)
+    if MCQ_CHUNK_MAX_TOKENS:
+        budget = min(budget, MCQ_CHUNK_MAX_TOKENS)
+    return max(budget, 0)
@@ -3,8 +3,10 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     PDFUploadView, TestView, GenerateQuizView, QuizViewSet, 
     SubmitQuizView, UserQuizHistoryView, QuizAnalyticsView, QuizAttemptDetailView,
-    QuizExplanationView
+    QuizExplanationView, QuizItemAnalysisView, GenerationJobStatusView,
+    GenerateQuizStreamView
 )
+from .async_views import AsyncGenerateQuizView, AsyncQuizExplanationView
 from .authentication import RegisterView, LoginView
 
 # Create a router and register our viewsets with it
@@ -15,8 +17,14 @@ urlpatterns = [
     # PDF and Quiz Management
     path('upload-pdf/', PDFUploadView.as_view(), name='upload-pdf'),
     path('generate-quiz/<int:pdf_id>/', GenerateQuizView.as_view(), name='generate-quiz'),
+    path('generate-quiz/<int:pdf_id>/stream/', GenerateQuizStreamView.as_view(), name='generate-quiz-stream'),
+    path('generation-jobs/<int:job_id>/', GenerationJobStatusView.as_view(), name='generation-job-status'),
     path('submit-quiz/<int:quiz_id>/', SubmitQuizView.as_view(), name='submit-quiz'),
     
+    # Async-native variants of the LLM-bound endpoints (serve through quiz_backend.asgi)
+    path('async/generate-quiz/<int:pdf_id>/', AsyncGenerateQuizView.as_view(), name='async-generate-quiz'),
+    path('async/quiz/<int:quiz_id>/explain/', AsyncQuizExplanationView.as_view(), name='async-quiz-explanation'),
+    
     # User Management
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
@@ -25,6 +33,7 @@ urlpatterns = [
     path('user/quiz-history/', UserQuizHistoryView.as_view(), name='user-quiz-history'),
     path('attempt/<int:attempt_id>/', QuizAttemptDetailView.as_view(), name='quiz-attempt-detail'),
     path('quiz/<int:quiz_id>/analytics/', QuizAnalyticsView.as_view(), name='quiz-analytics'),
+    path('quiz/<int:quiz_id>/item-analysis/', QuizItemAnalysisView.as_view(), name='quiz-item-analysis'),
     path('quiz/<int:quiz_id>/explain/', QuizExplanationView.as_view(), name='quiz-explanation'),
     
     # Test endpoint
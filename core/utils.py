@@ -1,21 +1,270 @@
+import asyncio
+import bisect
 import fitz  # PyMuPDF
+import hashlib
+import inspect
+import itertools
+import json
 import openai
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dotenv import load_dotenv
+from .llm_cache import build_cache_from_env
+from .llm_client import build_client_from_env
+from .llm_scheduler import LLMScheduler, LLM_HEDGING, MAX_CONCURRENT_BATCHES, attempt_timeout
+from .token_budget import (
+    count_tokens, count_message_tokens, max_questions_per_request, mcq_max_tokens, mcq_output_tokens,
+    chunk_input_budget, MCQ_CHUNK_MIN_TOKENS, MCQ_CHUNK_OVERLAP_TOKENS, MCQ_MIN_QUESTIONS_PER_CHUNK,
+    MCQ_EXCERPT_MIN_TOKENS
+)
 load_dotenv()
 
+# PDF text extraction: process pool size and the page count from which it is worth using.
+# Serial extraction runs at about 1.5 ms per page and starting the pool costs about 50 ms, so on
+# the bundled PDFs (up to 89 pages) the pool was slower on every file (benchmark_pdf_extraction).
+# Parallel mode therefore stays off (0) unless a threshold measured on the deployment host is set.
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "0"))
 
-def extract_text_from_pdf(file_path):
-    text = ""
+
+def compute_file_hash(file, chunk_size=64 * 1024):
+    """
+    Compute the SHA-256 hex digest of an uploaded or stored file without reading it into memory at once
+    """
+    digest = hashlib.sha256()
+    if hasattr(file, 'chunks'):
+        for chunk in file.chunks(chunk_size):
+            digest.update(chunk)
+    else:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)  # Leave the file ready to be saved
+    return digest.hexdigest()
+
+
+def _extract_page_range(file_path, start, stop):
+    """
+    Extract the text of pages [start, stop) as a list of per-page strings (runs in a worker process)
+    """
+    with fitz.open(file_path) as doc:
+        return [doc[page_number].get_text() for page_number in range(start, stop)]
+
+
+def extract_pages_from_pdf(file_path, max_workers=None, min_parallel_pages=None):
+    """
+    Extract per-page text from a PDF, splitting page ranges across a process pool for large documents
+    
+    Small files are parsed serially since starting worker processes costs more than it saves.
+    
+    Args:
+        file_path: Path to the PDF on disk
+        max_workers: Number of extraction processes (default: PDF_EXTRACTION_WORKERS)
+        min_parallel_pages: Page count from which the process pool is used (default: PDF_PARALLEL_MIN_PAGES;
+            0 always extracts serially)
+    
+    Returns:
+        List of page texts, in page order
+    """
+    max_workers = max_workers or PDF_EXTRACTION_WORKERS
+    if min_parallel_pages is None:
+        min_parallel_pages = PDF_PARALLEL_MIN_PAGES
+    
     with fitz.open(file_path) as doc:
-        for page in doc:
-            text += page.get_text()
-    return text
+        page_count = doc.page_count
+        if max_workers <= 1 or not min_parallel_pages or page_count < min_parallel_pages:
+            return [page.get_text() for page in doc]
+    
+    # One contiguous page range per worker keeps each process to a single open() of the file
+    range_size = -(-page_count // max_workers)
+    ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+    
+    with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(_extract_page_range, file_path, start, stop) for start, stop in ranges]
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+    
+    return pages
+
+
+def extract_text_from_pdf(file_path, max_workers=None, min_parallel_pages=None):
+    """
+    Extract the full text of a PDF as a single string (see extract_pages_from_pdf)
+    """
+    return "".join(extract_pages_from_pdf(file_path, max_workers, min_parallel_pages))
+
+
+# Backend for every LLM call: Groq by default (see core.llm_client for LLM_BACKEND and its settings)
+llm_client = build_client_from_env()
+
+# Shared cache of LLM responses (see core.llm_cache for the LLM_CACHE_* settings)
+llm_cache = build_cache_from_env()
+
+# Rate budgets and circuit breakers for every LLM call in the process (see core.llm_scheduler)
+llm_scheduler = LLMScheduler()
+
+# Follow-up requests made for the questions missing from a truncated or short batch
+MCQ_TOPUP_ROUNDS = int(os.getenv("MCQ_TOPUP_ROUNDS", "1"))
+
+# Seconds before a single LLM request is abandoned, so a stalled call can't hold a worker forever
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+
+# Characters of PDF text included as context in explanation prompts
+EXPLANATION_CONTEXT_CHARS = 3000
+
+# Output token budgeting for explanation requests: every request may use EXPLANATION_MAX_TOKENS,
+# and questions are grouped so their estimated output fills at most EXPLANATION_GROUP_TOKENS of
+# it, leaving headroom for explanations longer than the estimate
+EXPLANATION_MAX_TOKENS = 1500
+EXPLANATION_GROUP_TOKENS = 1000
+EXPLANATION_BASE_TOKENS = 100
+EXPLANATION_TOKENS_PER_QUESTION = 160
+
+# Recommended models for reliable JSON generation (2025), tried in order
+MODELS_TO_TRY = [
+    "llama-3.1-8b-instant",      # Fast and reliable
+    "gemma2-9b-it",              # Excellent for structured output
+    "llama-3.1-70b-versatile",   # Powerful fallback
+    "llama3-8b-8192"             # Backup option
+]
+
+EXPLANATION_MODEL = "llama-3.1-8b-instant"  # Updated to more reliable model
+
 
+def is_valid_question(item):
+    """
+    Check that a parsed item has the shape create_quiz_with_questions expects
+    """
+    if not isinstance(item, dict):
+        return False
+    options = item.get("options")
+    return (
+        isinstance(item.get("question"), str) and item["question"].strip() != ""
+        and isinstance(options, dict) and len(options) >= 2
+        and all(isinstance(value, str) for value in options.values())
+        and item.get("answer") in options
+    )
+
+
+def is_valid_explanation(item):
+    """
+    Check that a parsed item is an explanation for a question ID
+    """
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("question_id"), int)
+        and isinstance(item.get("explanation"), str) and item["explanation"].strip() != ""
+    )
+
+
+def salvage_objects(content, is_valid):
+    """
+    Extract every complete object accepted by is_valid from a possibly truncated or noisy response
+    
+    Objects are decoded one at a time from the first "{" onwards, so a response cut off by
+    max_tokens still yields all objects before the cut, and text or malformed items around
+    them are skipped. Objects that aren't valid themselves (e.g. {"questions": [...]}
+    wrappers) are searched for valid objects inside them.
+    
+    Returns:
+        List of objects in response order
+    """
+    decoder = json.JSONDecoder()
+    items = []
+    pos = content.find('{')
+    while pos != -1:
+        try:
+            item, end = decoder.raw_decode(content, pos)
+        except json.JSONDecodeError:
+            item, end = None, pos + 1
+        
+        if is_valid(item):
+            items.append(item)
+            pos = content.find('{', end)
+        else:
+            # Look inside whatever started here; the next "{" may open a nested object
+            pos = content.find('{', pos + 1)
+    return items
+
+
+def salvage_questions(content):
+    """
+    Extract every complete, valid question object from a possibly truncated or noisy response
+    (see salvage_objects)
+    """
+    return salvage_objects(content, is_valid_question)
+
+
+def parse_mcq_response(content):
+    """
+    Parser for MCQ completions: the valid questions salvaged from the response
+    """
+    questions = salvage_questions(content)
+    if not questions:
+        print("No valid questions found in AI response")
+        raise ValueError("No valid questions in response from AI")
+    return questions
 
-# Set Groq credentials
-openai.api_key = os.getenv("GROQ_API_KEY")
-openai.api_base = "https://api.groq.com/openai/v1"
+
+def parse_explanation_response(content):
+    """
+    Parser for explanation completions: the explanations salvaged from the response, so a
+    truncated array keeps the explanations completed before the cut
+    """
+    explanations = salvage_objects(content, is_valid_explanation)
+    if not explanations:
+        print("No valid explanations found in AI response")
+        raise ValueError("No valid explanations in response from AI")
+    return explanations
+
+
+def cached_chat_completion(model, messages, temperature, max_tokens, parse=None):
+    """
+    Run a chat completion through the LLM response cache
+    
+    The raw completion text is only cached once parse() accepts it, so a malformed
+    response is never replayed from the cache.
+    
+    Returns:
+        parse(content) if a parser is given, otherwise the completion text
+    """
+    key = llm_cache.make_key(model, messages, temperature, max_tokens, backend=llm_client.identity)
+    content = llm_cache.get(key)
+    if content is not None:
+        print(f"LLM cache hit for {model}")
+        return parse(content) if parse else content
+    
+    # Calls wait for the model's rate budget and feed its circuit breaker
+    tokens = count_message_tokens(messages, model) + max_tokens
+    response = llm_scheduler.call(model, tokens, lambda: llm_client.chat(
+        model, messages, temperature, max_tokens, timeout=attempt_timeout(LLM_REQUEST_TIMEOUT)
+    ))
+    content = response['choices'][0]['message']['content'].strip()
+    result = parse(content) if parse else content
+    llm_cache.set(key, content)
+    return result
+
+
+async def acached_chat_completion(model, messages, temperature, max_tokens, parse=None):
+    """
+    Async version of cached_chat_completion, awaiting the LLM instead of blocking a thread
+    """
+    key = llm_cache.make_key(model, messages, temperature, max_tokens, backend=llm_client.identity)
+    content = llm_cache.get(key)
+    if content is not None:
+        print(f"LLM cache hit for {model}")
+        return parse(content) if parse else content
+    
+    # Calls wait for the model's rate budget and feed its circuit breaker
+    tokens = count_message_tokens(messages, model) + max_tokens
+    response = await llm_scheduler.acall(model, tokens, lambda: llm_client.achat(
+        model, messages, temperature, max_tokens, timeout=LLM_REQUEST_TIMEOUT
+    ))
+    content = response['choices'][0]['message']['content'].strip()
+    result = parse(content) if parse else content
+    llm_cache.set(key, content)
+    return result
 
 
 def generate_mcqs_from_text(text, num_questions=5):
@@ -25,95 +274,322 @@ def generate_mcqs_from_text(text, num_questions=5):
     """
     print(f"Processing PDF with {len(text)} characters for {num_questions} questions")
     
-    # Use batch processing for larger requests or large PDFs
-    # This ensures we use the FULL PDF content, not just the beginning
-    if num_questions > 5 or len(text) > 3000:
-        return generate_mcqs_in_batches(text, num_questions)
+    # Chunks are sized for the model, so small requests on small PDFs are a single request
+    # and large PDFs are processed in full, not just the beginning
+    return generate_chunks_concurrently(plan_generation(text, num_questions), num_questions)
+
+
+def plan_generation(text, num_questions):
+    """
+    Chunk plan for generating num_questions from a document, keeping very short texts as one chunk
+    """
+    # Even then a single request can't ask for more questions than one response holds
+    return plan_chunks(text, num_questions) or [(text, min(num_questions, max_questions_per_request(MODELS_TO_TRY[0])))]
+
+
+async def agenerate_mcqs_from_text(text, num_questions=5):
+    """
+    Async version of generate_mcqs_from_text
+    """
+    print(f"Processing PDF with {len(text)} characters for {num_questions} questions")
     
-    # For smaller requests with small PDFs, use single batch
-    return generate_single_batch_mcqs(text, num_questions)
+    return await agenerate_chunks_concurrently(plan_generation(text, num_questions), num_questions)
 
 
-def generate_mcqs_in_batches(text, total_questions):
+def plan_chunks(text, total_questions, model=None):
     """
-    Divide PDF into chunks and generate questions from each chunk
-    NOW USES FULL PDF CONTENT - NO TRUNCATION!
+    Divide PDF text into sections and allocate the requested questions across all of them
+    
+    Sizes come from the model's token limits (see core.token_budget): a request asks for at most
+    as many questions as one response can hold and holds as much text as the context window and
+    MCQ_CHUNK_MAX_TOKENS allow. Long documents are spread over more requests (down to
+    MCQ_MIN_QUESTIONS_PER_CHUNK questions each) until the whole text fits; past that, each
+    section is sent as evenly spaced excerpts. Questions are allocated in proportion to section
+    length, so they come from the whole document while the number of calls stays bounded.
+    
+    Returns:
+        List of (chunk_text, questions_for_chunk) tuples in document order
     """
-    print(f"Batch processing: {len(text)} characters → {total_questions} questions")
-    print(f"Full PDF will be processed (no content truncated)")
+    model = model or MODELS_TO_TRY[0]
+    questions_per_batch = min(total_questions, max_questions_per_request(model))
     
-    # Calculate optimal chunk size and questions per batch
-    chunk_size = 2500  # Slightly larger chunks for better context
+    prompt_overhead = count_message_tokens(_mcq_messages("", questions_per_batch), model)
+    budget = chunk_input_budget(model, questions_per_batch, prompt_overhead)
+    text_tokens = count_tokens(text, model)
+    # Each section holds its share of the text plus the overlap with the previous one
+    section_budget = max(1, budget - MCQ_CHUNK_OVERLAP_TOKENS)
+    calls = max(
+        -(-total_questions // questions_per_batch),
+        min(-(-total_questions // MCQ_MIN_QUESTIONS_PER_CHUNK), -(-text_tokens // section_budget))
+    )
+    # Short texts aren't cut into sections too small to write questions about
+    calls = max(1, min(calls, -(-text_tokens // MCQ_CHUNK_MIN_TOKENS)))
     
-    # Dynamic questions per batch based on total request
-    if total_questions <= 20:
-        questions_per_batch = min(10, total_questions)  # Up to 10 per batch for small requests
-    elif total_questions <= 50:
-        questions_per_batch = 15  # 15 per batch for medium requests  
-    else:
-        questions_per_batch = 20  # 20 per batch for large requests
+    print(f"Using up to {questions_per_batch} questions per batch for {model}")
     
-    print(f"Using {questions_per_batch} questions per batch for optimal processing")
+    # Exactly one section per call, overlapping for better continuity
+    overlap_chars = int(MCQ_CHUNK_OVERLAP_TOKENS * len(text) / max(1, text_tokens))
+    sections = split_text_evenly(text, calls, overlap_chars)
+    counts = allocate_questions(total_questions, [len(section) for section in sections], questions_per_batch)
     
-    # Split text into overlapping chunks for better continuity
-    chunks = []
-    overlap = 200  # 200 character overlap between chunks
+    print(f"Created {len(sections)} sections from full PDF content ({text_tokens} tokens)")
+    print(f"Overlap: {MCQ_CHUNK_OVERLAP_TOKENS} tokens, Chunk budget: {budget} tokens")
     
-    for i in range(0, len(text), chunk_size - overlap):
-        chunk = text[i:i + chunk_size]
-        if len(chunk.strip()) > 100:  # Only use chunks with meaningful content
-            chunks.append(chunk.strip())
-            
-        # Stop if we've covered the entire text
-        if i + chunk_size >= len(text):
-            break
+    # Sections without questions are never sent; ones too long for a request are condensed
+    plan = []
+    for section, count in zip(sections, counts):
+        if not count:
+            continue
+        if count_tokens(section, model) > budget:
+            section = sample_excerpts(section, budget, count, model)
+        plan.append((section, count))
+    return plan
+
+
+def allocate_questions(total_questions, weights, cap):
+    """
+    Split total_questions across sections in proportion to their weights, at most cap each
     
-    print(f"Created {len(chunks)} overlapping chunks from full PDF content")
-    print(f"Chunk size: {chunk_size} chars, Overlap: {overlap} chars")
+    Each question is placed at an evenly spaced point of the combined weight, so sections get
+    their proportional share and, when there are fewer questions than sections, the ones that
+    get a question are spread across the document instead of bunched at the start.
+    """
+    counts = [0] * len(weights)
+    total_weight = sum(weights)
+    if not total_weight:
+        return counts
     
-    all_questions = []
-    questions_generated = 0
+    bounds = list(itertools.accumulate(weights))
+    for i in range(total_questions):
+        position = (i + 0.5) * total_weight / total_questions
+        counts[min(bisect.bisect_right(bounds, position), len(counts) - 1)] += 1
     
-    for i, chunk in enumerate(chunks):
-        if questions_generated >= total_questions:
+    # Move questions over the cap to the sections with the most room relative to their size
+    excess = sum(max(0, count - cap) for count in counts)
+    counts = [min(count, cap) for count in counts]
+    while excess:
+        open_sections = [index for index, count in enumerate(counts) if count < cap]
+        if not open_sections:
             break
-            
-        # Calculate how many questions to generate from this chunk
-        remaining_questions = total_questions - questions_generated
-        questions_for_chunk = min(questions_per_batch, remaining_questions)
+        index = min(open_sections, key=lambda index: counts[index] / max(1, weights[index]))
+        counts[index] += 1
+        excess -= 1
+    return counts
+
+
+def sample_excerpts(text, max_tokens, num_excerpts, model=None):
+    """
+    Condense text to about max_tokens as evenly spaced excerpts, one per question where they fit
+    """
+    num_excerpts = max(1, min(num_excerpts, max_tokens // MCQ_EXCERPT_MIN_TOKENS))
+    separator = "\n\n[...]\n\n"
+    excerpt_tokens = max(1, (max_tokens - num_excerpts * count_tokens(separator, model)) // num_excerpts)
+    passages = split_text_by_tokens(text, excerpt_tokens, 0, model)
+    picked = [passages[int((j + 0.5) * len(passages) / num_excerpts)] for j in range(min(num_excerpts, len(passages)))]
+    return separator.join(picked)
+
+
+def split_text_evenly(text, parts, overlap_chars=0):
+    """
+    Split text into exactly parts pieces of about equal length (fewer only if the text is too
+    short), breaking at whitespace; each piece also repeats the last overlap_chars of the previous one
+    """
+    chunks = []
+    start = 0
+    for i in range(1, parts + 1):
+        end = len(text) if i == parts else len(text) * i // parts
+        space = text.find(" ", end)
+        end = len(text) if i == parts or space == -1 else space
+        if end > start:
+            chunk = text[max(0, start - overlap_chars):end].strip()
+            if chunk:
+                chunks.append(chunk)
+            start = end
+    return chunks
+
+
+def split_text_by_tokens(text, max_tokens, overlap_tokens, model=None):
+    """
+    Split text into chunks of at most max_tokens (estimated) that overlap by about overlap_tokens,
+    breaking at whitespace where possible
+    """
+    if not text:
+        return []
+    chars_per_token = len(text) / max(1, count_tokens(text, model))
+    overlap_chars = int(overlap_tokens * chars_per_token)
+    
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + max(1, int(max_tokens * chars_per_token)))
+        # Dense passages (numbers, symbols) hold fewer characters per token than the average
+        while end - start > 1 and count_tokens(text[start:end], model) > max_tokens:
+            end = start + int((end - start) * 0.9)
+        if end < len(text):
+            space = max(text.rfind(" ", start + (end - start) // 2, end), text.rfind("\n", start + (end - start) // 2, end))
+            if space > start:
+                end = space
         
-        print(f"Processing chunk {i+1}/{len(chunks)} - generating {questions_for_chunk} questions")
+        chunks.append(text[start:end].strip())
         
-        # Generate questions from this chunk
-        chunk_questions = generate_single_batch_mcqs(chunk, questions_for_chunk)
+        # Stop if we've covered the entire text
+        if end >= len(text):
+            break
+        start = max(end - overlap_chars, start + 1)
+    return chunks
+
+
+class _ChunkDispatcher:
+    """
+    Bookkeeping shared by the thread-pool and asyncio chunk generators
+    
+    Chunks are dispatched lazily: a new chunk is only sent once the questions already
+    generated plus the questions still in flight fall short of total_questions, so a
+    failed chunk is replaced by the next one instead of every chunk being requested up front.
+    """
+    def __init__(self, chunk_plan, total_questions, max_workers):
+        self.chunk_plan = chunk_plan
+        self.total_questions = total_questions
+        self.max_workers = max_workers
+        self.results = {}  # chunk index -> list of questions
+        self.in_flight = {}  # future/task -> (chunk index, questions requested)
+        self.questions_generated = 0
+        self.next_chunk = 0
+    
+    def next_dispatches(self):
+        """
+        Yield (chunk index, chunk text, questions for chunk) for every chunk that should start now
+        """
+        pending_questions = sum(count for _, count in self.in_flight.values())
+        while (self.next_chunk < len(self.chunk_plan)
+               and len(self.in_flight) < self.max_workers
+               and self.questions_generated + pending_questions < self.total_questions):
+            chunk, questions_for_chunk = self.chunk_plan[self.next_chunk]
+            remaining_questions = self.total_questions - self.questions_generated - pending_questions
+            questions_for_chunk = min(questions_for_chunk, remaining_questions)
+            print(f"Processing chunk {self.next_chunk+1}/{len(self.chunk_plan)} - generating {questions_for_chunk} questions")
+            yield self.next_chunk, chunk, questions_for_chunk
+            pending_questions += questions_for_chunk
+            self.next_chunk += 1
+    
+    def started(self, handle, index, questions_for_chunk):
+        self.in_flight[handle] = (index, questions_for_chunk)
+    
+    def finished(self, handle):
+        index, _ = self.in_flight.pop(handle)
+        try:
+            chunk_questions = handle.result()
+        except Exception as e:
+            print(f"Error processing chunk {index+1}: {str(e)}")
+            chunk_questions = []
         
         if chunk_questions:
-            all_questions.extend(chunk_questions)
-            questions_generated += len(chunk_questions)
-            print(f"Generated {len(chunk_questions)} questions from chunk {i+1} (Total: {questions_generated})")
+            self.results[index] = chunk_questions
+            self.questions_generated += len(chunk_questions)
+            print(f"Generated {len(chunk_questions)} questions from chunk {index+1} (Total: {self.questions_generated})")
         else:
-            print(f"Failed to generate questions from chunk {i+1}")
+            print(f"Failed to generate questions from chunk {index+1}")
+        return index, chunk_questions
+    
+    def collect(self):
+        return _collect_chunk_results(self.results, self.total_questions)
+
+
+def _collect_chunk_results(results, total_questions):
+    # Reassemble in document order regardless of completion order
+    all_questions = []
+    for index in sorted(results):
+        all_questions.extend(results[index])
+    all_questions = all_questions[:total_questions]
     
     print(f"Batch processing complete: {len(all_questions)} total questions generated")
     return all_questions
 
 
-def generate_single_batch_mcqs(text, num_questions):
+def generate_chunks_concurrently(chunk_plan, total_questions, max_workers=None, on_result=None):
     """
-    Generate questions from a single text chunk (original function logic)
+    Fan chunk requests out over a thread pool and collect the results in document order.
+    
+    Args:
+        chunk_plan: List of (chunk_text, questions_for_chunk) tuples in document order
+        total_questions: Number of questions requested overall
+        max_workers: Maximum number of concurrent LLM calls (default: MAX_CONCURRENT_BATCHES)
+        on_result: Optional callback(chunk index, questions) run in the calling thread as each chunk
+            finishes (questions is [] if the chunk failed)
+    
+    Returns:
+        List of question dictionaries, in chunk order, capped at total_questions
     """
-    # Recommended models for reliable JSON generation (2025)
-    models_to_try = [
-        "llama-3.1-8b-instant",      # Fast and reliable
-        "gemma2-9b-it",              # Excellent for structured output  
-        "llama-3.1-70b-versatile",   # Powerful fallback
-        "llama3-8b-8192"             # Backup option
-    ]
+    results = {}
+    for index, chunk_questions in iter_chunks_concurrently(chunk_plan, total_questions, max_workers):
+        if on_result:
+            on_result(index, chunk_questions)
+        if chunk_questions:
+            results[index] = chunk_questions
     
-    # No text limits - batch processing handles large content automatically
-    print(f"Single batch mode: processing {len(text)} characters for {num_questions} questions")
+    return _collect_chunk_results(results, total_questions)
+
+
+def iter_chunks_concurrently(chunk_plan, total_questions, max_workers=None):
+    """
+    Run chunk requests over a thread pool, yielding (chunk index, questions) in completion order
+    
+    questions is [] for a chunk that failed. Closing the generator early stops dispatching new
+    chunks and waits for the ones already in flight.
+    """
+    max_workers = max(1, max_workers or MAX_CONCURRENT_BATCHES)
+    print(f"Generating from up to {len(chunk_plan)} chunks with {max_workers} concurrent requests")
+    dispatcher = _ChunkDispatcher(chunk_plan, total_questions, max_workers)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Dispatch more chunks while there is spare capacity and the count isn't covered yet
+            for index, chunk, questions_for_chunk in dispatcher.next_dispatches():
+                future = executor.submit(generate_single_batch_mcqs, chunk, questions_for_chunk)
+                dispatcher.started(future, index, questions_for_chunk)
+            
+            if not dispatcher.in_flight:
+                break
+            
+            done, _ = wait(dispatcher.in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield dispatcher.finished(future)
+
+
+async def agenerate_chunks_concurrently(chunk_plan, total_questions, max_workers=None):
+    """
+    Async version of generate_chunks_concurrently, running chunk requests as tasks on the event loop
+    """
+    max_workers = max(1, max_workers or MAX_CONCURRENT_BATCHES)
+    print(f"Generating from up to {len(chunk_plan)} chunks with {max_workers} concurrent requests")
+    dispatcher = _ChunkDispatcher(chunk_plan, total_questions, max_workers)
+    
+    try:
+        while True:
+            for index, chunk, questions_for_chunk in dispatcher.next_dispatches():
+                task = asyncio.ensure_future(agenerate_single_batch_mcqs(chunk, questions_for_chunk))
+                dispatcher.started(task, index, questions_for_chunk)
+            
+            if not dispatcher.in_flight:
+                break
+            
+            done, _ = await asyncio.wait(dispatcher.in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                dispatcher.finished(task)
+    finally:
+        # If the caller is cancelled (e.g. the client disconnected), stop the chunk requests too
+        for task in dispatcher.in_flight:
+            task.cancel()
+    
+    return dispatcher.collect()
+
+
+def _mcq_messages(text, num_questions, avoid=None):
+    avoid_text = ""
+    if avoid:
+        avoid_text = "\n\nDo not repeat any of these existing questions:\n" + "\n".join(f"- {q}" for q in avoid)
     
-    prompt = f"""Generate exactly {num_questions} multiple choice questions from this text. For each question, provide 4 options and mark the correct answer.
+    prompt = f"""Generate exactly {num_questions} multiple choice questions from this text. For each question, provide 4 options and mark the correct answer.{avoid_text}
 
 Text to generate questions from:
 {text}
@@ -131,90 +607,290 @@ Respond in this exact JSON format with no additional text:
         "answer": "a"
     }}
 ]"""
+    
+    return [{
+        "role": "system",
+        "content": "You are a quiz generator that always responds with valid JSON containing multiple choice questions."
+    },
+    {
+        "role": "user",
+        "content": prompt
+    }]
+
+
+def build_mcq_request(text, num_questions, model, avoid=None):
+    """
+    Build the chat completion arguments for generating num_questions MCQs from a text chunk
+    
+    avoid optionally lists question texts already generated, which the new questions must not repeat.
+    """
+    messages = _mcq_messages(text, num_questions, avoid)
+    
+    # Budget the response from the model's limits and the prompt's actual size
+    # (0 if the prompt alone doesn't leave room for an answer)
+    max_tokens = mcq_max_tokens(num_questions, model, count_message_tokens(messages, model))
+    
+    print(f"Using {max_tokens} max_tokens for {num_questions} questions")
+    
+    return {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens
+    }
+
+
+def _mcq_request_for(text, num_questions, model, avoid=None):
+    """
+    build_mcq_request, raising ValueError if the prompt leaves no room for even one question
+    """
+    print(f"Trying model: {model} for {num_questions} questions")
+    request = build_mcq_request(text, num_questions, model, avoid=avoid)
+    if request["max_tokens"] < mcq_output_tokens(1):
+        raise ValueError(f"Chunk too large for {model}'s context window, skipping")
+    return request
+
+
+def _request_mcqs(text, num_questions, model):
+    """
+    One MCQ request to model; raises if the model can't produce any valid questions
+    """
+    request = _mcq_request_for(text, num_questions, model)
+    questions = cached_chat_completion(**request, parse=parse_mcq_response)
+    print(f"Successfully generated {len(questions)} questions using {model}")
+    return questions
+
+
+async def _arequest_mcqs(text, num_questions, model):
+    request = _mcq_request_for(text, num_questions, model)
+    questions = await acached_chat_completion(**request, parse=parse_mcq_response)
+    print(f"Successfully generated {len(questions)} questions using {model}")
+    return questions
+
+
+def _report_model_error(model, e):
+    if isinstance(e, openai.error.OpenAIError):
+        print(f"Groq API Error with {model}: {str(e)}")
+    elif isinstance(e, json.JSONDecodeError):
+        print(f"JSON parsing error with {model}: {str(e)}")
+    else:
+        print(f"Error with {model}: {str(e)}")
+
+
+def _merge_topup(questions, extra, shortfall):
+    seen = {q["question"].strip().lower() for q in questions}
+    new_questions = [q for q in extra if q["question"].strip().lower() not in seen][:shortfall]
+    print(f"Top-up added {len(new_questions)} of {shortfall} missing questions")
+    return questions + new_questions
+
+
+def generate_single_batch_mcqs(text, num_questions):
+    """
+    Generate questions from a single text chunk (original function logic)
+    
+    Whatever valid questions a truncated response holds are kept, and only the shortfall is
+    requested again from the same model (up to MCQ_TOPUP_ROUNDS times).
+    """
+    # No text limits - batch processing handles large content automatically
+    print(f"Single batch mode: processing {len(text)} characters for {num_questions} questions")
+    
+    # Models are tried healthiest first: one that is rate limited or failing is passed over, and
+    # with LLM_HEDGING a request slower than the model usually is also goes to the next model
+    estimated_tokens = count_tokens(text) + mcq_output_tokens(num_questions)
+    model, questions = llm_scheduler.first_success(
+        MODELS_TO_TRY,
+        lambda model: _request_mcqs(text, num_questions, model),
+        tokens=estimated_tokens,
+        hedge=LLM_HEDGING,
+        on_error=_report_model_error
+    )
+    if model is None:
+        print("All models failed for this batch")
+        return []
+    
+    for _ in range(MCQ_TOPUP_ROUNDS):
+        shortfall = num_questions - len(questions)
+        if shortfall <= 0:
+            break
+        try:
+            request = _mcq_request_for(text, shortfall, model, avoid=[q["question"] for q in questions])
+        except ValueError:
+            # The questions to avoid have grown the prompt past what leaves room for an answer
+            print(f"Skipping top-up: no room for another question in {model}'s context window")
+            break
+        try:
+            extra = cached_chat_completion(**request, parse=parse_mcq_response)
+        except Exception as e:
+            _report_model_error(model, e)
+            break
+        questions = _merge_topup(questions, extra, shortfall)
+    
+    return questions
+
 
-    for model in models_to_try:
+async def agenerate_single_batch_mcqs(text, num_questions):
+    """
+    Async version of generate_single_batch_mcqs
+    """
+    print(f"Single batch mode: processing {len(text)} characters for {num_questions} questions")
+    
+    # Models are tried healthiest first; hedged attempts that lose the race are cancelled
+    estimated_tokens = count_tokens(text) + mcq_output_tokens(num_questions)
+    model, questions = await llm_scheduler.afirst_success(
+        MODELS_TO_TRY,
+        lambda model: _arequest_mcqs(text, num_questions, model),
+        tokens=estimated_tokens,
+        hedge=LLM_HEDGING,
+        on_error=_report_model_error
+    )
+    if model is None:
+        print("All models failed for this batch")
+        return []
+    
+    for _ in range(MCQ_TOPUP_ROUNDS):
+        shortfall = num_questions - len(questions)
+        if shortfall <= 0:
+            break
         try:
-            print(f"Trying model: {model} for {num_questions} questions")
-            
-            # Dynamic max_tokens based on number of questions
-            # Roughly 80-120 tokens per question (including options)
-            base_tokens = 200  # For prompt overhead
-            tokens_per_question = 100
-            max_tokens = base_tokens + (num_questions * tokens_per_question)
-            max_tokens = min(max_tokens, 2000)  # Cap at 2000 to stay within limits
-            
-            print(f"Using {max_tokens} max_tokens for {num_questions} questions")
-            
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=[{
-                    "role": "system",
-                    "content": "You are a quiz generator that always responds with valid JSON containing multiple choice questions."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }],
-                temperature=0.7,
-                max_tokens=max_tokens
-            )
-            import json
-            content = response['choices'][0]['message']['content'].strip()
-            # Remove any markdown code block markers if present
-            content = content.replace('```json', '').replace('```', '').strip()
-            
-            questions = json.loads(content)
-            print(f"Successfully generated {len(questions)} questions using {model}")
-            return questions
-        except openai.error.OpenAIError as e:
-            print(f"Groq API Error with {model}: {str(e)}")
-            continue
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error with {model}: {str(e)}")
-            continue
+            request = _mcq_request_for(text, shortfall, model, avoid=[q["question"] for q in questions])
+        except ValueError:
+            # The questions to avoid have grown the prompt past what leaves room for an answer
+            print(f"Skipping top-up: no room for another question in {model}'s context window")
+            break
+        try:
+            extra = await acached_chat_completion(**request, parse=parse_mcq_response)
         except Exception as e:
-            print(f"Error with {model}: {str(e)}")
-            continue
+            _report_model_error(model, e)
+            break
+        questions = _merge_topup(questions, extra, shortfall)
     
-    print("All models failed for this batch")
-    return []
+    return questions
 
 
-def generate_answer_explanations(questions_data, pdf_context=""):
+def estimate_tokens(text):
+    """
+    Token count for budgeting explanation requests
+    """
+    return count_tokens(text, EXPLANATION_MODEL)
+
+
+def plan_explanation_groups(questions_data):
+    """
+    Split questions into groups whose explanations fit in one response
+    
+    Each question is estimated at EXPLANATION_TOKENS_PER_QUESTION output tokens plus its own
+    estimated size. The estimate only decides the grouping: groups are filled to
+    EXPLANATION_GROUP_TOKENS, and every request still allows EXPLANATION_MAX_TOKENS.
+    """
+    groups = []
+    current = []
+    budget = EXPLANATION_BASE_TOKENS
+    for q in questions_data:
+        option_text = " ".join(option['text'] for option in q['options'])
+        cost = EXPLANATION_TOKENS_PER_QUESTION + estimate_tokens(q['question_text'] + option_text) // 2
+        if current and budget + cost > EXPLANATION_GROUP_TOKENS:
+            groups.append(current)
+            current = []
+            budget = EXPLANATION_BASE_TOKENS
+        current.append(q)
+        budget += cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _merge_explanations(questions_data, results):
+    # Merge by question_id so every requested question appears once, in request order
+    by_id = {}
+    for explanations in results:
+        for exp in explanations:
+            by_id.setdefault(exp.get('question_id'), exp)
+    return [by_id[q['question_id']] for q in questions_data if q['question_id'] in by_id]
+
+
+def generate_answer_explanations(questions_data, pdf_context="", context_builder=None, max_workers=None):
     """
     Generate AI explanations for quiz questions and answers
     
+    Questions are split into token-bounded groups (see plan_explanation_groups) that are sent
+    to the AI concurrently, and the results are merged back in question order.
+    
     Args:
         questions_data: List of question dictionaries with options and correct answers
-        pdf_context: Original PDF text content for context (optional)
+        pdf_context: Original PDF text content for context (optional), shared by every group
+        context_builder: Optional callable taking a group of questions and returning the context
+            for just that group; takes precedence over pdf_context. It runs on the worker threads,
+            so it must not query the database
+        max_workers: Maximum number of concurrent LLM calls (default: MAX_CONCURRENT_BATCHES)
     
     Returns:
-        List of explanation dictionaries
+        List of explanation dictionaries; canned fallback entries carry "fallback": True
     """
-    print(f"DEBUG: Generating explanations for {len(questions_data)} questions")
+    groups = plan_explanation_groups(questions_data)
+    if len(groups) > 1:
+        print(f"Explaining {len(questions_data)} questions in {len(groups)} groups")
+    
+    def explain_group(group):
+        context = context_builder(group) if context_builder else pdf_context
+        return generate_explanation_batch(group, context)
+    
+    max_workers = max(1, min(max_workers or MAX_CONCURRENT_BATCHES, len(groups)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(explain_group, groups))
+    
+    return _merge_explanations(questions_data, results)
+
+
+async def agenerate_answer_explanations(questions_data, pdf_context="", context_builder=None, max_workers=None):
+    """
+    Async version of generate_answer_explanations
+    
+    context_builder may be a coroutine function here, since building context can touch the database.
+    """
+    groups = plan_explanation_groups(questions_data)
+    if len(groups) > 1:
+        print(f"Explaining {len(questions_data)} questions in {len(groups)} groups")
+    
+    semaphore = asyncio.Semaphore(max(1, max_workers or MAX_CONCURRENT_BATCHES))
+    
+    async def explain_group(group):
+        async with semaphore:
+            context = pdf_context
+            if context_builder:
+                context = context_builder(group)
+                if inspect.isawaitable(context):
+                    context = await context
+            return await agenerate_explanation_batch(group, context)
+    
+    results = await asyncio.gather(*(explain_group(group) for group in groups))
+    return _merge_explanations(questions_data, results)
+
+
+def build_explanation_request(questions_data, pdf_context="", max_tokens=None):
+    """
+    Build the chat completion arguments for explaining one group of questions
+    """
+    # Smart context limiting for explanations (more generous now with batch system)
+    # Use more context since questions are typically few and specific
+    max_context_chars = EXPLANATION_CONTEXT_CHARS
+    if pdf_context and len(pdf_context) > max_context_chars:
+        # Take the first part for better context
+        pdf_context = pdf_context[:max_context_chars]
+        print(f"PDF context limited to {max_context_chars} characters for explanations")
+    
+    # Prepare the prompt for AI explanation generation
+    context_section = f"\n\nExcerpts from the original PDF (for context):\n{pdf_context}" if pdf_context else ""
+    
+    questions_text = ""
     for q in questions_data:
-        print(f"DEBUG: Question {q['question_id']}: {q['question_text'][:50]}...")
+        questions_text += f"\nQuestion ID {q['question_id']}: {q['question_text']}\n"
+        for i, option in enumerate(q['options']):
+            status = " ✓ CORRECT ANSWER" if option['is_correct'] else ""
+            questions_text += f"   {chr(97+i)}) {option['text']}{status}\n"
+        if q.get('passage_refs'):
+            questions_text += f"   Relevant passages: {', '.join(str(n) for n in q['passage_refs'])}\n"
     
-    try:
-        # Smart context limiting for explanations (more generous now with batch system)
-        # Use more context since questions are typically few and specific
-        max_context_chars = 3000  # Increased from 1000 to 3000
-        if pdf_context and len(pdf_context) > max_context_chars:
-            # Take the first part for better context
-            pdf_context = pdf_context[:max_context_chars]
-            print(f"PDF context limited to {max_context_chars} characters for explanations")
-        
-        # Prepare the prompt for AI explanation generation
-        context_section = f"\n\nOriginal PDF Content (for context):\n{pdf_context}" if pdf_context else ""
-        
-        questions_text = ""
-        for q in questions_data:
-            questions_text += f"\nQuestion ID {q['question_id']}: {q['question_text']}\n"
-            for i, option in enumerate(q['options']):
-                status = " ✓ CORRECT ANSWER" if option['is_correct'] else ""
-                questions_text += f"   {chr(97+i)}) {option['text']}{status}\n"
-        
-        prompt = f"""You are an educational AI assistant. Provide clear, helpful explanations for the following quiz questions and their correct answers.
+    prompt = f"""You are an educational AI assistant. Provide clear, helpful explanations for the following quiz questions and their correct answers.
 
 IMPORTANT: Use the exact Question IDs provided. Do not change or renumber them.
 
@@ -242,84 +918,100 @@ You MUST use the exact question IDs provided above. Example format:
 ]
 
 Respond with ONLY the JSON array, no additional text."""
+    
+    print(f"DEBUG: Prompt sent to AI:\n{prompt[:500]}...")
+    
+    return {
+        "model": EXPLANATION_MODEL,
+        "messages": [{
+            "role": "system",
+            "content": "You are an educational assistant. Always respond with valid JSON format."
+        }, {
+            "role": "user",
+            "content": prompt
+        }],
+        "temperature": 0.3,  # Lower temperature for more consistent explanations
+        "max_tokens": max_tokens or EXPLANATION_MAX_TOKENS
+    }
 
-        print(f"DEBUG: Prompt sent to AI:\n{prompt[:500]}...")
-        
-        response = openai.ChatCompletion.create(
-            model="llama-3.1-8b-instant",  # Updated to more reliable model
-            messages=[{
-                "role": "system",
-                "content": "You are an educational assistant. Always respond with valid JSON format."
-            }, {
-                "role": "user",
-                "content": prompt
-            }],
-            temperature=0.3,  # Lower temperature for more consistent explanations
-            max_tokens=1500
-        )
-        
-        import json
-        content = response['choices'][0]['message']['content'].strip()
-        print(f"Raw explanation response: '{content}'")  # Debug log
-        
-        # Remove any markdown code block markers if present
-        content = content.replace('```json', '').replace('```', '').strip()
-        
-        if not content:
-            print("Empty content received from AI")
-            raise ValueError("Empty response from AI")
-            
-        explanations = json.loads(content)
-        
-        # Ensure we have explanations for all requested questions
-        explained_ids = {exp['question_id'] for exp in explanations}
-        for q in questions_data:
-            if q['question_id'] not in explained_ids:
-                # Add fallback explanation if AI missed any
-                explanations.append({
-                    "question_id": q['question_id'],
-                    "explanation": f"The correct answer is '{q['correct_answer']}'. This is based on the content provided.",
-                    "key_concepts": ["Review the material", "Study the context"]
-                })
-        
-        return explanations
-        
-    except openai.error.OpenAIError as e:
-        print(f"Groq API Error: {str(e)}")
-        # Return fallback explanations
-        fallback_explanations = []
-        for q in questions_data:
-            fallback_explanations.append({
+
+def _complete_explanations(explanations, questions_data):
+    # Ensure we have explanations for all requested questions
+    explained_ids = {exp['question_id'] for exp in explanations}
+    for q in questions_data:
+        if q['question_id'] not in explained_ids:
+            # Add fallback explanation if AI missed any
+            explanations.append({
                 "question_id": q['question_id'],
-                "explanation": f"The correct answer is '{q.get('correct_answer', 'N/A')}'. For a detailed explanation, please review the source material.",
-                "key_concepts": ["Study the content", "Review definitions"]
+                "explanation": f"The correct answer is '{q['correct_answer']}'. This is based on the content provided.",
+                "key_concepts": ["Review the material", "Study the context"],
+                "fallback": True  # Canned text, not worth storing
             })
-        return fallback_explanations
-    except json.JSONDecodeError as e:
+    
+    return explanations
+
+
+def _fallback_explanations(questions_data, e):
+    if isinstance(e, openai.error.OpenAIError):
+        print(f"Groq API Error: {str(e)}")
+    elif isinstance(e, json.JSONDecodeError):
         print(f"JSON parsing error: {str(e)}")
-        print(f"Content that failed to parse: '{content}'")
-        # Return fallback explanations
-        fallback_explanations = []
-        for q in questions_data:
-            fallback_explanations.append({
-                "question_id": q['question_id'],
-                "explanation": f"Unable to generate detailed explanation. The correct answer is based on the provided content.",
-                "key_concepts": ["Study the content", "Review definitions"]
-            })
-        return fallback_explanations
-    except Exception as e:
+        print(f"Content that failed to parse: '{e.doc}'")
+    else:
         print("Error generating explanations:", str(e))
-        # Return fallback explanations
-        fallback_explanations = []
-        for q in questions_data:
-            fallback_explanations.append({
-                "question_id": q['question_id'],
-                "explanation": f"For a detailed explanation, please review the source material.",
-                "key_concepts": ["Study the content", "Review definitions"]
-            })
-        return fallback_explanations
-
+    
+    # Return fallback explanations
+    fallback_explanations = []
+    for q in questions_data:
+        if isinstance(e, openai.error.OpenAIError):
+            explanation = f"The correct answer is '{q.get('correct_answer', 'N/A')}'. For a detailed explanation, please review the source material."
+        elif isinstance(e, json.JSONDecodeError):
+            explanation = "Unable to generate detailed explanation. The correct answer is based on the provided content."
+        else:
+            explanation = "For a detailed explanation, please review the source material."
+        fallback_explanations.append({
+            "question_id": q['question_id'],
+            "explanation": explanation,
+            "key_concepts": ["Study the content", "Review definitions"],
+            "fallback": True  # Canned text, not worth storing
+        })
+    return fallback_explanations
 
 
+def generate_explanation_batch(questions_data, pdf_context="", max_tokens=None):
+    """
+    Generate AI explanations for one group of questions in a single request
+    
+    Args:
+        questions_data: List of question dictionaries with options and correct answers
+        pdf_context: Original PDF text content for context (optional); questions may carry
+            "passage_refs" naming the numbered passages in it that relate to them
+        max_tokens: Output token limit for the response (default: EXPLANATION_MAX_TOKENS)
+    
+    Returns:
+        List of explanation dictionaries; canned fallback entries carry "fallback": True
+    """
+    print(f"DEBUG: Generating explanations for {len(questions_data)} questions")
+    for q in questions_data:
+        print(f"DEBUG: Question {q['question_id']}: {q['question_text'][:50]}...")
+    
+    try:
+        request = build_explanation_request(questions_data, pdf_context, max_tokens)
+        explanations = cached_chat_completion(**request, parse=parse_explanation_response)
+        return _complete_explanations(explanations, questions_data)
+    except Exception as e:
+        return _fallback_explanations(questions_data, e)
 
 
+async def agenerate_explanation_batch(questions_data, pdf_context="", max_tokens=None):
+    """
+    Async version of generate_explanation_batch
+    """
+    print(f"DEBUG: Generating explanations for {len(questions_data)} questions")
+    
+    try:
+        request = build_explanation_request(questions_data, pdf_context, max_tokens)
+        explanations = await acached_chat_completion(**request, parse=parse_explanation_response)
+        return _complete_explanations(explanations, questions_data)
+    except Exception as e:
+        return _fallback_explanations(questions_data, e)
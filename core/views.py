@@ -1,13 +1,42 @@
+import json
+
 from django.shortcuts import render
-from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.db.models import Count, F, Q
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework import status, permissions,viewsets
+from rest_framework import status, permissions, viewsets, pagination
+
+from .models import UploadedPDF,Quiz, QuizAttempt, UserAnswer, QuizStatistics, GenerationJob
+from .serializers import UploadedPDFSerializer, QuizDetailSerializer, QuizSummarySerializer
+from .analytics import compute_item_analysis
+from .jobs import enqueue_generation_job, run_generation_job_now
+from .retrieval import get_pdf_index, select_passages
+from .services import (
+    grade_submission, get_answer_key, get_quiz_payload, GradingError,
+    load_stored_explanations, store_explanations, build_explanation_questions, stream_quiz_generation
+)
+from .utils import (
+    extract_pages_from_pdf, generate_answer_explanations, compute_file_hash,
+    EXPLANATION_CONTEXT_CHARS
+)
+
+def validate_num_questions(num_questions):
+    """
+    Return an error message if num_questions isn't acceptable for quiz generation, else None
+    """
+    # Validate num_questions (no upper limit - batch processing handles any amount!)
+    if not isinstance(num_questions, int) or num_questions < 1:
+        return "num_questions must be a positive integer (minimum 1)"
+    
+    # Add reasonable upper limit to prevent abuse (can be adjusted)
+    if num_questions > 200:
+        return "Maximum 200 questions per request (to prevent timeout). Please make multiple requests for more."
+    
+    return None
 
-from .models import UploadedPDF,Quiz, Question, Option, QuizAttempt, UserAnswer
-from .serializers import UploadedPDFSerializer,QuizDetailSerializer
-from .utils import extract_text_from_pdf,generate_mcqs_from_text, generate_answer_explanations
 
 class PDFUploadView(APIView):
     parser_classes = [MultiPartParser, FormParser]
@@ -23,18 +52,59 @@ class PDFUploadView(APIView):
 
         # Handle case when user is not authenticated
         user = request.user if request.user.is_authenticated else None
+        reuse_quizzes = request.data.get('reuse_quizzes', 'true').lower() == 'true'
+
+        # Look for an identical document that was already uploaded and parsed
+        content_hash = compute_file_hash(file)
+        matches = UploadedPDF.objects.filter(
+            content_hash=content_hash,
+            page_count__isnull=False
+        ).order_by('uploaded_at')
+        existing_pdf = matches.first()
+
+        if existing_pdf:
+            # Reuse the stored file and extracted pages instead of writing and parsing a new copy
+            pdf_instance = UploadedPDF.objects.create(
+                user=user,
+                title=title,
+                pdf_file=existing_pdf.pdf_file.name,
+                is_public=is_public,
+                content_hash=content_hash
+            )
+            pdf_instance.share_pages(existing_pdf)
+
+            response_data = UploadedPDFSerializer(pdf_instance).data
+
+            # Only name an earlier upload this user is allowed to see
+            visible_pdf = Q(is_public=True)
+            if user:
+                visible_pdf |= Q(user=user)
+            visible_match = matches.filter(visible_pdf).exclude(id=pdf_instance.id).first()
+            if visible_match:
+                response_data['duplicate_of'] = visible_match.id
+
+            if reuse_quizzes:
+                # Only offer quizzes from copies this user is allowed to see
+                visible = Q(pdf__is_public=True)
+                if user:
+                    visible |= Q(pdf__user=user)
+                existing_quizzes = Quiz.objects.filter(
+                    visible, pdf__content_hash=content_hash
+                ).order_by('-created_at').values('id', 'title', 'created_at')
+                response_data['existing_quizzes'] = list(existing_quizzes)
+
+            return Response(response_data, status=201)
 
         pdf_instance = UploadedPDF.objects.create(
             user=user,
             title=title,
             pdf_file=file,
-            is_public=is_public
+            is_public=is_public,
+            content_hash=content_hash
         )
 
-        # Extract text
-        text = extract_text_from_pdf(pdf_instance.pdf_file.path)
-        pdf_instance.extracted_text = text
-        pdf_instance.save()
+        # Extract text page by page
+        pdf_instance.set_pages(extract_pages_from_pdf(pdf_instance.pdf_file.path))
 
         serializer = UploadedPDFSerializer(pdf_instance)
         return Response(serializer.data, status=201)
@@ -46,13 +116,17 @@ class TestView(APIView):
 
 class GenerateQuizView(APIView):
     """
-    Generate quiz from PDF
+    Queue quiz generation from a PDF
     POST /api/generate-quiz/{pdf_id}/
     
     Optional payload:
     {
-        "num_questions": 10
+        "num_questions": 10,
+        "wait": false  # true generates in this request and answers with the quiz, as before
     }
+    
+    Returns 202 with a job ID; poll GET /api/generation-jobs/{job_id}/ for progress.
+    Run `python manage.py run_generation_worker` to process queued jobs.
     """
     def post(self, request, pdf_id):
         try:
@@ -62,85 +136,189 @@ class GenerateQuizView(APIView):
 
         # Get number of questions from request data, default to 5
         num_questions = request.data.get('num_questions', 5)
-        
-        # Validate num_questions (no upper limit - batch processing handles any amount!)
-        if not isinstance(num_questions, int) or num_questions < 1:
-            return Response({
-                "error": "num_questions must be a positive integer (minimum 1)"
-            }, status=400)
-        
-        # Add reasonable upper limit to prevent abuse (can be adjusted)
-        if num_questions > 200:
-            return Response({
-                "error": "Maximum 200 questions per request (to prevent timeout). Please make multiple requests for more."
-            }, status=400)
+        error = validate_num_questions(num_questions)
+        if error:
+            return Response({"error": error}, status=400)
+
+        user = request.user if request.user.is_authenticated else None
 
-        questions = generate_mcqs_from_text(pdf.extracted_text, num_questions=num_questions)
+        if request.data.get('wait', False):
+            job = run_generation_job_now(pdf, user, num_questions)
 
-        # Check if AI generated any questions
-        if not questions:
+            # Check if AI generated any questions
+            if job.status != 'completed':
+                return Response({"error": job.error}, status=500)
+
+            actual_questions_count = job.quiz.question_set.count()
             return Response({
-                "error": "Failed to generate questions. Please try again or use a different PDF."
-            }, status=500)
-
-        # Create quiz with actual number of questions generated
-        actual_questions_count = len(questions)
-        quiz = Quiz.objects.create(
-            pdf=pdf, 
-            title=f"Quiz from {pdf.title} ({actual_questions_count} questions)"
-        )
+                "quiz_id": job.quiz_id, 
+                "message": f"Quiz with {actual_questions_count} questions generated successfully",
+                "requested_questions": num_questions,
+                "questions_generated": actual_questions_count
+            })
 
-        for q in questions:
-            ques = Question.objects.create(quiz=quiz, text=q["question"])
-            for key, value in q["options"].items():
-                Option.objects.create(
-                    question=ques,
-                    text=value,
-                    is_correct=(key == q["answer"])
-                )
+        job, created = enqueue_generation_job(pdf, user, num_questions)
 
         return Response({
-            "quiz_id": quiz.id, 
-            "message": f"Quiz with {actual_questions_count} questions generated successfully",
+            "job_id": job.id,
+            "status": job.status,
+            "message": "Quiz generation queued" if created else "Quiz generation already in progress",
             "requested_questions": num_questions,
-            "questions_generated": actual_questions_count
+            "status_url": f"/api/generation-jobs/{job.id}/"
+        }, status=202)
+
+
+class GenerateQuizStreamView(APIView):
+    """
+    Generate quiz from PDF, streaming each chunk's questions as Server-Sent Events
+    POST /api/generate-quiz/{pdf_id}/stream/
+    
+    Optional payload:
+    {
+        "num_questions": 10
+    }
+    
+    Events: "start", one "questions" per generated chunk (saved before it is sent),
+    "chunk_failed", then "complete" with the quiz ID and counts (or "error").
+    """
+    def post(self, request, pdf_id):
+        try:
+            pdf = UploadedPDF.objects.get(id=pdf_id)
+        except UploadedPDF.DoesNotExist:
+            return Response({"error": "PDF not found"}, status=404)
+
+        num_questions = request.data.get('num_questions', 5)
+        error = validate_num_questions(num_questions)
+        if error:
+            return Response({"error": error}, status=400)
+
+        def events():
+            for event, data in stream_quiz_generation(pdf, num_questions):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+        return response
+
+
+class GenerationJobStatusView(APIView):
+    """
+    Get progress of a queued quiz generation
+    GET /api/generation-jobs/{job_id}/
+    """
+    def get(self, request, job_id):
+        try:
+            job = GenerationJob.objects.get(id=job_id)
+        except GenerationJob.DoesNotExist:
+            return Response({"error": "Job not found"}, status=404)
+
+        # Jobs started by a signed-in user are only visible to them
+        if job.user_id and job.user_id != request.user.id:
+            return Response({"error": "Job not found"}, status=404)
+
+        chunks = []
+        questions_generated = 0
+        for index, chunk_status, requested, questions in job.chunks.order_by('index').values_list(
+            'index', 'status', 'questions_requested', 'questions'
+        ):
+            questions_generated += len(questions)
+            chunks.append({
+                "index": index,
+                "status": chunk_status,
+                "questions_requested": requested,
+                "questions_generated": len(questions)
+            })
+
+        return Response({
+            "job_id": job.id,
+            "status": job.status,
+            "pdf_id": job.pdf_id,
+            "quiz_id": job.quiz_id,
+            "requested_questions": job.num_questions,
+            "questions_generated": min(questions_generated, job.num_questions),
+            "chunks_total": len(chunks),
+            "chunks_done": sum(1 for chunk in chunks if chunk["status"] != 'pending'),
+            "chunks": chunks,
+            "attempts": job.attempts,
+            "error": job.error,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at
         })
     
+class QuizCursorPagination(pagination.CursorPagination):
+    ordering = '-created_at'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
 class QuizViewSet(viewsets.ReadOnlyModelViewSet):
     """
     Provides `list` and `retrieve` endpoints for quizzes.
-    GET /api/quizzes/ - List all public quizzes + user's private quizzes
-    GET /api/quizzes/{id}/ - Get specific quiz (if public or belongs to user)
+    GET /api/quizzes/ - Cursor-paginated summaries of public quizzes + user's private quizzes
+    GET /api/quizzes/{id}/ - Get specific quiz with questions and options (if public or belongs to user)
     """
     queryset = Quiz.objects.all()  # Default queryset (will be overridden by get_queryset)
     serializer_class = QuizDetailSerializer
+    pagination_class = QuizCursorPagination
     permission_classes = [permissions.AllowAny]
     
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return QuizSummarySerializer
+        return QuizDetailSerializer
+    
     def get_queryset(self):
         user = self.request.user if self.request.user.is_authenticated else None
         
         if user:
             # Show public quizzes + user's own private quizzes
-            return Quiz.objects.filter(
-                Q(pdf__is_public=True) | Q(pdf__user=user)
-            ).order_by('-created_at')
+            queryset = Quiz.objects.filter(Q(pdf__is_public=True) | Q(pdf__user=user))
         else:
             # Show only public quizzes for anonymous users
-            return Quiz.objects.filter(pdf__is_public=True).order_by('-created_at')
+            queryset = Quiz.objects.filter(pdf__is_public=True)
+        
+        # Flat columns only: the question count is computed in the same query
+        return queryset.annotate(
+            question_count=Count('question'),
+            is_public=F('pdf__is_public'),
+            owner_id=F('pdf__user_id')
+        ).order_by('-created_at')
     
     def retrieve(self, request, pk=None):
+        # Cache keys use the integer id, so "/quizzes/01/" mustn't get an entry of its own
         try:
-            quiz = Quiz.objects.get(pk=pk)
-            user = request.user if request.user.is_authenticated else None
-            
-            # Check if user can access this quiz
-            if not quiz.pdf.is_public and quiz.pdf.user != user:
-                return Response({"error": "This quiz is private"}, status=403)
-            
-            serializer = self.get_serializer(quiz)
-            return Response(serializer.data)
-        except Quiz.DoesNotExist:
+            pk = int(pk)
+        except (TypeError, ValueError):
+            return Response({"error": "Quiz not found"}, status=404)
+        
+        access = Quiz.objects.filter(pk=pk).values('pdf__is_public', 'pdf__user_id').first()
+        if access is None:
             return Response({"error": "Quiz not found"}, status=404)
+        
+        # Check if user can access this quiz
+        user = request.user if request.user.is_authenticated else None
+        if not access['pdf__is_public'] and access['pdf__user_id'] != (user.id if user else None):
+            return Response({"error": "This quiz is private"}, status=403)
+        
+        # Quizzes don't change after generation, so the rendered JSON is cached and revalidated by ETag
+        cached = get_quiz_payload(pk)
+        if cached is None:
+            return Response({"error": "Quiz not found"}, status=404)
+        payload, etag = cached
+        
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            client_etags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+            if '*' in client_etags or etag in client_etags:
+                response = HttpResponse(status=304)
+                response['ETag'] = etag
+                return response
+        
+        response = HttpResponse(payload, content_type='application/json')
+        response['ETag'] = etag
+        return response
 
 
 class SubmitQuizView(APIView):
@@ -181,75 +359,20 @@ class SubmitQuizView(APIView):
             }, status=400)
         
         user = request.user if request.user.is_authenticated else None
-        total_questions = quiz.question_set.count()
-        
-        # Create quiz attempt
-        attempt = QuizAttempt.objects.create(
-            quiz=quiz,
-            user=user,
-            total_questions=total_questions
-        )
-        
-        correct_count = 0
-        results = []
         
-        for answer_data in answers:
-            question_id = answer_data.get('question_id')
-            option_id = answer_data.get('option_id')
-            
-            print(f"Processing: question_id={question_id}, option_id={option_id}")
-            
-            try:
-                question = Question.objects.get(id=question_id, quiz=quiz)
-                print(f"Found question: {question.text[:50]}...")
-                
-                selected_option = Option.objects.get(id=option_id, question=question)
-                print(f"Found option: {selected_option.text}")
-                
-                is_correct = selected_option.is_correct
-                if is_correct:
-                    correct_count += 1
-                
-                # Save user answer
-                UserAnswer.objects.create(
-                    attempt=attempt,
-                    question=question,
-                    selected_option=selected_option,
-                    is_correct=is_correct
-                )
-                
-                # Get correct answer for response
-                correct_option = Option.objects.get(question=question, is_correct=True)
-                
-                results.append({
-                    "question_id": question_id,
-                    "question_text": question.text,
-                    "selected_option": selected_option.text,
-                    "correct_option": correct_option.text,
-                    "is_correct": is_correct
-                })
-                
-            except Question.DoesNotExist:
-                print(f"Question with id={question_id} not found in quiz {quiz_id}")
-                return Response({
-                    "error": f"Question with id {question_id} not found in this quiz"
-                }, status=400)
-            except Option.DoesNotExist:
-                print(f"Option with id={option_id} not found for question {question_id}")
-                return Response({
-                    "error": f"Option with id {option_id} not found for question {question_id}"
-                }, status=400)
-        
-        # Update attempt score
-        attempt.score = correct_count
-        attempt.save()
+        try:
+            graded = grade_submission(quiz, user, answers)
+        except GradingError as e:
+            print(f"Rejected submission for quiz {quiz_id}: {str(e)}")
+            return Response({"error": str(e)}, status=400)
         
+        total_questions = graded["total_questions"]
         return Response({
-            "attempt_id": attempt.id,
-            "score": correct_count,
+            "attempt_id": graded["attempt"].id,
+            "score": graded["score"],
             "total_questions": total_questions,
-            "percentage": round((correct_count / total_questions) * 100, 2),
-            "results": results
+            "percentage": round((graded["score"] / total_questions) * 100, 2),
+            "results": graded["results"]
         })
 
 
@@ -292,32 +415,30 @@ class QuizAttemptDetailView(APIView):
     
     def get(self, request, attempt_id):
         try:
-            attempt = QuizAttempt.objects.get(id=attempt_id)
+            attempt = QuizAttempt.objects.select_related('quiz').get(id=attempt_id)
         except QuizAttempt.DoesNotExist:
             return Response({"error": "Quiz attempt not found"}, status=404)
         
-        # Get all user answers for this attempt
-        user_answers = UserAnswer.objects.filter(attempt=attempt).select_related(
-            'question', 'selected_option'
+        # Question and option texts plus the correct answers come from the cached answer key
+        answer_key = get_answer_key(attempt.quiz_id)
+        user_answers = UserAnswer.objects.filter(attempt=attempt).order_by('id').values_list(
+            'question_id', 'selected_option_id', 'is_correct'
         )
         
         # Build detailed results
         results = []
-        for user_answer in user_answers:
-            # Get correct answer for this question
-            correct_option = Option.objects.get(
-                question=user_answer.question, 
-                is_correct=True
-            )
+        for question_id, selected_option_id, is_correct in user_answers:
+            entry = answer_key[question_id]
+            correct_option_id = entry["correct_option_id"]
             
             results.append({
-                "question_id": user_answer.question.id,
-                "question_text": user_answer.question.text,
-                "selected_option": user_answer.selected_option.text,
-                "selected_option_id": user_answer.selected_option.id,
-                "correct_option": correct_option.text,
-                "correct_option_id": correct_option.id,
-                "is_correct": user_answer.is_correct
+                "question_id": question_id,
+                "question_text": entry["text"],
+                "selected_option": entry["options"].get(selected_option_id),
+                "selected_option_id": selected_option_id,
+                "correct_option": entry["options"].get(correct_option_id),
+                "correct_option_id": correct_option_id,
+                "is_correct": is_correct
             })
         
         return Response({
@@ -345,9 +466,9 @@ class QuizAnalyticsView(APIView):
         except Quiz.DoesNotExist:
             return Response({"error": "Quiz not found"}, status=404)
         
-        attempts = QuizAttempt.objects.filter(quiz=quiz)
-        total_attempts = attempts.count()
-        total_questions = quiz.question_set.count()
+        total_questions = len(get_answer_key(quiz.id))
+        stats = QuizStatistics.objects.filter(quiz=quiz).first()
+        total_attempts = stats.attempt_count if stats else 0
         
         if total_attempts == 0:
             return Response({
@@ -361,14 +482,13 @@ class QuizAnalyticsView(APIView):
                 "lowest_score": 0
             })
         
-        scores = [attempt.score for attempt in attempts]
-        average_score = sum(scores) / len(scores)
-        average_percentage = (average_score / total_questions) * 100
+        average_score = stats.mean
+        average_percentage = (average_score / total_questions) * 100 if total_questions else 0.0
         
         # Consider 60% as passing threshold
         passing_threshold = 0.6
         passing_score = total_questions * passing_threshold
-        passed_attempts = len([score for score in scores if score >= passing_score])
+        passed_attempts = stats.count_at_least(passing_score)
         pass_rate = (passed_attempts / total_attempts) * 100
         
         return Response({
@@ -377,10 +497,42 @@ class QuizAnalyticsView(APIView):
             "total_attempts": total_attempts,
             "average_score": round(average_score, 1),
             "average_percentage": round(average_percentage, 1),
+            "std_dev": round(stats.std_dev, 2),
+            "median_score": stats.percentile(50),
+            "percentiles": {f"p{p}": stats.percentile(p) for p in (25, 50, 75, 90)},
+            "score_distribution": {
+                int(score): count for score, count in sorted(stats.histogram.items(), key=lambda item: int(item[0]))
+            },
             "pass_rate": round(pass_rate, 1),
             "passing_threshold": f"{int(passing_threshold * 100)}%",
-            "highest_score": max(scores),
-            "lowest_score": min(scores)
+            "highest_score": stats.max_score,
+            "lowest_score": stats.min_score
+        })
+
+
+class QuizItemAnalysisView(APIView):
+    """
+    Get per-question item analysis for a specific quiz
+    GET /api/quiz/{quiz_id}/item-analysis/
+    
+    Reports difficulty index, discrimination index (point-biserial against total score)
+    and how often each option was selected.
+    """
+    permission_classes = [permissions.AllowAny]
+    
+    def get(self, request, quiz_id):
+        try:
+            quiz = Quiz.objects.get(id=quiz_id)
+        except Quiz.DoesNotExist:
+            return Response({"error": "Quiz not found"}, status=404)
+        
+        analysis = compute_item_analysis(quiz.id)
+        
+        return Response({
+            "quiz_id": quiz.id,
+            "quiz_title": quiz.title,
+            "total_attempts": analysis["total_attempts"],
+            "questions": analysis["questions"]
         })
 
 
@@ -418,35 +570,35 @@ class QuizExplanationView(APIView):
             return Response({"error": "question_ids must be a list"}, status=400)
         
         # Validate question IDs belong to this quiz
-        questions = Question.objects.filter(id__in=question_ids, quiz=quiz).prefetch_related('option_set')
-        
-        if questions.count() != len(question_ids):
-            found_ids = list(questions.values_list('id', flat=True))
-            invalid_ids = [qid for qid in question_ids if qid not in found_ids]
+        answer_key = get_answer_key(quiz.id)
+        invalid_ids = [qid for qid in question_ids if qid not in answer_key]
+        if invalid_ids:
             return Response({
                 "error": f"Some question IDs don't belong to this quiz: {invalid_ids}"
             }, status=400)
         
         # Prepare questions data for AI explanation
-        questions_data = []
-        for question in questions:
-            options = question.option_set.all()
-            correct_option = options.filter(is_correct=True).first()
-            
-            question_info = {
-                "question_id": question.id,
-                "question_text": question.text,
-                "options": [{"text": opt.text, "is_correct": opt.is_correct} for opt in options],
-                "correct_answer": correct_option.text if correct_option else "N/A"
-            }
-            questions_data.append(question_info)
+        questions_data = build_explanation_questions(answer_key, question_ids)
         
-        # Get PDF context if requested
-        pdf_context = quiz.pdf.extracted_text if include_context else ""
+        # Questions explained before are served from the store; only the rest go to the AI
+        context_mode = 'pdf' if include_context else 'none'
+        stored = load_stored_explanations([q["question_id"] for q in questions_data], context_mode)
+        missing = [q for q in questions_data if q["question_id"] not in stored]
         
         try:
-            # Generate explanations using AI
-            explanations = generate_answer_explanations(questions_data, pdf_context)
+            if missing:
+                # Get PDF context if requested: each group of questions gets only the passages relevant to it.
+                # The index is loaded here, so the worker threads only search it and never touch the database
+                context_builder = None
+                if include_context:
+                    index = get_pdf_index(quiz.pdf)
+                    context_builder = lambda group: select_passages(index, group, max_chars=EXPLANATION_CONTEXT_CHARS)
+                
+                # Generate explanations using AI
+                generated = generate_answer_explanations(missing, context_builder=context_builder)
+                stored.update(store_explanations(generated, [q["question_id"] for q in missing], context_mode))
+            
+            explanations = [stored[q["question_id"]] for q in questions_data]
             
             return Response({
                 "quiz_id": quiz.id,
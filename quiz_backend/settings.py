@@ -143,3 +143,15 @@ REST_FRAMEWORK = {
 }
 
 CORS_ALLOW_ALL_ORIGINS = True
+
+# Quiz answer keys are cached per process; set an alias from CACHES to also share them across workers
+# (and invalidate them everywhere at once). Without one, a worker's copy may be up to
+# ANSWER_KEY_LOCAL_TTL seconds stale after an edit made in another worker.
+ANSWER_KEY_CACHE_ALIAS = None
+ANSWER_KEY_CACHE_SIZE = 500
+ANSWER_KEY_LOCAL_TTL = 30
+
+# Rendered quiz detail payloads, cached the same way as answer keys
+QUIZ_PAYLOAD_CACHE_ALIAS = None
+QUIZ_PAYLOAD_CACHE_SIZE = 200
+QUIZ_PAYLOAD_LOCAL_TTL = 30